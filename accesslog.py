@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+'''
+Structured access log, one JSON object per line:
+
+    {"ts": 1634567890.123, "client": "127.0.0.1", "method": "GET", "path": "/api/v1/models",
+     "route": "/api/v1/models", "status": 200, "bytes": 5120, "ms": 1.92, "db_ms": 0.71,
+     "serialize_ms": 0.45}
+
+The request threads only append the line to a buffer. A background thread
+writes the buffer out every ACCESS_LOG_FLUSH seconds (sooner once it gets
+big), so nobody waits on the terminal or the disk while handling a request.
+'''
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+
+import conf
+
+
+class AccessLog(object):
+
+    def __init__(self, target=conf.ACCESS_LOG, interval=conf.ACCESS_LOG_FLUSH, max_lines=1000):
+        # '-' is stderr, None turns the log off.
+        self.target = target
+        self.interval = interval
+        self.max_lines = max_lines
+        self._lines = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._file = None
+
+    def write(self, **fields):
+        if self.target is None:
+            return
+        line = json.dumps({'ts': round(time.time(), 3), **fields})
+        with self._lock:
+            self._lines.append(line)
+            count = len(self._lines)
+        # The thread doesn't survive a fork, so check it is still there.
+        if self._thread is None or not self._thread.is_alive():
+            self._start()
+        if count >= self.max_lines:
+            self._wake.set()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name='access-log', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
+
+    def _stream(self):
+        if '-' == self.target:
+            return sys.stderr
+        if self._file is None:
+            self._file = open(self.target, 'a')
+        return self._file
+
+    def flush(self):
+        with self._lock:
+            lines, self._lines = self._lines, []
+        if not lines:
+            return
+        try:
+            stream = self._stream()
+            # A single write, so lines from different processes don't get mixed up.
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+
+    def _afterFork(self):
+        # The parent still has these lines and will write them itself.
+        self._lines = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+
+ACCESS_LOG = AccessLog()
+
+# Requests recorded for benchmarks/replay.py when capturing (see
+# conf.CAPTURE_FILE). Same idea, only the lines are a lot bigger.
+CAPTURE = AccessLog(conf.CAPTURE_FILE)
+
+for log in [ACCESS_LOG, CAPTURE]:
+    atexit.register(log.flush)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=log._afterFork)
@@ -0,0 +1,614 @@
+#!/usr/bin/env python3
+
+'''
+asyncio based HTTP engine.
+
+This started out as an echo server experiment. The ThreadingSimpleServer in
+server.py spawns an OS thread for every connection (and occasionally deadlocks
+on shutdown), so idle keep-alive connections are expensive. Here every
+connection is just an asyncio.Protocol sitting on the event loop. A thread is
+only needed while a request is actually being handled.
+
+    $ python3 main.py -engine asyncio
+
+The routes and response helpers are the ones from server.Controller. Requests
+are parsed incrementally on the event loop and then handed to a bounded thread
+pool, where a Controller runs the request exactly like it would in the threaded
+server. This keeps the blocking SQLite (and file) work off the event loop.
+
+A request goes to the thread pool as soon as its headers are in. The body
+follows through a RequestBody the Controller reads like the socket, so a big
+import streams through in constant memory just like in the threaded server.
+'''
+
+import io
+import sys
+import signal
+import asyncio
+import threading
+import traceback
+from http.client import parse_headers
+from concurrent.futures import ThreadPoolExecutor
+
+import conf
+import prefork
+import database
+from models import CHANGE_FEED
+from server import Controller
+
+
+class ParseError(Exception):
+
+    ''' A malformed request. 'status' is the HTTP error to respond with. '''
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+CONTINUE = b'HTTP/1.1 100 Continue\r\n\r\n'
+
+
+class Request(object):
+
+    __slots__ = ('method', 'target', 'version', 'headers', 'body', 'expect_continue')
+
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.body = RequestBody()
+        # The client is waiting for a '100 Continue' before sending the body.
+        self.expect_continue = False
+
+
+class RequestBody(object):
+
+    ''' The request body as the handler thread sees it (the Controller's
+        'rfile'). The event loop feeds it the bytes as they arrive and
+        read/readline block until there is enough, so a request can be
+        handled while its body is still coming in.
+
+        Once 'buffer_size' bytes are waiting the protocol stops reading from
+        the client until the handler catches up. When the handler is done
+        the rest of the body gets dropped as it arrives.
+    '''
+
+    buffer_size = 256 * 1024
+
+    def __init__(self, protocol=None, data=b'', complete=True):
+        self.protocol = protocol
+        self.complete = complete
+        self._buffer = bytearray(data)
+        self._discard = False
+        self._cond = threading.Condition()
+
+    @property
+    def full(self):
+        return not self._discard and len(self._buffer) >= self.buffer_size
+
+    # These are called on the event loop.
+
+    def feed(self, data):
+        with self._cond:
+            if not self._discard:
+                self._buffer += data
+                self._cond.notify_all()
+
+    def finish(self):
+        ''' No more data is coming, the body is all there or the client went away. '''
+        with self._cond:
+            self.complete = True
+            self._cond.notify_all()
+
+    # These are called on the handler thread.
+
+    def read(self, size=-1):
+        with self._cond:
+            self._wait(lambda: 0 <= size <= len(self._buffer))
+            if size < 0 or size > len(self._buffer):
+                size = len(self._buffer)
+            return self._take(size)
+
+    def readline(self, size=-1):
+        with self._cond:
+            self._wait(lambda: -1 != self._buffer.find(b'\n') or 0 <= size <= len(self._buffer))
+            end = self._buffer.find(b'\n')
+            end = len(self._buffer) if -1 == end else end + 1
+            if 0 <= size < end:
+                end = size
+            return self._take(end)
+
+    def discard(self):
+        ''' The handler is done with the body. '''
+        with self._cond:
+            self._discard = True
+            self._buffer.clear()
+        if not self.complete and self.protocol is not None:
+            self.protocol.loop.call_soon_threadsafe(self.protocol.updateReading)
+
+    def _wait(self, ready):
+        if not self._cond.wait_for(lambda: self.complete or ready(), conf.HTTP_KEEPALIVE_TIMEOUT):
+            raise TimeoutError('Client is not sending the request body')
+
+    def _take(self, size):
+        # If it was full the protocol stopped reading, let it start again.
+        full = self.full
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        if full and self.protocol is not None:
+            self.protocol.loop.call_soon_threadsafe(self.protocol.updateReading)
+        return data
+
+
+class HTTPParser(object):
+
+    ''' Incremental HTTP/1.1 request parser.
+
+        Bytes are fed in as they arrive and requests come out. It keeps track
+        of where it left off, so a request split across many packets (or many
+        requests in one packet, when pipelining) is fine.
+
+        A request with a 'Content-Length' body comes out as soon as its headers
+        are in, the body goes to its RequestBody as it arrives ('body' is the
+        one still being received). Chunked bodies are put together first (up
+        to 'max_body_size') and the request comes out once it is complete.
+    '''
+
+    def __init__(self, protocol=None, max_header_size=conf.HTTP_MAX_HEADER_SIZE,
+                 max_body_size=conf.HTTP_MAX_BODY_SIZE):
+        self.protocol = protocol
+        self.max_header_size = max_header_size
+        self.max_body_size = max_body_size
+        self.body = None
+        self._buffer = bytearray()
+        self._scan = 0
+        self._state = 'head'
+        self._request = None
+        self._remaining = 0
+        self._chunks = []
+        # Set when a chunked request is waiting on its body and asked for a
+        # '100 Continue'.
+        self.expect_continue = False
+
+    def feed(self, data):
+        self._buffer += data
+        requests = []
+        while True:
+            request = self._step()
+            if request is None:
+                return requests
+            requests.append(request)
+
+    def _step(self):
+        while True:
+            if 'head' == self._state:
+                if not self._parseHead():
+                    return None
+                if 'chunk_size' != self._state:
+                    # No body or one that streams in after the request.
+                    return self._finish()
+            elif 'body' == self._state:
+                if not self._buffer:
+                    return None
+                data = bytes(self._buffer[:self._remaining])
+                del self._buffer[:len(data)]
+                self._remaining -= len(data)
+                self.body.feed(data)
+                if not self._remaining:
+                    self.body.finish()
+                    self.body = None
+                    self._state = 'head'
+            elif 'chunk_size' == self._state:
+                end = self._buffer.find(b'\r\n')
+                if -1 == end:
+                    if len(self._buffer) > 1024:
+                        raise ParseError(400, 'Bad chunk size')
+                    return None
+                line = bytes(self._buffer[:end]).split(b';', 1)[0].strip()
+                del self._buffer[:end + 2]
+                try:
+                    size = int(line, 16)
+                except ValueError:
+                    raise ParseError(400, 'Bad chunk size')
+                if size:
+                    self._remaining = size
+                    self._state = 'chunk_data'
+                    if sum(len(chunk) for chunk in self._chunks) + size > self.max_body_size:
+                        raise ParseError(413, 'Request body too large')
+                else:
+                    self._state = 'trailer'
+            elif 'chunk_data' == self._state:
+                if len(self._buffer) < self._remaining + 2:
+                    return None
+                if b'\r\n' != self._buffer[self._remaining:self._remaining + 2]:
+                    raise ParseError(400, 'Bad chunk')
+                self._chunks.append(bytes(self._buffer[:self._remaining]))
+                del self._buffer[:self._remaining + 2]
+                self._state = 'chunk_size'
+            elif 'trailer' == self._state:
+                # We don't use trailers, just skip them.
+                end = self._buffer.find(b'\r\n')
+                if -1 == end:
+                    return None
+                del self._buffer[:end + 2]
+                if 0 == end:
+                    body = b''.join(self._chunks)
+                    self._chunks = []
+                    self._request.body = RequestBody(self.protocol, body)
+                    headers = self._request.headers
+                    del headers['Transfer-Encoding']
+                    headers['Content-Length'] = str(len(body))
+                    self._state = 'head'
+                    return self._finish()
+
+    def _parseHead(self):
+        # Clients are allowed to send empty lines between requests.
+        while self._buffer.startswith(b'\r\n'):
+            del self._buffer[:2]
+        end = self._buffer.find(b'\r\n\r\n', max(0, self._scan - 3))
+        if -1 == end:
+            self._scan = len(self._buffer)
+            if len(self._buffer) > self.max_header_size:
+                raise ParseError(431, 'Request header fields too large')
+            return False
+        head = bytes(self._buffer[:end + 4])
+        del self._buffer[:end + 4]
+        self._scan = 0
+
+        line, _, rest = head.partition(b'\r\n')
+        parts = line.decode('iso-8859-1').split()
+        if 3 != len(parts) or not parts[2].startswith('HTTP/1.'):
+            raise ParseError(400, 'Bad request line')
+        try:
+            headers = parse_headers(io.BytesIO(rest))
+        except Exception:
+            raise ParseError(400, 'Bad headers')
+        self._request = Request(parts[0], parts[1], parts[2], headers)
+
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            self._state = 'chunk_size'
+        else:
+            try:
+                self._remaining = int(headers.get('Content-Length', 0))
+            except ValueError:
+                raise ParseError(400, 'Bad Content-Length')
+            if self._remaining < 0:
+                raise ParseError(400, 'Bad Content-Length')
+            self._state = 'body' if self._remaining else 'head'
+        expect_continue = (
+            'head' != self._state and
+            '100-continue' == headers.get('Expect', '').lower() and
+            'HTTP/1.1' == parts[2])
+        if 'body' == self._state:
+            self.body = self._request.body = RequestBody(self.protocol, complete=False)
+            self._request.expect_continue = expect_continue
+        else:
+            self.expect_continue = expect_continue
+        return True
+
+    def _finish(self):
+        request = self._request
+        self._request = None
+        self.expect_continue = False
+        return request
+
+
+class TransportWriter(object):
+
+    ''' File like object the Controller writes its response to. It is used from
+        the executor thread and hands the bytes over to the event loop.
+
+        Writes are buffered and pushed to the transport on flush (or when the
+        buffer fills up). If the client isn't keeping up the transport pauses us
+        and flush blocks the handler thread until it catches up.
+    '''
+
+    buffer_size = 64 * 1024
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self._buffer:
+            return
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        protocol = self.protocol
+        if not protocol.writable.wait(conf.HTTP_KEEPALIVE_TIMEOUT):
+            raise TimeoutError('Client is not reading the response')
+        if protocol.closed:
+            raise ConnectionResetError('Client went away')
+        protocol.loop.call_soon_threadsafe(protocol.write, data)
+
+
+class AsyncController(Controller):
+
+    ''' Runs a parsed request through the Controller routes without a socket. '''
+
+    # No real socket to hand to sendfile.
+    use_sendfile = False
+
+    def __init__(self, protocol, request):
+        # BaseRequestHandler.__init__ wants a socket and handles the request
+        # right away, so we set up what the Controller needs by hand instead.
+        self.server = protocol.app
+        self.client_address = protocol.peername
+        self.connection = None
+        self.request = None
+        self.rfile = request.body
+        self.wfile = protocol.writer
+        self.command = request.method
+        self.path = request.target
+        self.request_version = request.version
+        self.requestline = '{0} {1} {2}'.format(request.method, request.target, request.version)
+        self.headers = request.headers
+        self.requests_handled = protocol.requests_handled
+
+        connection = request.headers.get('Connection', '').lower()
+        if 'close' == connection:
+            self.close_connection = True
+        elif 'keep-alive' == connection:
+            self.close_connection = False
+        else:
+            self.close_connection = 'HTTP/1.0' == request.version
+
+    def run(self):
+        self._headers_buffer = []
+        method = getattr(self, 'do_' + self.command, None)
+        if method is None:
+            self.send_error(501, 'Unsupported method ({0!r})'.format(self.command))
+        else:
+            method()
+        self.wfile.flush()
+
+
+class HTTPProtocol(asyncio.Protocol):
+
+    ''' One of these per connection. Requests on a connection are handled one
+        at a time in the order they came in, which is what makes pipelining safe.
+    '''
+
+    def __init__(self, app):
+        self.app = app
+        self.loop = app.loop
+        self.transport = None
+        self.peername = ('', 0)
+        self.parser = HTTPParser(self)
+        self.queue = []
+        self.busy = False
+        self.closed = False
+        # A bad request is waiting in the queue, don't read past it.
+        self.failed = False
+        self.requests_handled = 0
+        self.writer = TransportWriter(self)
+        # Cleared by the transport when its write buffer is full.
+        self.writable = threading.Event()
+        self.writable.set()
+        self._idle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peername = transport.get_extra_info('peername') or ('', 0)
+        self.app.connections.add(self)
+        prefork.connectionOpened()
+        self._resetIdle()
+
+    def connection_lost(self, exc):
+        self.closed = True
+        # Wake up a handler thread waiting to write or on the body.
+        self.writable.set()
+        if self.parser.body is not None:
+            self.parser.body.finish()
+        self.app.connections.discard(self)
+        prefork.connectionClosed()
+        if self._idle is not None:
+            self._idle.cancel()
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def write(self, data):
+        if not self.closed:
+            self.transport.write(data)
+
+    def updateReading(self):
+        ''' Stops reading from the client while it is ahead of us: there is a
+            bad request to answer, too many pipelined requests are waiting or
+            the body coming in is piling up. Starts again once it isn't.
+        '''
+        if self.closed:
+            return
+        body = self.parser.body
+        if self.failed or len(self.queue) > conf.HTTP_MAX_PIPELINE or (body is not None and body.full):
+            self.transport.pause_reading()
+        else:
+            self.transport.resume_reading()
+
+    def _sendContinue(self):
+        ''' Sends the '100 Continue' a chunked request is waiting on, once
+            everything before it on the connection has been answered.
+        '''
+        if (self.parser.expect_continue and not self.busy and not self.queue and
+                not self.failed and not self.transport.is_closing()):
+            self.parser.expect_continue = False
+            self.write(CONTINUE)
+
+    def _resetIdle(self):
+        if self._idle is not None:
+            self._idle.cancel()
+        self._idle = self.loop.call_later(conf.HTTP_KEEPALIVE_TIMEOUT, self._onIdle)
+
+    def _onIdle(self):
+        if not self.busy:
+            self.transport.close()
+
+    def data_received(self, data):
+        self._resetIdle()
+        try:
+            requests = self.parser.feed(data)
+        except ParseError as e:
+            self.failed = True
+            requests = [e]
+        self.queue.extend(requests)
+        self._sendContinue()
+        # Don't let a client pile up an unbounded number of pipelined requests
+        # (or body).
+        self.updateReading()
+        if self.queue and not self.busy:
+            self.busy = True
+            self.loop.create_task(self._process())
+
+    async def _process(self):
+        try:
+            while self.queue and not self.closed:
+                item = self.queue.pop(0)
+                if isinstance(item, ParseError):
+                    self._sendError(item.status, str(item))
+                    return
+                if item.expect_continue:
+                    # Everything before it has been answered by now, so
+                    # this can't get in the middle of another response.
+                    self.write(CONTINUE)
+                keep_alive = await self.app.handle(self, item)
+                if not keep_alive:
+                    self.transport.close()
+                    return
+                self.updateReading()
+        finally:
+            self.busy = False
+            if not self.closed:
+                self._sendContinue()
+                self._resetIdle()
+
+    def _sendError(self, status, message):
+        body = message.encode('utf-8')
+        self.transport.write(
+            'HTTP/1.1 {0} {1}\r\nContent-Type: text/plain\r\nContent-Length: {2}\r\nConnection: close\r\n\r\n'.format(
+                status, message, len(body)).encode('latin-1') + body)
+        self.transport.close()
+
+
+class AsyncServer(object):
+
+    ''' Holds the shared state: the executor and the open connections. '''
+
+    def __init__(self, loop, workers=conf.ASYNC_EXECUTOR_WORKERS):
+        self.loop = loop
+        self.connections = set()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='request')
+        # Bound the number of requests waiting on the executor so a flood of
+        # requests queues up as unread sockets instead of memory.
+        self.slots = asyncio.Semaphore(workers * 2)
+        self.in_flight = 0
+
+    async def handle(self, protocol, request):
+        async with self.slots:
+            self.in_flight += 1
+            try:
+                return await self.loop.run_in_executor(
+                    self.executor, self._run, protocol, request)
+            finally:
+                self.in_flight -= 1
+
+    def _run(self, protocol, request):
+        ''' Runs in an executor thread. Returns whether to keep the connection. '''
+        prefork.requestStarted()
+        try:
+            return self._respond(protocol, request)
+        finally:
+            request.body.discard()
+            prefork.requestFinished()
+
+    def _respond(self, protocol, request):
+        controller = AsyncController(protocol, request)
+        try:
+            controller.run()
+        except Exception:
+            traceback.print_exc()
+            if protocol.closed:
+                return False
+            if controller.requests_handled == protocol.requests_handled:
+                # Nothing was sent yet so we can still report the error.
+                controller.close_connection = True
+                controller._headers_buffer = []
+                controller.send_error(500)
+                controller.wfile.flush()
+            return False
+        protocol.requests_handled = controller.requests_handled
+        return not controller.close_connection
+
+    async def shutdown(self, grace=conf.ASYNC_SHUTDOWN_GRACE):
+        ''' Closes idle connections right away and gives the busy ones
+            'grace' seconds to finish before closing them too.
+        '''
+        for protocol in list(self.connections):
+            if not protocol.busy:
+                protocol.transport.close()
+        deadline = self.loop.time() + grace
+        while any(p.busy for p in self.connections) and self.loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for protocol in list(self.connections):
+            protocol.transport.close()
+        # Let the handler threads wind down without blocking the loop.
+        await self.loop.run_in_executor(None, self.executor.shutdown, True)
+
+
+async def serve(host='localhost', port=8080, sock=None):
+    loop = asyncio.get_running_loop()
+    app = AsyncServer(loop)
+
+    if sock is not None:
+        server = await loop.create_server(lambda: HTTPProtocol(app), sock=sock)
+    else:
+        server = await loop.create_server(
+            lambda: HTTPProtocol(app), host, port,
+            reuse_address=True, backlog=conf.HTTP_BACKLOG)
+
+    stop = asyncio.Event()
+    for sig in [signal.SIGINT, signal.SIGTERM]:
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows (and non main threads) don't support this. There we
+            # rely on the KeyboardInterrupt instead.
+            pass
+
+    print("Starting server at http://{0}:{1}".format(host, port))
+
+    CHANGE_FEED.start()
+    try:
+        await stop.wait()
+    finally:
+        # Stop accepting new connections first, then drain the existing ones.
+        # The long-polls and event streams would hold up the drain.
+        server.close()
+        CHANGE_FEED.close()
+        await app.shutdown()
+
+
+# Listen and serve on specified host and port
+def start(host='localhost', port=8080, sock=None):
+    try:
+        asyncio.run(serve(host, port, sock))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        database.close()
+    print("Server stopped")
+
+
+if __name__ == '__main__':
+    start(*sys.argv[1:2], *[int(port) for port in sys.argv[2:3]])
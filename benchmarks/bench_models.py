@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+'''
+Microbenchmarks for the model layer: Model.fetch (cold and through the query
+cache), Model.save, Model.exists, loading rows with 'dict_factory' and
+rendering the JSON for a list response (with json.dumps and from the cached
+JSON of each model), at different table sizes.
+
+    $ python3 benchmarks/bench_models.py
+    $ python3 benchmarks/bench_models.py -rows 1000 100000 1000000 -o models.json
+
+Each size gets a scratch database in a temporary directory, so it will not
+touch 'db.sqlite3'. The tables are filled by dataset.generate. The JSON report
+can be compared against another run with compare.py.
+'''
+
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import sqlite3
+import argparse
+import tempfile
+
+# Let the benchmark import the project modules.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import conf
+import report
+from bench_rows import populate
+
+
+def timed(fn, repeat):
+    ''' Runs 'fn' 'repeat' times. Returns the latencies and the total time. '''
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - t)
+    return latencies, time.perf_counter() - start
+
+
+def run(path, rows, args):
+    # Point the project at the scratch database before importing it.
+    conf.DB_FILE = path
+    for module in ['database', 'models']:
+        sys.modules.pop(module, None)
+    import database
+    from models import Model
+    from models import QUERY_CACHE
+
+    populate(path, rows)
+    with database.connect() as conn:
+        ids = [row[0] for row in conn.execute(
+            '''SELECT id FROM models ORDER BY random() LIMIT 1000;''').fetchall()]
+    makes = ['ford', 'subaru', 'honda', 'toyota', 'gm', 'mazda']
+
+    def fetchCold():
+        QUERY_CACHE.clear()
+        Model.fetch()
+
+    def fetchFiltered():
+        QUERY_CACHE.clear()
+        Model.fetch(make='ford', status='fail')
+
+    def fetchCached():
+        Model.fetch(make='ford', status='fail')
+
+    def saveInsert():
+        Model(name=str(uuid.uuid4()), make=random.choice(makes), color='red', status='pass').save()
+
+    def saveUpdate():
+        model = Model.fetch(id=random.choice(ids))[0]
+        model.make = random.choice(makes)
+        model.save()
+
+    def exists():
+        Model.exists(random.choice(ids))
+
+    def dictFactory():
+        conn = sqlite3.connect(path)
+        conn.row_factory = database.dict_factory
+        conn.execute('''SELECT * FROM models;''').fetchall()
+        conn.close()
+
+    models = Model.fetch()
+
+    def renderJSON():
+        json.dumps([model.toDict() for model in models])
+
+    def renderFragments():
+        Model.listJSON(models)
+
+    # (name, fn, repeat) The whole table ones run 'repeat' times, the single
+    # row ones 'ops' times.
+    benchmarks = [
+        ('fetch', fetchCold, args.repeat),
+        ('fetch_filtered', fetchFiltered, args.repeat),
+        ('fetch_cached', fetchCached, args.ops),
+        ('save_insert', saveInsert, args.ops),
+        ('save_update', saveUpdate, args.ops),
+        ('exists', exists, args.ops),
+        ('dict_factory', dictFactory, args.repeat),
+        ('json_render', renderJSON, args.repeat),
+        ('json_fragments', renderFragments, args.repeat),
+    ]
+    results = {}
+    for name, fn, repeat in benchmarks:
+        if args.only and name not in args.only:
+            continue
+        # One warm up round so the first run doesn't pay for opening connections.
+        fn()
+        latencies, seconds = timed(fn, repeat)
+        results['{0}@{1}'.format(name, rows)] = report.summarize(latencies, seconds)
+
+    del models
+    database.close()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Model layer microbenchmarks')
+    parser.add_argument('-rows', type=int, nargs='+', default=[1000, 100000])
+    parser.add_argument('-repeat', type=int, default=5, help='runs of the whole table benchmarks')
+    parser.add_argument('-ops', type=int, default=500, help='runs of the single row benchmarks')
+    parser.add_argument('-only', nargs='+', help='only run these benchmarks')
+    parser.add_argument('-o', dest='output', help="write the JSON report here ('-' for stdout)")
+    args = parser.parse_args()
+
+    result = report.new('bench_models', vars(args))
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            result['results'].update(run(os.path.join(tmpdir, 'bench.sqlite3'), rows, args))
+    report.show(result['results'])
+    report.save(result, args.output)
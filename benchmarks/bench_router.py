@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+
+'''
+Measures the per request overhead of finding the handler and parsing the
+parameters: the old if/elif chains (uncompiled 're.match', 'urlparse' on every
+check and 'params' re-parsed on every access) against the compiled ROUTES and
+the RequestContext.
+
+    $ python3 benchmarks/bench_router.py
+    $ python3 benchmarks/bench_router.py -n 200000
+
+No server or database is involved, the handlers are never called.
+'''
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from urllib.parse import quote
+from urllib.parse import urlparse
+from urllib.parse import parse_qs
+
+# Let the benchmark import the project modules.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import router
+
+
+MODEL_ID = '0a1817dd-93e0-4e34-aa30-92dfcfcc415e'
+
+# (method, path, content type, body)
+REQUESTS = [
+    ('GET', '/', None, b''),
+    ('GET', '/static/js/app.js', None, b''),
+    ('GET', '/ping', None, b''),
+    ('GET', '/api/v1/models?make=ford&status=fail', None, b''),
+    ('GET', '/api/v1/model/' + MODEL_ID, None, b''),
+    ('GET', '/model/' + MODEL_ID, None, b''),
+    ('POST', '/api/v1/model', 'application/json',
+     json.dumps({'method': 'create_model', 'params': {'name': 'bench', 'make': 'ford'}}).encode()),
+    ('PUT', '/api/v1/model/' + MODEL_ID, 'application/json',
+     json.dumps({'method': 'update_model', 'params': {'color': 'blue'}}).encode()),
+    ('POST', '/model/' + MODEL_ID, 'application/x-www-form-urlencoded', b'color=red&status=pass'),
+    ('DELETE', '/api/v1/model/' + MODEL_ID, None, b''),
+]
+
+
+class FakeRequest(object):
+
+    ''' The bits of the Controller the parameter parsing looks at. '''
+
+    def __init__(self, method, path, content_type, body):
+        self.command = method
+        self.path = path
+        self.headers = {'content-type': content_type} if content_type else {}
+        self.body = body
+
+
+class Legacy(FakeRequest):
+
+    ''' The parameter parsing and dispatch as they were before router.py. '''
+
+    def json(self):
+        if 'application/json' == self.headers.get('content-type'):
+            if self.body:
+                try:
+                    return json.loads(self.body)
+                except BaseException:
+                    return {}
+        return {}
+
+    @property
+    def form(self):
+        if 'application/x-www-form-urlencoded' == self.headers.get('content-type'):
+            if self.body:
+                params = parse_qs(self.body)
+                return {k.decode(): v[0].decode() for k, v in params.items() if v is not None}
+        return {}
+
+    @property
+    def args(self):
+        params = parse_qs(urlparse(self.path).query)
+        return {k: v[0] for k, v in params.items() if v is not None}
+
+    @property
+    def params(self):
+        params = {**self.args, **self.form, **self.json().get('params', {})}
+        id = self.getModelIDFromRequestURL()
+        if id:
+            params['id'] = id
+        return params
+
+    def getModelIDFromRequestURL(self):
+        url = urlparse(self.path)
+        if url.path.startswith('/api/v1/model/'):
+            return quote(url.path.replace('/api/v1/model/', '').split('/')[0])
+        elif url.path.startswith('/model/'):
+            return quote(url.path.replace('/model/', '').split('/')[0])
+        return None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if '/' == url.path:
+            return self.params
+        elif url.path.startswith('/static/'):
+            return url.path
+        elif '/ping' == url.path:
+            return None
+        elif re.match(r'^/model/[^/]+$', url.path):
+            return self.params.get('id')
+        elif '/api/v1/models' == url.path:
+            return self.params
+        elif re.match(r'^/api/v1/model/[^/]+$', url.path):
+            return self.params.get('id')
+        elif '/api/v1/models/explain' == url.path:
+            return self.params
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if '/' == url.path:
+            return self.params
+        elif url.path in ['/api/v1/model', '/create']:
+            return self.params
+        elif re.match(r'^/model/[^/]+$', url.path):
+            # getModel() and updateModel() both read the params.
+            return self.params.get('id'), self.params
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        _isApiRequest = re.match(r'^/api/v1/model/[^/]+$', url.path)
+        if '/' == url.path:
+            return self.params
+        elif _isApiRequest or re.match(r'^/model/[^/]+$', url.path):
+            return self.params.get('id'), self.params
+
+    def do_DELETE(self):
+        url = urlparse(self.path)
+        if '/' == url.path:
+            return self.params
+        elif url.path.startswith('/api/v1/model/') or re.match(r'^/model/[^/]+$', url.path):
+            return self.params.get('id')
+
+
+def handler(request):
+    return None
+
+
+ROUTES = router.Router()
+for methods, template in [
+        ('GET', '/'),
+        (['POST', 'PUT', 'DELETE'], '/'),
+        ('GET', '/static/{path:path}'),
+        ('GET', '/ping'),
+        ('POST', '/create'),
+        ('GET', '/model/{id}'),
+        (['POST', 'PUT'], '/model/{id}'),
+        ('DELETE', '/model/{id}'),
+        ('GET', '/api/v1/models'),
+        ('GET', '/api/v1/models/explain'),
+        ('POST', '/api/v1/model'),
+        ('GET', '/api/v1/model/{id}'),
+        ('PUT', '/api/v1/model/{id}'),
+        ('DELETE', '/api/v1/model/{id}')]:
+    ROUTES.add(methods, template, handler)
+
+
+def runLegacy(method, path, content_type, body):
+    request = Legacy(method, path, content_type, body)
+    return getattr(request, 'do_' + method)()
+
+
+def runRouter(method, path, content_type, body):
+    request = FakeRequest(method, path, content_type, body)
+    ctx = router.RequestContext(request)
+    fn, captures, allowed, template = ROUTES.match(method, ctx.path)
+    ctx.captures = captures
+    # Handlers that need the parameters read them (twice for updates).
+    if 'GET' != method or '?' in path:
+        ctx.params
+        ctx.params
+    return fn
+
+
+def measure(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        for request in REQUESTS:
+            fn(*request)
+    elapsed = time.perf_counter() - start
+    return elapsed / (n * len(REQUESTS))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Dispatch overhead benchmark')
+    parser.add_argument('-n', type=int, default=50000, help='rounds over the sample requests')
+    args = parser.parse_args()
+
+    legacy = measure(runLegacy, args.n)
+    current = measure(runRouter, args.n)
+    print('{0:<8} {1:>8.2f} us/request'.format('legacy', legacy * 1e6))
+    print('{0:<8} {1:>8.2f} us/request'.format('router', current * 1e6))
+    print('{0:<8} {1:>8.2f}x'.format('speedup', legacy / current if current else 0))
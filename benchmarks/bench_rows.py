@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+'''
+Compares loading the 'models' table through the old 'dict_factory' + dict backed
+Model against the current tuple backed Model.
+
+    $ python3 benchmarks/bench_rows.py
+    $ python3 benchmarks/bench_rows.py -rows 100000 1000000
+
+Each run builds a scratch database in a temporary directory, so it will not touch
+'db.sqlite3'. Time is measured without tracemalloc (it slows things down a lot) and
+memory is measured in a second pass with it.
+'''
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import tempfile
+import tracemalloc
+
+# Let the benchmark import the project modules.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import conf
+
+
+class LegacyModel(object):
+
+    ''' The dict backed Model as it was before the switch to tuples. '''
+
+    def __init__(self, **kwargs):
+        self._data = kwargs
+
+    def get(self, key):
+        if self._data:
+            return self._data.get(key)
+
+    @property
+    def status(self):
+        return self.get('status')
+
+    def toDict(self):
+        return self._data
+
+
+def populate(path, rows):
+    # After conf.DB_FILE points at the scratch database, dataset imports
+    # the database module.
+    import dataset
+    dataset.generate(rows, path)
+
+
+def loadLegacy(path):
+    conn = sqlite3.connect(path)
+    conn.row_factory = database.dict_factory
+    rows = conn.execute('''SELECT * FROM models;''').fetchall()
+    conn.close()
+    return [LegacyModel(**row) for row in rows]
+
+
+def loadCurrent(path):
+    # Model.fetch without QUERY_CACHE, otherwise every pass after the first
+    # one measures a cache hit instead of the rows.
+    query, params = Model._query()
+    fromRow = Model.fromRow
+    return [fromRow(row) for row in Model._cached(None, query, params)]
+
+
+def measure(fn, path):
+    start = time.perf_counter()
+    result = fn(path)
+    # Touch every model the way a list response would.
+    for model in result:
+        model.status
+    elapsed = time.perf_counter() - start
+    count = len(result)
+    del result
+
+    tracemalloc.start()
+    result = fn(path)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return {
+        'rows': count,
+        'seconds': elapsed,
+        'rows_per_second': count / elapsed if elapsed else 0,
+        'peak_mb': peak / (1024 * 1024)
+    }
+
+
+def report(rows, name, stats):
+    print('{0:>9} {1:<8} {2:>8.3f}s {3:>12,.0f} rows/s {4:>9.1f} MB'.format(
+        rows, name, stats['seconds'], stats['rows_per_second'], stats['peak_mb']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Row representation benchmark')
+    parser.add_argument('-rows', type=int, nargs='+', default=[100000, 1000000])
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'bench.sqlite3')
+
+            # Point the project at the scratch database before importing it.
+            conf.DB_FILE = path
+            # The slow query log would go off on every full table load.
+            conf.DB_SLOW_QUERY_MS = None
+            for module in ['database', 'models']:
+                sys.modules.pop(module, None)
+            import database
+            from models import Model
+
+            populate(path, rows)
+            report(rows, 'dict', measure(loadLegacy, path))
+            report(rows, 'tuple', measure(loadCurrent, path))
+            database.close()
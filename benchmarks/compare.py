@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+
+'''
+Compares two JSON reports from bench_models.py or loadgen.py.
+
+    $ python3 benchmarks/compare.py before.json after.json
+    $ python3 benchmarks/compare.py before.json after.json -threshold 5
+
+Shows the change in throughput and latency for every result the two have in
+common. Exits with 1 if anything regressed by more than '-threshold' percent
+(lower throughput or a higher p50/p99), so it can gate a CI job. Keep in mind
+a run on a busy machine can easily be 10% off.
+'''
+
+import sys
+import json
+import argparse
+
+
+def change(before, after):
+    if not before:
+        return 0.0
+    return (after - before) / before * 100
+
+
+def compare(before, after, threshold):
+    regressions = []
+    print('{0:<24} {1:>12} {2:>12} {3:>9} {4:>9} {5:>9}'.format(
+        'name', 'before/s', 'after/s', 'rate %', 'p50 %', 'p99 %'))
+    for name, old in before['results'].items():
+        new = after['results'].get(name)
+        if new is None:
+            continue
+        rate = change(old['per_second'], new['per_second'])
+        p50 = change(old['p50'], new['p50'])
+        p99 = change(old['p99'], new['p99'])
+        worse = rate < -threshold or p50 > threshold or p99 > threshold
+        if worse:
+            regressions.append(name)
+        print('{0:<24} {1:>12.1f} {2:>12.1f} {3:>+9.1f} {4:>+9.1f} {5:>+9.1f}{6}'.format(
+            name, old['per_second'], new['per_second'], rate, p50, p99, '  <--' if worse else ''))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare benchmark reports')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('-threshold', type=float, default=10, help='percent change that counts as a regression')
+    args = parser.parse_args()
+
+    with open(args.before) as fh:
+        before = json.load(fh)
+    with open(args.after) as fh:
+        after = json.load(fh)
+    for report in [before, after]:
+        environment = report.get('environment', {})
+        print('{0}: {1} (commit {2}, python {3}, sqlite {4})'.format(
+            report.get('name'), report.get('started'), environment.get('commit'),
+            environment.get('python'), environment.get('sqlite')))
+
+    regressions = compare(before, after, args.threshold)
+    if regressions:
+        print('Regressed: {0}'.format(', '.join(regressions)))
+        sys.exit(1)
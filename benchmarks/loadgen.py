@@ -0,0 +1,310 @@
+#!/usr/bin/python3
+
+'''
+HTTP load generator. Starts 'main.py' on a free port with a scratch database
+(or uses the server at '-url'), seeds it with models and then hammers the
+CRUD and static endpoints from a number of threads, each with its own
+keep-alive connection.
+
+    $ python3 benchmarks/loadgen.py
+    $ python3 benchmarks/loadgen.py -concurrency 32 -duration 30 -engine asyncio -workers 4
+    $ python3 benchmarks/loadgen.py -mix get=80,update=20 -o before.json
+    $ python3 benchmarks/loadgen.py -url http://localhost:8080 -seed 0
+
+The mix is a weighted list of operations:
+
+    get      GET /api/v1/model/{id}
+    list     GET /api/v1/models?limit=100
+    filter   GET /api/v1/models?make=...&status=...
+    create   POST /api/v1/model
+    update   PUT /api/v1/model/{id}
+    delete   DELETE /api/v1/model/{id}   (only models this run created)
+    static   GET /static/js/app.js
+    index    GET /
+
+Requests made in the first '-warmup' seconds are not counted. Only the
+standard library is used, so this runs anywhere the server does.
+'''
+
+import os
+import sys
+import gzip
+import json
+import time
+import uuid
+import random
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlsplit
+
+import report
+
+
+DEFAULT_MIX = 'get=40,list=15,filter=10,create=10,update=10,delete=5,static=5,index=5'
+
+MAKES = ['ford', 'subaru', 'honda', 'toyota', 'gm', 'mazda']
+COLORS = ['blue', 'red', 'silver', 'white', 'black']
+STATUSES = ['fail', 'warn', 'pass']
+
+
+def parseMix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in Worker.operations:
+            raise ValueError('Unknown operation {0!r}'.format(name))
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+class Client(object):
+
+    ''' A keep-alive connection that reconnects when the server drops it. '''
+
+    def __init__(self, host, port, timeout=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.conn = None
+
+    def request(self, method, path, payload=None):
+        body = None
+        headers = {'Accept-Encoding': 'gzip'}
+        if payload is not None:
+            body = json.dumps(payload)
+            headers['Content-Type'] = 'application/json'
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body, headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                if 'gzip' == response.getheader('Content-Encoding'):
+                    data = gzip.decompress(data)
+                if response.will_close:
+                    self.close()
+                return response.status, data
+            except (http.client.HTTPException, OSError):
+                self.close()
+                # A kept-alive connection may have been closed under us, try
+                # once more on a fresh one.
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+class Worker(threading.Thread):
+
+    operations = ['get', 'list', 'filter', 'create', 'update', 'delete', 'static', 'index']
+
+    def __init__(self, client, ids, weights, counting, stop):
+        super().__init__(daemon=True)
+        self.client = client
+        self.ids = ids
+        self.names = list(weights)
+        self.weights = [weights[name] for name in self.names]
+        self.counting = counting
+        self.stop = stop
+        self.created = []
+        # {operation: [latencies]}, {operation: errors}
+        self.latencies = {name: [] for name in self.names}
+        self.errors = {name: 0 for name in self.names}
+
+    def run(self):
+        while not self.stop.is_set():
+            name = random.choices(self.names, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                status, _ = getattr(self, name)()
+                ok = status < 400
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - start
+            if self.counting.is_set():
+                if ok:
+                    self.latencies[name].append(elapsed)
+                else:
+                    self.errors[name] += 1
+        self.client.close()
+
+    def get(self):
+        return self.client.request('GET', '/api/v1/model/' + random.choice(self.ids))
+
+    def list(self):
+        return self.client.request('GET', '/api/v1/models?limit=100')
+
+    def filter(self):
+        return self.client.request('GET', '/api/v1/models?make={0}&status={1}'.format(
+            random.choice(MAKES), random.choice(STATUSES)))
+
+    def create(self):
+        status, data = self.client.request('POST', '/api/v1/model', {
+            'method': 'create_model',
+            'params': {
+                'name': 'load_' + str(uuid.uuid4()),
+                'make': random.choice(MAKES),
+                'color': random.choice(COLORS),
+                'status': random.choice(STATUSES)
+            }
+        })
+        if status < 400:
+            self.created.append(json.loads(data)['data']['model']['id'])
+        return status, data
+
+    def update(self):
+        return self.client.request('PUT', '/api/v1/model/' + random.choice(self.ids), {
+            'method': 'update_model',
+            'params': {'color': random.choice(COLORS), 'status': random.choice(STATUSES)}
+        })
+
+    def delete(self):
+        if not self.created:
+            return self.create()
+        return self.client.request('DELETE', '/api/v1/model/' + self.created.pop())
+
+    def static(self):
+        return self.client.request('GET', '/static/js/app.js')
+
+    def index(self):
+        return self.client.request('GET', '/')
+
+
+def spawn(port, path, args):
+    ''' Starts main.py and waits for it to answer. '''
+    command = [
+        sys.executable, 'main.py', '-port', str(port), '-db', path, '-access-log', 'off',
+        '-engine', args.engine, '-workers', str(args.workers)]
+    process = subprocess.Popen(command, cwd=report.ROOT, stdout=subprocess.DEVNULL)
+    client = Client('localhost', port, timeout=1)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            if 200 == client.request('GET', '/ping')[0]:
+                client.close()
+                return process
+        except OSError:
+            pass
+        if process.poll() is not None:
+            break
+        time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('The server did not start')
+
+
+def seed(client, count, chunk=1000):
+    for start in range(0, count, chunk):
+        models = [{
+            'name': 'seed_' + str(uuid.uuid4()),
+            'make': random.choice(MAKES),
+            'color': random.choice(COLORS),
+            'status': random.choice(STATUSES)
+        } for _ in range(min(chunk, count - start))]
+        status, _ = client.request('POST', '/api/v1/models/batch', {
+            'method': 'create_models', 'params': {'models': models}})
+        if status >= 400:
+            raise RuntimeError('Seeding failed with {0}'.format(status))
+
+
+def modelIDs(client, limit=10000):
+    ids = []
+    after = None
+    while len(ids) < limit:
+        path = '/api/v1/models?limit=1000' + ('&after={0}'.format(after) if after else '')
+        data = json.loads(client.request('GET', path)[1])['data']
+        ids += [model['id'] for model in data['models']]
+        after = data['next']
+        if not after:
+            break
+    return ids
+
+
+def main(args):
+    weights = parseMix(args.mix)
+    process = None
+    tmpdir = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        tmpdir = tempfile.TemporaryDirectory()
+        host, port = 'localhost', freePort()
+        process = spawn(port, os.path.join(tmpdir.name, 'load.sqlite3'), args)
+
+    try:
+        client = Client(host, port)
+        seed(client, args.seed)
+        ids = modelIDs(client)
+        client.close()
+        if not ids:
+            raise RuntimeError('There are no models to work with, use -seed')
+
+        stop = threading.Event()
+        counting = threading.Event()
+        workers = [Worker(Client(host, port), ids, weights, counting, stop)
+                   for _ in range(args.concurrency)]
+        for worker in workers:
+            worker.start()
+        time.sleep(args.warmup)
+        counting.set()
+        start = time.perf_counter()
+        time.sleep(args.duration)
+        counting.clear()
+        seconds = time.perf_counter() - start
+        stop.set()
+        for worker in workers:
+            worker.join()
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+    result = report.new('loadgen', vars(args))
+    everything = []
+    errors = 0
+    for name in weights:
+        latencies = sum((worker.latencies[name] for worker in workers), [])
+        failed = sum(worker.errors[name] for worker in workers)
+        result['results'][name] = report.summarize(latencies, seconds, failed)
+        everything += latencies
+        errors += failed
+    result['results']['all'] = report.summarize(everything, seconds, errors)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='HTTP load generator')
+    parser.add_argument('-url', help='use this server instead of starting one')
+    parser.add_argument('-concurrency', type=int, default=8, help='client threads')
+    parser.add_argument('-duration', type=float, default=10, help='seconds to measure')
+    parser.add_argument('-warmup', type=float, default=2, help='seconds before measuring')
+    parser.add_argument('-mix', default=DEFAULT_MIX, help='weighted operations')
+    parser.add_argument('-seed', type=int, default=10000, help='models to create first')
+    parser.add_argument('-engine', default='threading', choices=['threading', 'asyncio'])
+    parser.add_argument('-workers', type=int, default=1)
+    parser.add_argument('-o', dest='output', help="write the JSON report here ('-' for stdout)")
+    args = parser.parse_args()
+
+    result = main(args)
+    report.show(result['results'])
+    report.save(result, args.output)
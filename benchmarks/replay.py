@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+
+'''
+Replays traffic recorded with 'main.py -capture' against a server. By
+default it starts 'main.py' on a copy of '-db' (ideally a copy of the
+database taken when the capture started, so the ids in the paths exist)
+and sends every captured request again.
+
+    $ python3 main.py -capture traffic.jsonl
+    $ python3 benchmarks/replay.py traffic.jsonl -db snapshot.sqlite3
+    $ python3 benchmarks/replay.py traffic.jsonl -db snapshot.sqlite3 -speed 10 -concurrency 32
+    $ python3 benchmarks/replay.py traffic.jsonl -url http://localhost:8080 -speed 0 -o replay.json
+
+'-speed' keeps the original pacing (1, the default), compresses it (10 sends
+the requests ten times faster) or with 0 sends them as fast as
+'-concurrency' connections allow. 'lag' in the report is how far behind
+schedule requests went out, if that gets big the server (or the replay)
+can't keep up.
+
+Every response is checked against the capture: the status and, when the
+capture has one, the hash of the body. Anything that creates models or
+shows the time will differ (new ids, timestamps), so expect some body diffs
+for those routes. The latencies go in the same JSON report format as
+loadgen.py, per route and for 'all'. 'captured' is the time the server spent
+on the same requests during the capture. That leaves out the network and
+the client, so it is always a bit lower than what the replay measures.
+'''
+
+import os
+import gzip
+import json
+import time
+import queue
+import base64
+import signal
+import hashlib
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlsplit
+
+import report
+from loadgen import Client
+from loadgen import spawn
+from loadgen import freePort
+
+
+# Headers that are about the original connection rather than the request.
+SKIP_HEADERS = ['host', 'connection', 'keep-alive', 'content-length', 'transfer-encoding',
+                'accept-encoding', 'expect']
+
+
+def load(path):
+    ''' Reads the capture, oldest request first. '''
+    entries = []
+    with open(path) as fh:
+        for line in fh:
+            if line.strip():
+                entries.append(json.loads(line))
+    # Each process appends its own lines, so they aren't quite in order.
+    entries.sort(key=lambda entry: entry['start'])
+    return entries
+
+
+def requestBody(entry):
+    ''' The captured body, or False when it wasn't kept. '''
+    if 'body' in entry:
+        return entry['body'].encode('utf-8')
+    if 'body_base64' in entry:
+        return base64.b64decode(entry['body_base64'])
+    return False if entry.get('body_length') else None
+
+
+class ReplayClient(Client):
+
+    ''' loadgen's keep-alive client, sending the captured headers and body
+        as is. Only gzip is accepted so the body can be hashed.
+    '''
+
+    def send(self, method, path, headers, body):
+        headers = {key: value for key, value in headers if key.lower() not in SKIP_HEADERS}
+        headers['Accept-Encoding'] = 'gzip'
+        for attempt in range(2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self.conn.request(method, path, body, headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                if 'gzip' == response.getheader('Content-Encoding'):
+                    data = gzip.decompress(data)
+                if response.will_close:
+                    self.close()
+                return response.status, data
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if attempt:
+                    raise
+
+
+class Worker(threading.Thread):
+
+    def __init__(self, client, jobs, results):
+        super().__init__(daemon=True)
+        self.client = client
+        self.jobs = jobs
+        self.results = results
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            entry, scheduled = job
+            sent = time.perf_counter()
+            try:
+                status, data = self.client.send(
+                    entry['method'], entry['path'], entry['headers'], requestBody(entry) or None)
+                error = None
+            except Exception as e:
+                status, data, error = None, b'', str(e)
+            elapsed = time.perf_counter() - sent
+            # Static files and HEAD requests weren't hashed.
+            digest = hashlib.sha1(data).hexdigest() if entry.get('sha1') and 'HEAD' != entry['method'] else None
+            lag = max(0.0, sent - scheduled) if scheduled is not None else 0.0
+            self.results.append((entry, elapsed, lag, status, digest, error))
+        self.client.close()
+
+
+def snapshot(source, path):
+    ''' Copies the database at 'source' to 'path' with the backup API. A
+        plain file copy would miss whatever is still in the '-wal' file.
+    '''
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(path)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def replay(entries, host, port, speed, concurrency):
+    ''' Sends the entries, paced by their captured start times divided by
+        'speed' (0 for no pacing). Returns the results and the seconds it took.
+    '''
+    jobs = queue.Queue(maxsize=concurrency * 4)
+    results = []
+    workers = [Worker(ReplayClient(host, port), jobs, results) for _ in range(concurrency)]
+    for worker in workers:
+        worker.start()
+
+    first = entries[0]['start'] if entries else 0
+    started = time.perf_counter()
+    for entry in entries:
+        if speed:
+            scheduled = started + (entry['start'] - first) / speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            scheduled = None
+        jobs.put((entry, scheduled))
+    for _ in workers:
+        jobs.put(None)
+    for worker in workers:
+        worker.join()
+    return results, time.perf_counter() - started
+
+
+def compare(results, limit):
+    ''' Counts the responses that differ from the capture. '''
+    diffs = {'status': 0, 'body': 0, 'errors': 0, 'skipped': 0, 'examples': []}
+    for entry, elapsed, lag, status, digest, error in results:
+        kind = None
+        if error is not None:
+            kind = 'errors'
+        elif requestBody(entry) is False:
+            # The body wasn't captured, so this was never going to match.
+            kind = 'skipped'
+        elif status != entry['status']:
+            kind = 'status'
+        elif digest is not None and digest != entry['sha1']:
+            kind = 'body'
+        if kind is None:
+            continue
+        diffs[kind] += 1
+        if len(diffs['examples']) < limit:
+            diffs['examples'].append({
+                'kind': kind,
+                'method': entry['method'],
+                'path': entry['path'],
+                'expected': entry['status'],
+                'actual': status,
+                'error': error
+            })
+    return diffs
+
+
+def main(args):
+    entries = load(args.capture)
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        raise RuntimeError('There is nothing to replay in {0}'.format(args.capture))
+
+    process = None
+    tmpdir = None
+    if args.url:
+        url = urlsplit(args.url)
+        host, port = url.hostname, url.port or 80
+    else:
+        tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmpdir.name, 'replay.sqlite3')
+        # Work on a copy, the replay writes to it.
+        if args.db:
+            snapshot(args.db, path)
+        host, port = 'localhost', freePort()
+        process = spawn(port, path, args)
+
+    try:
+        results, seconds = replay(entries, host, port, args.speed, args.concurrency)
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(15)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if tmpdir is not None:
+            tmpdir.cleanup()
+
+    result = report.new('replay', vars(args))
+    routes = {}
+    for entry, elapsed, lag, status, digest, error in results:
+        routes.setdefault(entry.get('route', 'unmatched'), []).append((entry, elapsed, error))
+    for route, items in sorted(routes.items()):
+        result['results'][route] = report.summarize(
+            [elapsed for _, elapsed, error in items if error is None], seconds,
+            sum(1 for _, _, error in items if error is not None))
+    result['results']['all'] = report.summarize(
+        [r[1] for r in results if r[5] is None], seconds, sum(1 for r in results if r[5] is not None))
+    # What the same requests took when they were captured, for comparison.
+    captured = [entry['ms'] / 1000 for entry in entries]
+    span = entries[-1]['start'] - entries[0]['start'] + captured[-1]
+    result['captured'] = report.summarize(captured, span)
+    result['lag'] = report.summarize([r[2] for r in results], seconds)
+    result['diffs'] = compare(results, args.examples)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay captured traffic')
+    parser.add_argument('capture', help="file written by 'main.py -capture'")
+    parser.add_argument('-url', help='use this server instead of starting one')
+    parser.add_argument('-db', help='database to start the server on a copy of (default empty)')
+    parser.add_argument('-speed', type=float, default=1, help='time compression factor, 0 for no pacing')
+    parser.add_argument('-concurrency', type=int, default=8, help='connections sending requests')
+    parser.add_argument('-limit', type=int, help='only replay the first N requests')
+    parser.add_argument('-examples', type=int, default=20, help='differences to list')
+    parser.add_argument('-engine', default='threading', choices=['threading', 'asyncio'])
+    parser.add_argument('-workers', type=int, default=1)
+    parser.add_argument('-o', dest='output', help="write the JSON report here ('-' for stdout)")
+    args = parser.parse_args()
+
+    result = main(args)
+    report.show(result['results'])
+    print()
+    report.show({'captured (server)': result['captured'], 'lag': result['lag']})
+    diffs = result['diffs']
+    print()
+    print('Differences: {status} status, {body} body, {errors} errors, {skipped} skipped (body not captured)'.format(**diffs))
+    for example in diffs['examples']:
+        print('  {kind:<7} {method} {path} expected {expected} got {actual}{0}'.format(
+            ' ({0})'.format(example['error']) if example['error'] else '', **example))
+    report.save(result, args.output)
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+'''
+Shared bits for the benchmarks that write JSON reports (bench_models.py and
+loadgen.py). A report looks like:
+
+    {
+        "name": "loadgen",
+        "started": "2021-09-08T12:00:00",
+        "environment": {"python": "3.9.7", "sqlite": "3.36.0", "commit": "abc123", ...},
+        "config": {...the command line options...},
+        "results": {
+            "read": {"count": 1200, "errors": 0, "seconds": 10.0, "per_second": 120.0,
+                     "mean": 0.0021, "p50": 0.0018, "p95": 0.0041, "p99": 0.0078, "max": 0.012},
+            ...
+        }
+    }
+
+Latencies are in seconds. compare.py diffs two of these.
+'''
+
+import os
+import sys
+import json
+import math
+import time
+import sqlite3
+import platform
+import subprocess
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def percentile(ordered, p):
+    ''' Nearest rank percentile of an already sorted list. '''
+    if not ordered:
+        return 0.0
+    rank = math.ceil(p / 100.0 * len(ordered))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+def summarize(latencies, seconds, errors=0):
+    ''' Throughput and latency percentiles for a list of latencies collected
+        over 'seconds' of wall clock time.
+    '''
+    ordered = sorted(latencies)
+    count = len(ordered)
+    return {
+        'count': count,
+        'errors': errors,
+        'seconds': seconds,
+        'per_second': count / seconds if seconds else 0.0,
+        'mean': sum(ordered) / count if count else 0.0,
+        'p50': percentile(ordered, 50),
+        'p95': percentile(ordered, 95),
+        'p99': percentile(ordered, 99),
+        'max': ordered[-1] if ordered else 0.0
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            capture_output=True, text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'commit': commit or None
+    }
+
+
+def new(name, config):
+    return {
+        'name': name,
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'config': config,
+        'results': {}
+    }
+
+
+def show(results):
+    print('{0:<24} {1:>9} {2:>7} {3:>11} {4:>9} {5:>9} {6:>9}'.format(
+        'name', 'count', 'errors', 'per second', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for name, r in results.items():
+        print('{0:<24} {1:>9} {2:>7} {3:>11.1f} {4:>9.3f} {5:>9.3f} {6:>9.3f}'.format(
+            name, r['count'], r['errors'], r['per_second'],
+            r['p50'] * 1000, r['p95'] * 1000, r['p99'] * 1000))
+
+
+def save(report, path):
+    ''' Writes the report to 'path' ('-' for stdout). '''
+    if not path:
+        return
+    if '-' == path:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+    with open(path, 'w') as fh:
+        json.dump(report, fh, indent=2)
+    print('Report written to {0}'.format(path))
@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+'''
+Response compression for the dynamic (JSON and HTML) responses.
+
+gzip comes from the standard library. brotli is used if the 'brotli'
+module happens to be installed, otherwise we just don't offer it.
+'''
+
+import time
+import zlib
+
+import conf
+import metrics
+from utils import acceptsEncoding
+from utils import parseAcceptEncoding
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Content types worth compressing. Images and such are already compressed.
+COMPRESSIBLE = [
+    'text/html',
+    'text/plain',
+    'text/css',
+    'application/json',
+    'application/javascript',
+    'application/x-ndjson',
+    'text/csv',
+]
+
+# Preferred encodings, best first.
+ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+
+
+bytes_in = metrics.counter(
+    'compression_bytes_in_total', 'Bytes handed to the compressor', ['encoding'])
+bytes_out = metrics.counter(
+    'compression_bytes_out_total', 'Bytes produced by the compressor', ['encoding'])
+cpu_seconds = metrics.counter(
+    'compression_cpu_seconds_total', 'CPU time spent compressing', ['encoding'])
+responses = metrics.counter(
+    'compression_responses_total', 'Responses sent compressed', ['encoding'])
+
+
+def compressible(content_type):
+    return conf.COMPRESSION and content_type.split(';')[0].strip() in COMPRESSIBLE
+
+
+def negotiate(accept_encoding):
+    ''' Picks the encoding to use for the given 'Accept-Encoding' header.
+        Returns None if the client doesn't accept any we support.
+    '''
+    if not accept_encoding:
+        return None
+    accepted = parseAcceptEncoding(accept_encoding)
+    for encoding in ENCODINGS:
+        if acceptsEncoding(accepted, encoding):
+            return encoding
+    return None
+
+
+def _record(encoding, size_in, size_out, cpu):
+    bytes_in.inc(size_in, encoding=encoding)
+    bytes_out.inc(size_out, encoding=encoding)
+    cpu_seconds.inc(cpu, encoding=encoding)
+
+
+class StreamCompressor(object):
+
+    ''' Compresses a response a piece at a time (for chunked responses). '''
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if 'br' == encoding:
+            self._compressor = brotli.Compressor(quality=conf.COMPRESSION_BROTLI_QUALITY)
+        else:
+            # wbits=31 gives us the gzip header and trailer
+            self._compressor = zlib.compressobj(conf.COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+        self._in = 0
+        self._out = 0
+        self._cpu = 0.0
+        responses.inc(encoding=encoding)
+
+    def compress(self, data, flush=False):
+        start = time.thread_time()
+        if 'br' == self.encoding:
+            out = self._compressor.process(data)
+            if flush:
+                out += self._compressor.flush()
+        else:
+            out = self._compressor.compress(data)
+            if flush:
+                out += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self._cpu += time.thread_time() - start
+        self._in += len(data)
+        self._out += len(out)
+        return out
+
+    def finish(self):
+        start = time.thread_time()
+        if 'br' == self.encoding:
+            out = self._compressor.finish()
+        else:
+            out = self._compressor.flush()
+        self._cpu += time.thread_time() - start
+        self._out += len(out)
+        _record(self.encoding, self._in, self._out, self._cpu)
+        return out
+
+
+def compress(content, encoding):
+    ''' Compresses a complete response body. '''
+    compressor = StreamCompressor(encoding)
+    return compressor.compress(content) + compressor.finish()
+
+
+def stats():
+    ''' Summarizes the compression metrics per encoding. '''
+    summary = {}
+    sizes_in = bytes_in.snapshot()
+    sizes_out = bytes_out.snapshot()
+    cpu = cpu_seconds.snapshot()
+    counts = responses.snapshot()
+    for key, size_in in sizes_in.items():
+        size_out = sizes_out.get(key, 0)
+        summary[key.split('=', 1)[1]] = {
+            'responses': counts.get(key, 0),
+            'bytes_in': size_in,
+            'bytes_out': size_out,
+            'ratio': size_in / size_out if size_out else 0,
+            'cpu_seconds': cpu.get(key, 0)
+        }
+    return summary
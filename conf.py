@@ -5,3 +5,149 @@
 # DB_FILE = ':memory:'
 
 DB_FILE = 'db.sqlite3'
+
+# Brand new databases get a few example models (see database.seed).
+# 'main.py generate' turns this off so the table only has what it made.
+DB_SEED = True
+
+# Turns on developer only features such as the query plan endpoint.
+# This gets set from the '-debug' command line flag in main.py.
+DEBUG = False
+
+# Connection pool settings (see database.ConnectionPool).
+# DB_POOL_SIZE is the maximum number of open connections, DB_POOL_TIMEOUT
+# is how long (seconds) a request will wait for a free connection and
+# DB_POOL_IDLE_TIMEOUT is how long (seconds) an unused connection is kept
+# around before it gets closed.
+DB_POOL_SIZE = 8
+DB_POOL_TIMEOUT = 10
+DB_POOL_IDLE_TIMEOUT = 300
+
+# How long (milliseconds) SQLite will wait on a locked database before
+# giving up with 'database is locked'.
+DB_BUSY_TIMEOUT = 5000
+
+# Writer thread settings (see database.Writer).
+# All writes go through a single thread which commits them in groups.
+# DB_WRITER_BATCH_SIZE caps how many writes go into one transaction and
+# DB_WRITER_MAX_WAIT is how long (seconds) the writer will hold a
+# transaction open waiting for more writes to show up. With 0 it will only
+# group the writes that piled up while the previous commit was running.
+DB_WRITER_BATCH_SIZE = 256
+DB_WRITER_MAX_WAIT = 0
+
+# Statement tracing (see database.StatementStats). Every statement is timed
+# and counted under its normalized text (literals replaced with '?').
+# Statements taking DB_SLOW_QUERY_MS milliseconds or more are written to the
+# access log with their parameters and query plan (None turns that off).
+# Only DB_TRACE_MAX_STATEMENTS distinct statements are tracked and
+# '/api/v1/admin/queries' shows the top DB_TRACE_TOP_N of them by default.
+DB_TRACE = True
+DB_SLOW_QUERY_MS = 100
+DB_TRACE_MAX_STATEMENTS = 500
+DB_TRACE_TOP_N = 20
+
+# Static file settings (see static.py).
+# STATIC_MAX_AGE is the 'Cache-Control' max-age (seconds) for files that don't
+# have a version number in their path. Files at least STATIC_SENDFILE_MIN bytes
+# are sent with sendfile instead of being read into memory.
+STATIC_MAX_AGE = 3600
+STATIC_SENDFILE_MIN = 64 * 1024
+
+# Response compression for JSON and HTML (see compression.py).
+# Responses smaller than COMPRESSION_MIN_SIZE bytes are sent as is.
+# COMPRESSION_LEVEL is the gzip level (1-9) and COMPRESSION_BROTLI_QUALITY
+# the brotli quality (0-11), brotli is only used if the module is installed.
+COMPRESSION = True
+COMPRESSION_MIN_SIZE = 1024
+COMPRESSION_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5
+
+# HTTP keep-alive settings. Idle connections are closed after
+# HTTP_KEEPALIVE_TIMEOUT seconds and after HTTP_MAX_KEEPALIVE_REQUESTS
+# requests on the same connection.
+HTTP_KEEPALIVE_TIMEOUT = 15
+HTTP_MAX_KEEPALIVE_REQUESTS = 1000
+
+# Limits for the asyncio engine's request parser (see async_server.py).
+# HTTP_MAX_BODY_SIZE only applies to chunked bodies, those are put together
+# in memory first. Bodies with a Content-Length stream through to the
+# handler. HTTP_MAX_PIPELINE is how many pipelined requests we buffer per
+# connection before we stop reading from it.
+HTTP_MAX_HEADER_SIZE = 64 * 1024
+HTTP_MAX_BODY_SIZE = 64 * 1024 * 1024
+HTTP_MAX_PIPELINE = 32
+HTTP_BACKLOG = 1024
+
+# Number of threads the asyncio engine uses to run requests (these do the
+# blocking SQLite work) and how long (seconds) in flight requests get to
+# finish when shutting down.
+ASYNC_EXECUTOR_WORKERS = 16
+ASYNC_SHUTDOWN_GRACE = 10
+
+# Pre-fork workers (main.py -workers N). How long (seconds) a new worker gets
+# to start listening during a rolling reload, how long a stopping worker gets
+# to finish its in flight requests, and the longest we wait before restarting
+# a worker that keeps crashing.
+WORKER_READY_TIMEOUT = 30
+WORKER_SHUTDOWN_GRACE = 10
+WORKER_RESTART_BACKOFF_MAX = 30
+
+# Read-through cache for Model.fetch (see models.QueryCache). Results are
+# kept for MODEL_CACHE_TTL seconds, the cache holds at most MODEL_CACHE_SIZE
+# queries and MODEL_CACHE_MAX_ROWS rows in total. A size of 0 turns it off.
+MODEL_CACHE_SIZE = 256
+MODEL_CACHE_MAX_ROWS = 100000
+MODEL_CACHE_TTL = 60
+
+# Pre-encoded JSON for single models (see models.FragmentCache). List
+# responses are put together from it instead of encoding every row again.
+# It holds about FRAGMENT_CACHE_MB megabytes, 0 turns it off.
+FRAGMENT_CACHE_MB = 64
+
+# Change feed (see models.ChangeFeed and '/api/v1/changes'). Entries are kept
+# for CHANGES_RETENTION seconds and at most CHANGES_MAX_ROWS of them, pruned
+# every CHANGES_PRUNE_INTERVAL seconds. Waiting requests check for changes
+# made by other processes every CHANGES_POLL_INTERVAL seconds. Long-polls wait
+# at most CHANGES_LONGPOLL_MAX seconds, event streams are ended after
+# CHANGES_STREAM_TIMEOUT seconds (browsers reconnect on their own) and send a
+# heartbeat every CHANGES_HEARTBEAT seconds. Each waiting request holds a
+# thread, so only CHANGES_MAX_STREAMS of them are allowed per process.
+CHANGES_RETENTION = 3600
+CHANGES_MAX_ROWS = 100000
+CHANGES_PRUNE_INTERVAL = 60
+CHANGES_POLL_INTERVAL = 0.5
+CHANGES_LONGPOLL_MAX = 30
+CHANGES_STREAM_TIMEOUT = 300
+CHANGES_HEARTBEAT = 15
+CHANGES_MAX_STREAMS = 8
+
+# Bulk import and export (see transfer.py). Imports are committed
+# IMPORT_CHUNK_SIZE rows at a time and report their progress every
+# IMPORT_PROGRESS_INTERVAL seconds. Every bad row is counted but only the
+# first IMPORT_MAX_ERRORS are listed. Exports are written EXPORT_BATCH_SIZE
+# rows at a time.
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_PROGRESS_INTERVAL = 5
+IMPORT_MAX_ERRORS = 100
+EXPORT_BATCH_SIZE = 1000
+
+# Synthetic datasets (see dataset.py). Generated models are committed
+# GENERATE_CHUNK_SIZE at a time, every INSERT makes GENERATE_BATCH_SIZE of
+# them and the loading connection gets a GENERATE_CACHE_MB page cache.
+GENERATE_CHUNK_SIZE = 100000
+GENERATE_BATCH_SIZE = 10000
+GENERATE_CACHE_MB = 256
+
+# Access log (see accesslog.py), one JSON line per request. '-' is stderr,
+# a path appends to that file and None turns it off. Lines are written out
+# in batches every ACCESS_LOG_FLUSH seconds.
+ACCESS_LOG = '-'
+ACCESS_LOG_FLUSH = 1
+
+# Traffic capture for benchmarks/replay.py ('-capture' in main.py). Every
+# request is appended to CAPTURE_FILE as a JSON line (method, path, headers,
+# body and timing) by a background thread. None turns it off. Request bodies
+# bigger than CAPTURE_MAX_BODY bytes are left out.
+CAPTURE_FILE = None
+CAPTURE_MAX_BODY = 1024 * 1024
@@ -20,11 +20,31 @@ Here are some other SQL examples on my github:
 '''
 
 # import uuid
+import os
+import re
+import time
+import queue
 import random
 import os.path
 import sqlite3
+import functools
+import threading
+import contextlib
+from concurrent.futures import Future
 
 from conf import DB_FILE
+from conf import DB_SEED
+from conf import DB_POOL_SIZE
+from conf import DB_POOL_TIMEOUT
+from conf import DB_POOL_IDLE_TIMEOUT
+from conf import DB_BUSY_TIMEOUT
+from conf import DB_WRITER_BATCH_SIZE
+from conf import DB_WRITER_MAX_WAIT
+from conf import DB_TRACE
+from conf import DB_SLOW_QUERY_MS
+from conf import DB_TRACE_MAX_STATEMENTS
+from conf import DB_TRACE_TOP_N
+from accesslog import ACCESS_LOG
 
 
 # Check for database file
@@ -33,83 +53,941 @@ from conf import DB_FILE
 _dbExists = os.path.exists(DB_FILE)
 
 
-# Open new database connection
+# Dict factory for sqlite3.
+# I would typically use the PostGreSQL JSON functionality.
+# The pool now uses sqlite3.Row instead. This is kept around for
+# comparison (see benchmarks/bench_rows.py).
+def dict_factory(cursor, row):
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+
+# Time spent in SQLite by the current thread, see 'resetQueryTime'.
+_timing = threading.local()
+
+
+def _addQueryTime(seconds):
+    _timing.seconds = getattr(_timing, 'seconds', 0.0) + seconds
+
+
+def resetQueryTime():
+    ''' Starts counting the time this thread spends in the database from
+        zero. The server does this at the start of every request.
+    '''
+    _timing.seconds = 0.0
+
+
+def queryTime():
+    ''' Seconds this thread spent in the database since 'resetQueryTime'.
+        That is running statements and fetching rows, plus waiting on the
+        writer for writes.
+    '''
+    return getattr(_timing, 'seconds', 0.0)
+
+
+# Statement text is normalized so the same query with different values gets
+# counted as one statement, see 'normalize'.
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACES = re.compile(r'\s+')
+
+# Statements that wait for the write lock before doing anything else.
+_LOCKING = ('BEGIN IMMEDIATE', 'BEGIN EXCLUSIVE')
+
+# Statements we can ask SQLite for a query plan of.
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+
+@functools.lru_cache(maxsize=1024)
+def normalize(sql):
+    ''' Collapses the whitespace and replaces string and number literals with
+        '?', so "SELECT * FROM models WHERE id = 'abc' LIMIT 10" becomes
+        "SELECT * FROM models WHERE id = ? LIMIT ?". 'IN (?, ?, ...)' lists
+        of any length become 'IN (...)'.
+    '''
+    sql = _SPACES.sub(' ', _LITERALS.sub('?', sql)).strip()
+    return _LISTS.sub('(...)', sql)
+
+
+def _jsonable(value):
+    ''' Query parameters as something json.dumps can handle. '''
+    if isinstance(value, dict):
+        return {key: _jsonable(v) for key, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return repr(value)
+
+
+class StatementStats(object):
+
+    ''' Running totals for every statement this process runs, grouped by the
+        normalized statement text: how many times it ran, the time spent
+        running it and fetching its rows, the slowest run, rows returned (or
+        changed), time spent waiting on the write lock and errors.
+
+        Only the first 'max_statements' distinct statements get an entry of
+        their own, anything after that is lumped together under OTHER so a
+        query built with inline values can't eat all the memory.
+
+        The sqlite3 module doesn't give us the busy handler, so 'lock_wait' is
+        the time spent in statements that grab the write lock up front
+        ('BEGIN IMMEDIATE', which is how the writer starts a transaction) plus
+        statements that gave up with 'database is locked'.
+    '''
+
+    OTHER = '(other)'
+    SORTS = ['seconds', 'calls', 'mean', 'max', 'rows', 'lock_wait', 'errors']
+
+    def __init__(self, max_statements=DB_TRACE_MAX_STATEMENTS, slow_ms=DB_SLOW_QUERY_MS):
+        self.max_statements = max_statements
+        self.slow_ms = slow_ms
+        # A cursor can get garbage collected (and record itself) while this
+        # thread is in the middle of 'record'.
+        self._lock = threading.RLock()
+        self._statements = {}
+        self._slow = 0
+        self._since = time.time()
+
+    def record(self, statement, seconds, rows=0, lock_wait=0.0, failed=False, slow=False):
+        with self._lock:
+            entry = self._statements.get(statement)
+            if entry is None:
+                if len(self._statements) >= self.max_statements:
+                    statement = self.OTHER
+                entry = self._statements.setdefault(statement, {
+                    'calls': 0, 'seconds': 0.0, 'max': 0.0, 'rows': 0, 'lock_wait': 0.0, 'errors': 0})
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['max'] = max(entry['max'], seconds)
+            entry['rows'] += rows
+            entry['lock_wait'] += lock_wait
+            entry['errors'] += failed
+            self._slow += slow
+
+    def top(self, limit=DB_TRACE_TOP_N, sort='seconds'):
+        ''' The 'limit' statements with the most 'sort' (see SORTS). '''
+        if sort not in self.SORTS:
+            raise ValueError('sort must be one of {0}'.format(', '.join(self.SORTS)))
+        with self._lock:
+            statements = [
+                {'statement': statement, **entry, 'mean': entry['seconds'] / entry['calls']}
+                for statement, entry in self._statements.items()]
+        statements.sort(key=lambda entry: entry[sort], reverse=True)
+        return statements[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._statements = {}
+            self._slow = 0
+            self._since = time.time()
+
+    def stats(self):
+        with self._lock:
+            entries = list(self._statements.values())
+            return {
+                'since': self._since,
+                'tracked': len(entries),
+                'calls': sum(entry['calls'] for entry in entries),
+                'seconds': sum(entry['seconds'] for entry in entries),
+                'lock_wait': sum(entry['lock_wait'] for entry in entries),
+                'errors': sum(entry['errors'] for entry in entries),
+                'slow': self._slow,
+                'slow_ms': self.slow_ms
+            }
+
+
+STATEMENTS = StatementStats() if DB_TRACE else None
+
+
+class TimedCursor(sqlite3.Cursor):
+
+    ''' Cursor that adds the time spent in SQLite to 'queryTime'. The
+        sqlite3 module does the actual work when stepping through the rows,
+        so the fetches are timed as well as the execute.
+
+        Each statement is also traced. The time and rows add up until the
+        statement is done (all the rows have been read, the cursor runs
+        something else, or it is closed or thrown away) and then get recorded
+        in STATEMENTS. A statement that goes over the slow query threshold
+        gets its query plan looked up right away, while this thread still has
+        the connection, and is logged once it is done.
+    '''
+
+    # [statement, sql, params, seconds, rows, lock_wait, failed, plan]
+    _trace = None
+
+    def _begin(self, sql, params):
+        if self._trace is not None:
+            self._end()
+        if STATEMENTS is not None:
+            self._trace = [normalize(sql), sql, params, 0.0, 0, 0.0, False, None]
+
+    def _record(self, seconds, rows=0):
+        _addQueryTime(seconds)
+        trace = self._trace
+        if trace is None:
+            return
+        trace[3] += seconds
+        trace[4] += rows
+        if (trace[7] is None and STATEMENTS.slow_ms is not None
+                and trace[3] * 1000 >= STATEMENTS.slow_ms):
+            trace[7] = self._plan(trace[1], trace[2])
+
+    def _plan(self, sql, params):
+        if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+            return []
+        try:
+            # A plain cursor, so this doesn't get traced itself.
+            cursor = sqlite3.Cursor(self.connection)
+            rows = cursor.execute('EXPLAIN QUERY PLAN ' + sql, params or ()).fetchall()
+            cursor.close()
+        except sqlite3.Error as e:
+            return ['({0})'.format(e)]
+        # (id, parent, notused, detail)
+        return [row[3] for row in rows]
+
+    def _end(self):
+        trace, self._trace = self._trace, None
+        # STATEMENTS can already be gone when cursors get cleaned up at exit.
+        if trace is None or STATEMENTS is None:
+            return
+        statement, sql, params, seconds, rows, lock_wait, failed, plan = trace
+        slow = plan is not None
+        STATEMENTS.record(statement, seconds, rows, lock_wait, failed, slow)
+        if slow:
+            ACCESS_LOG.write(
+                level='warning',
+                message='slow query',
+                statement=statement,
+                params=_jsonable(params),
+                ms=round(seconds * 1000, 3),
+                rows=rows,
+                lock_wait_ms=round(lock_wait * 1000, 3),
+                plan=plan)
+
+    def _executed(self, seconds, error):
+        ''' Bookkeeping after 'execute' or 'executemany'. '''
+        trace = self._trace
+        if trace is not None:
+            if error is not None:
+                trace[6] = True
+            if trace[0].upper().startswith(_LOCKING) or (
+                    error is not None and 'locked' in str(error)):
+                trace[5] += seconds
+        # Statements that don't return rows are done right away.
+        rows = self.rowcount if error is None and self.description is None else 0
+        self._record(seconds, max(rows, 0))
+        if error is not None or self.description is None:
+            self._end()
+
+    def execute(self, sql, parameters=()):
+        self._begin(sql, parameters)
+        start = time.perf_counter()
+        error = None
+        try:
+            return super().execute(sql, parameters)
+        except sqlite3.Error as e:
+            error = e
+            raise
+        finally:
+            self._executed(time.perf_counter() - start, error)
+
+    def executemany(self, sql, parameters):
+        # Only the first set of parameters is kept for the slow query log
+        # (and only if we can look at it without using up an iterator).
+        first = parameters[0] if isinstance(parameters, (list, tuple)) and parameters else None
+        self._begin(sql, first)
+        start = time.perf_counter()
+        error = None
+        try:
+            return super().executemany(sql, parameters)
+        except sqlite3.Error as e:
+            error = e
+            raise
+        finally:
+            self._executed(time.perf_counter() - start, error)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._record(time.perf_counter() - start, row is not None)
+        if row is None:
+            self._end()
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        start = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._record(time.perf_counter() - start, len(rows))
+        if len(rows) < size:
+            self._end()
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._record(time.perf_counter() - start, len(rows))
+        self._end()
+        return rows
+
+    def __next__(self):
+        # 'for row in cursor' steps through the rows here.
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._record(time.perf_counter() - start)
+            self._end()
+            raise
+        self._record(time.perf_counter() - start, 1)
+        return row
+
+    def close(self):
+        self._end()
+        super().close()
+
+    def __del__(self):
+        self._end()
+
+
+class TimedConnection(sqlite3.Connection):
+
+    ''' Hands out TimedCursors. The C version of 'execute' makes a plain
+        cursor, so the shortcuts go through 'cursor' here.
+    '''
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+
+class PoolTimeoutError(Exception):
+    ''' Raised when no database connection becomes available in time. '''
+    pass
+
+
+class ConnectionPool(object):
+
+    ''' Keeps a small stack of open SQLite connections around so we are not
+        paying for sqlite3.connect, the row factory and the pragmas on every
+        single query.
+
+        Connections are checked out and returned (LIFO), so a busy thread will
+        usually get the same 'warm' connection back. The pragmas are applied
+        once when a connection is opened. Connections that sit idle for longer
+        than 'idle_timeout' seconds get closed.
+    '''
+
+    def __init__(self, database, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT,
+                 idle_timeout=DB_POOL_IDLE_TIMEOUT):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._idle = []
+        self._open = 0
+        self._dedicated = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            'opened': 0,
+            'closed': 0,
+            'evicted': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0
+        }
+
+    def _connect(self):
+        # The connections get handed between request threads so we have
+        # to turn off the sqlite3 same thread check. The pool makes sure
+        # only one thread is using a connection at a time.
+        conn = sqlite3.connect(self.database, check_same_thread=False, factory=TimedConnection)
+        # sqlite3.Row is implemented in C and still lets us look up columns
+        # by name. It is a lot cheaper than building a dict for every row
+        # with 'dict_factory'. Hot paths in models.py go even further and
+        # use plain tuples.
+        conn.row_factory = sqlite3.Row
+
+        # Set journal mode to WAL.
+        # source: https://charlesleifer.com/blog/going-fast-with-sqlite-and-python/
+        # https://sqlite.org/wal.html
+        # This isn't really needed for this project, but it is
+        # helpful for high concurrency applications.
+        conn.execute('pragma journal_mode=wal')
+        # In WAL mode 'normal' is still safe from corruption and saves an
+        # fsync on every commit.
+        conn.execute('pragma synchronous=normal')
+        # Wait on locks instead of failing right away.
+        conn.execute('pragma busy_timeout={0}'.format(int(DB_BUSY_TIMEOUT)))
+        return conn
+
+    def _evict(self):
+        ''' Closes connections that have been idle for too long.
+            The caller must be holding the lock.
+        '''
+        if not self._idle:
+            return
+        cutoff = time.monotonic() - self.idle_timeout
+        # The stack is ordered by when connections were returned, so the
+        # stale ones are always at the bottom.
+        while self._idle and self._idle[0][1] < cutoff:
+            conn, _ = self._idle.pop(0)
+            conn.close()
+            self._open -= 1
+            self._stats['closed'] += 1
+            self._stats['evicted'] += 1
+
+    def checkout(self):
+        ''' Borrow a connection from the pool. Make sure to hand it back
+            with checkin when done.
+        '''
+        with self._cond:
+            self._evict()
+            self._stats['checkouts'] += 1
+            if not self._idle and self._open >= self.size:
+                self._stats['waits'] += 1
+                start = time.monotonic()
+                if not self._cond.wait_for(
+                        lambda: self._idle or self._open < self.size,
+                        self.timeout):
+                    raise PoolTimeoutError('Timed out waiting for a database connection')
+                self._stats['wait_time'] += time.monotonic() - start
+            if self._idle:
+                return self._idle.pop()[0]
+            # Reserve the slot before opening so we don't go over 'size'.
+            self._open += 1
+
+        try:
+            conn = self._connect()
+        except BaseException:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._stats['opened'] += 1
+        return conn
+
+    def checkin(self, conn):
+        ''' Return a connection to the pool. '''
+        # Never hand out a connection with a half finished transaction.
+        if conn.in_transaction:
+            conn.rollback()
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        ''' Works just like the sqlite3 connection context manager (commit
+            on success and rollback on error) except the connection goes back
+            to the pool instead of being thrown away.
+        '''
+        conn = self.checkout()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.checkin(conn)
+
+    @contextlib.contextmanager
+    def dedicated(self):
+        ''' Like 'connection' but with a connection of its own, opened for
+            the occasion and closed after. For long reads (like an export
+            going out to a slow client) that would otherwise keep a pool
+            connection from everyone else for as long as they take.
+        '''
+        conn = self._connect()
+        with self._cond:
+            self._dedicated += 1
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+            with self._cond:
+                self._dedicated -= 1
+
+    def close(self):
+        ''' Closes all idle connections. '''
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                conn.close()
+                self._open -= 1
+                self._stats['closed'] += 1
+
+    def stats(self):
+        with self._cond:
+            return {
+                **self._stats,
+                'size': self.size,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self._open - len(self._idle),
+                'dedicated': self._dedicated
+            }
+
+
+class Writer(object):
+
+    ''' SQLite only allows one writer at a time. Instead of having every request
+        thread fight over the write lock (and occasionally lose with 'database is
+        locked'), all writes are handed to a single thread.
+
+        The writer pulls as many queued operations as it can (up to 'batch_size')
+        and runs them inside one transaction, so a burst of writes only pays for
+        a single commit. Every operation gets its own SAVEPOINT so one bad write
+        (say a UNIQUE constraint) does not take the rest of the batch with it.
+
+        Callers get a Future back. The result is only set once the transaction
+        has been committed.
+    '''
+
+    def __init__(self, pool, batch_size=DB_WRITER_BATCH_SIZE, max_wait=DB_WRITER_MAX_WAIT):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stats = {
+            'writes': 0,
+            'errors': 0,
+            'batches': 0,
+            'max_batch': 0
+        }
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='database-writer', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout=None):
+        ''' Finishes any queued writes and stops the writer thread. '''
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
+
+    def submit(self, fn, *args, **kwargs):
+        ''' Queue up a write. 'fn' gets called from the writer thread with a
+            cursor as its first argument.
+        '''
+        future = Future()
+        if self._thread is None:
+            self.start()
+        self._queue.put((fn, args, kwargs, future))
+        return future
+
+    def write(self, fn, *args, **kwargs):
+        ''' Queue up a write and wait for its result. '''
+        return self.submit(fn, *args, **kwargs).result()
+
+    def _collect(self, item):
+        ''' Gathers a batch of operations starting with 'item'.
+            Returns the batch and whether we were asked to stop.
+        '''
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            try:
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    item = self._queue.get(timeout=remaining)
+                else:
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _commit(self, batch):
+        results = []
+        conn = None
+        try:
+            conn = self.pool.checkout()
+            # Grab the write lock up front.
+            conn.execute('BEGIN IMMEDIATE')
+            for fn, args, kwargs, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute('SAVEPOINT write_op')
+                try:
+                    result = fn(conn.cursor(), *args, **kwargs)
+                except Exception as e:
+                    conn.execute('ROLLBACK TO write_op')
+                    conn.execute('RELEASE write_op')
+                    results.append((future, e, True))
+                else:
+                    conn.execute('RELEASE write_op')
+                    results.append((future, result, False))
+            conn.commit()
+        except Exception as e:
+            # The whole transaction failed (or never started, say the write
+            # lock was busy) so nothing in this batch made it.
+            if conn is not None and conn.in_transaction:
+                conn.rollback()
+            self._fail(batch, e)
+            return
+        finally:
+            if conn is not None:
+                self.pool.checkin(conn)
+
+        self._stats['batches'] += 1
+        self._stats['writes'] += len(results)
+        self._stats['max_batch'] = max(self._stats['max_batch'], len(batch))
+        for future, value, failed in results:
+            if failed:
+                self._stats['errors'] += 1
+                future.set_exception(value)
+            else:
+                future.set_result(value)
+
+    def _fail(self, batch, e):
+        ''' Fails every write in the batch that hasn't got an answer yet,
+            whether it got as far as running or not.
+        '''
+        for fn, args, kwargs, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        self._stats['errors'] += len(batch)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch, stopping = self._collect(item)
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # Nobody is left waiting and the writer keeps going.
+                self._fail(batch, e)
+            if stopping:
+                return
+
+    def stats(self):
+        return {
+            **self._stats,
+            'queued': self._queue.qsize(),
+            'batch_size': self.batch_size,
+            'max_wait': self.max_wait
+        }
+
+
+pool = ConnectionPool(DB_FILE)
+
+writer = Writer(pool)
+
+
+# Borrow a database connection from the pool.
+# This is meant to be used with the 'with' clause:
+#
+#     with database.connect() as conn:
+#         ...
+#
 def connect():
-    # This is technically dangerous because with multiple writers SQLite3
-    # could lock. I am going to ignore this consern because the likelyhood
-    # of this happening is low.
-    conn = sqlite3.connect(DB_FILE)
+    return pool.connection()
 
-    # Enable dict factory for sqlite3.
-    # I would typically use the PostGreSQL JSON functionality.
-    def dict_factory(cursor, row):
-        d = {}
-        for idx, col in enumerate(cursor.description):
-            d[col[0]] = row[idx]
-        return d
 
-    conn.row_factory = dict_factory
+# A connection outside the pool for reads that take a long time, see
+# ConnectionPool.dedicated.
+def connectDedicated():
+    return pool.dedicated()
 
-    # Set journal mode to WAL.
-    # source: https://charlesleifer.com/blog/going-fast-with-sqlite-and-python/
-    # https://sqlite.org/wal.html
-    # This isn't really needed for this project, but it is
-    # helpful for high concurrency applications.
-    conn.execute('pragma journal_mode=wal')
 
-    # Return database connection
-    return conn
+# Run a write operation on the writer thread and wait for the result.
+# 'fn' is called with a cursor that is already inside a transaction,
+# so it should not commit.
+def write(fn, *args, **kwargs):
+    # Waiting on the writer counts as database time for the caller.
+    start = time.perf_counter()
+    try:
+        return writer.write(fn, *args, **kwargs)
+    finally:
+        _addQueryTime(time.perf_counter() - start)
 
 
-# Initialize database if it does not yet exist
-if not _dbExists:
+def stats():
+    return {
+        'pool': pool.stats(),
+        'writer': writer.stats(),
+        'statements': STATEMENTS.stats() if STATEMENTS is not None else None
+    }
 
-    # The 'with' clause will automatically call the close
-    # method on the database connection.
-    with connect() as conn:
 
-        # Create basic tables and triggers
-        cursor = conn.cursor()
+def close():
+    writer.stop()
+    pool.close()
 
-        # I am using a UUID for a primary key. This is over kill for a small
-        # project. I have gotten in the habit of doing this when working with
-        # horizontally scaling systems.
-        # SQLite3 doesn't have a UUID function so we will use a custom one.
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS models (
-                id              DEFAULT (lower(hex(randomblob(4))) || '-' || lower(hex(randomblob(2))) || '-4' || substr(lower(hex(randomblob(2))),2) || '-' || substr('89ab',abs(random()) % 4 + 1, 1) || substr(lower(hex(randomblob(2))),2) || '-' || lower(hex(randomblob(6)))),
-                name            TEXT UNIQUE,
-                make            TEXT,
-                color           TEXT,
-                status          TEXT,
-                create_at       DATETIME DEFAULT CURRENT_TIMESTAMP,
-                update_at       DATETIME DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY ("id")
-            );
-        ''')
 
+def _afterFork():
+    ''' SQLite connections (and our locks and threads) must not be carried
+        across a fork, so a forked child starts with a fresh pool and writer.
+        The pre-fork supervisor closes the parent's connections before forking.
+    '''
+    global pool, writer, STATEMENTS
+    pool = ConnectionPool(pool.database, pool.size, pool.timeout, pool.idle_timeout)
+    writer = Writer(pool, writer.batch_size, writer.max_wait)
+    # Each worker keeps its own statement totals.
+    if STATEMENTS is not None:
+        STATEMENTS = StatementStats(STATEMENTS.max_statements, STATEMENTS.slow_ms)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_afterFork)
+
+
+# Feature detection for the SQLite library Python was built against.
+# 'RETURNING' showed up in 3.35.0 (https://www.sqlite.org/lang_returning.html)
+# and 'ON CONFLICT ... DO UPDATE' (UPSERT) in 3.24.0. Debian 10 still ships 3.27.2,
+# so we need a fallback.
+SQLITE_VERSION = sqlite3.sqlite_version_info
+SUPPORTS_RETURNING = SQLITE_VERSION >= (3, 35, 0)
+SUPPORTS_UPSERT = SQLITE_VERSION >= (3, 24, 0)
+
+
+def _searchTokenizer():
+    ''' Full text search needs the FTS5 extension. The 'trigram' tokenizer
+        (3.34.0) lets us match any substring, without it we can only match
+        the start of words. Returns None when there is no FTS5 at all.
+    '''
+    conn = sqlite3.connect(':memory:')
+    try:
+        for tokenizer in ['trigram', 'unicode61']:
+            try:
+                conn.execute('''CREATE VIRTUAL TABLE t_{0} USING fts5(a, tokenize='{0}');'''.format(tokenizer))
+                return tokenizer
+            except sqlite3.OperationalError:
+                continue
+        return None
+    finally:
+        conn.close()
+
+
+SEARCH_TOKENIZER = _searchTokenizer()
+
+
+def createSchema(cursor):
+    # I am using a UUID for a primary key. This is over kill for a small
+    # project. I have gotten in the habit of doing this when working with
+    # horizontally scaling systems.
+    # SQLite3 doesn't have a UUID function so we will use a custom one.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS models (
+            id              DEFAULT (lower(hex(randomblob(4))) || '-' || lower(hex(randomblob(2))) || '-4' || substr(lower(hex(randomblob(2))),2) || '-' || substr('89ab',abs(random()) % 4 + 1, 1) || substr(lower(hex(randomblob(2))),2) || '-' || lower(hex(randomblob(6)))),
+            name            TEXT UNIQUE,
+            make            TEXT,
+            color           TEXT,
+            status          TEXT,
+            create_at       DATETIME DEFAULT CURRENT_TIMESTAMP,
+            update_at       DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY ("id")
+        );
+    ''')
+
+
+def migrate(cursor):
+    ''' Brings an existing database up to date with the current schema. '''
+    # The 'update_at' column used to be maintained by an AFTER UPDATE trigger.
+    # That meant every update was really two writes. The writes in models.py
+    # now set 'update_at' themselves.
+    cursor.execute('''DROP TRIGGER IF EXISTS on_models_update;''')
+
+    # A counter per table that goes up on every write. Anything cached from
+    # the table (see models.QueryCache) is still good as long as the counter
+    # hasn't moved, and since it lives in the database it works across
+    # processes too. The triggers run in the same transaction as the write.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name            TEXT PRIMARY KEY,
+            version         INTEGER NOT NULL DEFAULT 0
+        );
+    ''')
+    cursor.execute('''INSERT OR IGNORE INTO table_versions (name, version) VALUES ('models', 0);''')
+    for event in ['INSERT', 'UPDATE', 'DELETE']:
         cursor.execute('''
-            CREATE TRIGGER IF NOT EXISTS on_models_update
-               AFTER UPDATE OF make, color, status ON models
+            CREATE TRIGGER IF NOT EXISTS models_version_{0} AFTER {1} ON models
             BEGIN
-                UPDATE models SET update_at = CURRENT_TIMESTAMP WHERE name = NEW.name;
+                UPDATE table_versions SET version = version + 1 WHERE name = 'models';
             END;
-        ''')
+        '''.format(event.lower(), event))
 
-        conn.commit()
+    if SEARCH_TOKENIZER:
+        createSearchIndex(cursor)
+
+    createChangeLog(cursor)
+
+
+def createChangeLog(cursor):
+    ''' The change feed (see Model.changes). Every write to 'models' adds an
+        entry with a new 'seq' and drops the older entries for the same id,
+        so the log is compacted as it goes: at most one entry per model, and
+        a client that has seen up to 'seq' only needs the entries after it.
+
+        Old entries are pruned by 'pruneChanges'. The highest pruned 'seq' is
+        kept in table_versions as 'changes_pruned', clients that are behind
+        that have to start over from a snapshot.
+    '''
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS changes (
+            seq             INTEGER PRIMARY KEY AUTOINCREMENT,
+            id              TEXT NOT NULL,
+            op              TEXT NOT NULL,
+            at              TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    ''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS idx_changes_id ON changes (id);''')
+    cursor.execute('''INSERT OR IGNORE INTO table_versions (name, version) VALUES ('changes_pruned', 0);''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS models_changes_insert AFTER INSERT ON models
+        BEGIN
+            DELETE FROM changes WHERE id = new.id;
+            INSERT INTO changes (id, op) VALUES (new.id, 'upsert');
+        END;
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS models_changes_update AFTER UPDATE ON models
+        BEGIN
+            DELETE FROM changes WHERE id IN (old.id, new.id);
+            INSERT INTO changes (id, op) SELECT old.id, 'delete' WHERE old.id IS NOT new.id;
+            INSERT INTO changes (id, op) VALUES (new.id, 'upsert');
+        END;
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS models_changes_delete AFTER DELETE ON models
+        BEGIN
+            DELETE FROM changes WHERE id = old.id;
+            INSERT INTO changes (id, op) VALUES (old.id, 'delete');
+        END;
+    ''')
 
-        # Generate an example dataset
-        cursor = conn.cursor()
-        make_options = ['ford', 'subaru', 'honda', 'toyota', 'gm', 'mazda']
-        color_options = ['blue', 'red', 'silver', 'white', 'black']
-        status_options = ['fail'] * 10 + ['warn'] * 20 + ['pass'] * 70
-
-        for i in range(37):
-            name = 'thing_{0}'.format(i)
-            make = random.choice(make_options)
-            color = random.choice(color_options)
-            status = random.choice(status_options)
-            cursor.execute(
-                '''INSERT INTO models (name, make, color, status) VALUES (?, ?, ?, ?)''', (name, make, color, status, ))
 
+def lastChange(cursor):
+    ''' Returns the 'seq' of the latest change. AUTOINCREMENT keeps it in
+        'sqlite_sequence', even once the entry itself is gone.
+    '''
+    row = cursor.execute(
+        '''SELECT seq FROM sqlite_sequence WHERE name = 'changes';''').fetchone()
+    return row[0] if row else 0
+
+
+def pruneChanges(cursor, retention, max_rows):
+    ''' Drops the change log entries older than 'retention' seconds and
+        anything beyond the newest 'max_rows'. Returns how many went.
+    '''
+    cutoff = 0
+    for query, args in [
+            ('''SELECT seq FROM changes WHERE at < datetime('now', ?) ORDER BY seq DESC LIMIT 1;''',
+             ('-{0} seconds'.format(int(retention)),)),
+            ('''SELECT seq FROM changes ORDER BY seq DESC LIMIT 1 OFFSET ?;''', (int(max_rows),))]:
+        row = cursor.execute(query, args).fetchone()
+        if row:
+            cutoff = max(cutoff, row[0])
+    if not cutoff:
+        return 0
+    pruned = cursor.execute('''DELETE FROM changes WHERE seq <= ?;''', (cutoff,)).rowcount
+    cursor.execute(
+        '''UPDATE table_versions SET version = max(version, ?) WHERE name = 'changes_pruned';''', (cutoff,))
+    return pruned
+
+
+def createSearchIndex(cursor):
+    ''' Full text index over the text columns of 'models' (see Model.search).
+        It is an external content table so the text isn't stored twice, and
+        the triggers keep it in sync with every write.
+    '''
+    exists = cursor.execute(
+        '''SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'models_search';''').fetchone()
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS models_search USING fts5(
+            name, make, color, status,
+            content='models', content_rowid='rowid', tokenize='{0}'
+        );
+    '''.format(SEARCH_TOKENIZER))
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS models_search_insert AFTER INSERT ON models
+        BEGIN
+            INSERT INTO models_search (rowid, name, make, color, status)
+                VALUES (new.rowid, new.name, new.make, new.color, new.status);
+        END;
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS models_search_delete AFTER DELETE ON models
+        BEGIN
+            INSERT INTO models_search (models_search, rowid, name, make, color, status)
+                VALUES ('delete', old.rowid, old.name, old.make, old.color, old.status);
+        END;
+    ''')
+    # Only when one of the indexed columns changes.
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS models_search_update AFTER UPDATE OF name, make, color, status ON models
+        BEGIN
+            INSERT INTO models_search (models_search, rowid, name, make, color, status)
+                VALUES ('delete', old.rowid, old.name, old.make, old.color, old.status);
+            INSERT INTO models_search (rowid, name, make, color, status)
+                VALUES (new.rowid, new.name, new.make, new.color, new.status);
+        END;
+    ''')
+    if not exists:
+        # Index whatever is already in the table.
+        cursor.execute('''INSERT INTO models_search (models_search) VALUES ('rebuild');''')
+
+
+def tableVersion(cursor, name='models'):
+    ''' Returns the current version of a table (see 'migrate'). '''
+    row = cursor.execute(
+        '''SELECT version FROM table_versions WHERE name = ?;''', (name,)).fetchone()
+    return row[0] if row else 0
+
+
+def seed(cursor):
+    # Generate an example dataset
+    make_options = ['ford', 'subaru', 'honda', 'toyota', 'gm', 'mazda']
+    color_options = ['blue', 'red', 'silver', 'white', 'black']
+    status_options = ['fail'] * 10 + ['warn'] * 20 + ['pass'] * 70
+
+    for i in range(37):
+        name = 'thing_{0}'.format(i)
+        make = random.choice(make_options)
+        color = random.choice(color_options)
+        status = random.choice(status_options)
+        cursor.execute(
+            '''INSERT INTO models (name, make, color, status) VALUES (?, ?, ?, ?)''', (name, make, color, status, ))
+
+
+def initialize():
+    ''' Creates the database if it does not yet exist and runs any migrations. '''
+    # The 'with' clause will commit and hand the connection
+    # back to the pool when we are done.
+    with connect() as conn:
+        cursor = conn.cursor()
+        createSchema(cursor)
+        migrate(cursor)
         conn.commit()
+
+        # Only seed brand new databases.
+        if not _dbExists and DB_SEED:
+            seed(cursor)
+            conn.commit()
+
+
+initialize()
@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+
+'''
+Synthetic datasets for scale testing. 'generate' bulk loads any number of
+models with the given distributions of makes, colors and statuses. Used by
+'main.py generate' and the benchmarks, and handy in tests:
+
+    $ python3 main.py generate 10000000 -db big.sqlite3
+    $ python3 main.py generate 1000000 -make ford=3,gm=1 -status fail=1,pass=9 -seed 42
+
+    dataset.generate(100000, path, statuses={'fail': 1, 'pass': 9}, seed=1)
+
+Going through Model.save (or even ModelCollection.load) every row fires the
+search, change log and version triggers and updates every index, that tops
+out at a few thousand rows a second. So this goes around all of it:
+
+  * The triggers and the secondary indexes are dropped for the load and
+    created again afterwards. Building an index over a full table is one
+    sort instead of millions of inserts. The new rows are added to the
+    search index in one statement at the end (that is most of the time
+    with the trigram tokenizer).
+  * SQLite makes the rows. Python only samples the values, a random byte
+    per row and column mapped through a 256 entry table, and every
+    statement in the executemany inserts a whole batch of rows.
+  * Ids and names count up within a run, so they go on the end of the
+    primary key and 'name' indexes.
+  * synchronous=off and a big page cache.
+
+Generated models don't go in the change log, clients following the change
+feed are told to start over from a snapshot instead (see Model.changes).
+Don't run it against a database a server is using, anything the server
+writes during the load misses the triggers too.
+'''
+
+import time
+import random
+import sqlite3
+
+import conf
+import database
+
+
+# Default distributions, the same as database.seed.
+MAKES = {'ford': 1, 'subaru': 1, 'honda': 1, 'toyota': 1, 'gm': 1, 'mazda': 1}
+COLORS = {'blue': 1, 'red': 1, 'silver': 1, 'white': 1, 'black': 1}
+STATUSES = {'fail': 10, 'warn': 20, 'pass': 70}
+
+
+def parseDistribution(text):
+    ''' Turns 'ford=3,gm=1' into {'ford': 3.0, 'gm': 1.0}. A value without a
+        weight gets 1.
+    '''
+    weights = {}
+    for part in text.split(','):
+        value, _, weight = part.partition('=')
+        value = value.strip()
+        if not value:
+            raise ValueError('Empty value in {0!r}'.format(text))
+        try:
+            weights[value] = float(weight or 1)
+        except ValueError:
+            raise ValueError('Invalid weight {0!r} for {1!r}'.format(weight, value))
+    return weights
+
+
+def sampler(distribution):
+    ''' Returns the values of a {value: weight} distribution and a table for
+        bytes.translate that turns a random byte into the index of a value.
+        Each value gets a share of the 256 entries in line with its weight
+        (at least one), so the weights are good to about 1/256.
+    '''
+    if any(weight < 0 for weight in distribution.values()):
+        raise ValueError('Weights can not be negative')
+    values = [value for value, weight in distribution.items() if weight > 0]
+    if not values:
+        raise ValueError('A distribution needs a value with a weight')
+    if len(values) > 256:
+        raise ValueError('A distribution can have at most 256 values')
+    total = sum(distribution[value] for value in values)
+    shares = [distribution[value] * 256 / total for value in values]
+    slots = [max(1, int(share)) for share in shares]
+    # Hand out what rounding left over (or took too much) by the remainders.
+    while sum(slots) < 256:
+        i = max(range(len(values)), key=lambda i: shares[i] - slots[i])
+        slots[i] += 1
+    while sum(slots) > 256:
+        i = max((i for i in range(len(values)) if slots[i] > 1), key=lambda i: slots[i] - shares[i])
+        slots[i] -= 1
+    return values, b''.join(bytes([i]) * n for i, n in enumerate(slots))
+
+
+def _quote(value):
+    return "'" + value.replace("'", "''") + "'"
+
+
+def insertStatement(columns):
+    ''' The INSERT for a batch. It counts 'i' from 1 to :count and picks
+        the value of each column with the i-th byte of its samples (a BLOB,
+        so substr doesn't have to scan for characters). The values are
+        literals so SQLite only looks at them once per statement.
+    '''
+    picks = [
+        'CASE substr(:{0}, i, 1) {1} END'.format(name, ' '.join(
+            "WHEN x'{0:02x}' THEN {1}".format(i, _quote(value)) for i, value in enumerate(values)))
+        for name, (values, _) in columns]
+    return '''
+        WITH RECURSIVE seq(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM seq WHERE i < :count)
+        INSERT INTO models (id, name, {0})
+            SELECT printf(:ids, :start + i), printf(:names, :start + i), {1} FROM seq;
+    '''.format(', '.join(name for name, _ in columns), ', '.join(picks))
+
+
+def deferSchema(cursor):
+    ''' Drops the indexes and triggers on 'models' (not the ones SQLite
+        makes for the constraints). Returns the SQL to create them again.
+    '''
+    rows = cursor.execute('''
+        SELECT type, name, sql FROM sqlite_master
+            WHERE type IN ('index', 'trigger') AND tbl_name = 'models' AND sql IS NOT NULL;''').fetchall()
+    for kind, name, _ in rows:
+        cursor.execute('''DROP {0} IF EXISTS "{1}";'''.format(kind.upper(), name))
+    return [sql for _, _, sql in rows]
+
+
+def restoreSchema(cursor, statements, after):
+    ''' Puts back what deferSchema dropped and catches up on what the
+        triggers would have done for the rows after rowid 'after'.
+    '''
+    for sql in statements:
+        cursor.execute(sql)
+    if cursor.execute('''SELECT 1 FROM sqlite_master WHERE name = 'models_search';''').fetchone():
+        cursor.execute('''
+            INSERT INTO models_search (rowid, name, make, color, status)
+                SELECT rowid, name, make, color, status FROM models WHERE rowid > ?;''', (after,))
+    cursor.execute('''UPDATE table_versions SET version = version + 1 WHERE name = 'models';''')
+    # Nothing went in the change log, so move its sequence on and count
+    # everything before as pruned. Anyone following the feed starts over.
+    seq = database.lastChange(cursor) + 1
+    if not cursor.execute('''UPDATE sqlite_sequence SET seq = ? WHERE name = 'changes';''', (seq,)).rowcount:
+        cursor.execute('''INSERT INTO sqlite_sequence (name, seq) VALUES ('changes', ?);''', (seq,))
+    cursor.execute(
+        '''UPDATE table_versions SET version = max(version, ?) WHERE name = 'changes_pruned';''', (seq,))
+
+
+def generate(count, path=None, makes=MAKES, colors=COLORS, statuses=STATUSES, seed=None,
+             chunk_size=conf.GENERATE_CHUNK_SIZE, batch_size=conf.GENERATE_BATCH_SIZE,
+             progress=None, interval=conf.IMPORT_PROGRESS_INTERVAL):
+    ''' Adds 'count' models to the database at 'path' (conf.DB_FILE by
+        default), creating it if needed. The distributions are {value:
+        weight}. The same 'seed' makes the same models, ids included, so
+        only once per database. 'progress' gets called with the number of
+        rows so far every 'interval' seconds.
+
+        Chunks that were committed stay if it fails part way, the indexes
+        and triggers are put back either way. If the process gets killed
+        they come back when the server starts, but the search index will be
+        missing rows until it is rebuilt:
+
+            INSERT INTO models_search (models_search) VALUES ('rebuild');
+
+        Returns {'rows', 'load_seconds', 'index_seconds', 'seconds', 'rows_per_second'}
+        where 'rows_per_second' is for the load alone.
+    '''
+    if count < 0:
+        raise ValueError('count can not be negative')
+    if chunk_size < 1 or batch_size < 1:
+        raise ValueError('chunk_size and batch_size must be at least 1')
+    columns = [('make', sampler(makes)), ('color', sampler(colors)), ('status', sampler(statuses))]
+    statement = insertStatement(columns)
+    rnd = random.Random(seed)
+    # A random version 4 UUID with the last 12 digits counting up. The names
+    # share the first 8 digits.
+    prefix = '{0:08x}-{1:04x}-4{2:03x}-{3:04x}-'.format(
+        rnd.getrandbits(32), rnd.getrandbits(16), rnd.getrandbits(12), 0x8000 | rnd.getrandbits(14))
+    ids = prefix + '%012x'
+    names = 'gen_' + prefix[:8] + '_%010d'
+
+    def batches(start, stop):
+        for first in range(start, stop, batch_size):
+            size = min(batch_size, stop - first)
+            params = {'count': size, 'start': first - 1, 'ids': ids, 'names': names}
+            for name, (_, table) in columns:
+                params[name] = rnd.randbytes(size).translate(table)
+            yield params
+
+    conn = sqlite3.connect(path or conf.DB_FILE, isolation_level=None)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('pragma journal_mode=wal')
+        cursor.execute('pragma synchronous=off')
+        cursor.execute('pragma temp_store=memory')
+        cursor.execute('pragma cache_size=-{0}'.format(int(conf.GENERATE_CACHE_MB * 1024)))
+
+        started = time.monotonic()
+        cursor.execute('''BEGIN IMMEDIATE;''')
+        database.createSchema(cursor)
+        database.migrate(cursor)
+        after = cursor.execute('''SELECT coalesce(max(rowid), 0) FROM models;''').fetchone()[0]
+        deferred = deferSchema(cursor)
+        cursor.execute('''COMMIT;''')
+
+        done = 0
+        reported = time.monotonic()
+        try:
+            for start in range(0, count, chunk_size):
+                stop = min(count, start + chunk_size)
+                cursor.execute('''BEGIN;''')
+                cursor.executemany(statement, batches(start, stop))
+                cursor.execute('''COMMIT;''')
+                done = stop
+                if progress is not None and time.monotonic() - reported >= interval:
+                    progress(done)
+                    reported = time.monotonic()
+        finally:
+            if conn.in_transaction:
+                cursor.execute('''ROLLBACK;''')
+            loaded = time.monotonic()
+            cursor.execute('''BEGIN IMMEDIATE;''')
+            restoreSchema(cursor, deferred, after)
+            cursor.execute('''COMMIT;''')
+            cursor.execute('pragma wal_checkpoint(truncate)')
+    finally:
+        conn.close()
+
+    finished = time.monotonic()
+    if progress is not None:
+        progress(done)
+    return {
+        'rows': done,
+        'load_seconds': round(loaded - started, 3),
+        'index_seconds': round(finished - loaded, 3),
+        'seconds': round(finished - started, 3),
+        'rows_per_second': round(done / (loaded - started), 1) if loaded > started else 0.0
+    }
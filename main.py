@@ -1,20 +1,186 @@
 #!/usr/bin/python3
 
+import sys
+import time
 import argparse
 
-import server
+import conf
+
+
+def importFile(args):
+    import transfer
+    import database
+    fmt = args.format or transfer.detectFormat(args.file)
+    # csv wants to do its own newline handling.
+    fh = sys.stdin if '-' == args.file else open(args.file, newline='', encoding='utf-8')
+    try:
+        stats = transfer.importModels(
+            fh, fmt, args.on_conflict, args.chunk_size or conf.IMPORT_CHUNK_SIZE,
+            progress=lambda stats: print(stats, file=sys.stderr))
+    finally:
+        if fh is not sys.stdin:
+            fh.close()
+        database.close()
+    for error in stats.errors:
+        print('line {line}: {message}'.format(**error), file=sys.stderr)
+    if stats.stopped is not None:
+        print('Stopped at line {0}'.format(stats.stopped), file=sys.stderr)
+        return 1
+    return 0
+
+
+def exportFile(args):
+    import transfer
+    import database
+    fmt = args.format or transfer.detectFormat(args.file)
+    filters = dict(f.split('=', 1) for f in args.filter)
+    started = reported = time.monotonic()
+    written = 0
+
+    def progress(count):
+        nonlocal reported, written
+        written = count
+        if time.monotonic() - reported >= conf.IMPORT_PROGRESS_INTERVAL:
+            reported = time.monotonic()
+            print('{0} rows written'.format(count), file=sys.stderr)
+
+    fh = sys.stdout if '-' == args.file else open(args.file, 'w', newline='', encoding='utf-8')
+    try:
+        for chunk in transfer.exportModels(fmt, progress=progress, **filters):
+            fh.write(chunk)
+    finally:
+        if fh is not sys.stdout:
+            fh.close()
+        database.close()
+    seconds = time.monotonic() - started
+    print('{0} rows written in {1:.3f}s ({2:.1f} rows/s)'.format(
+        written, seconds, written / seconds if seconds else 0.0), file=sys.stderr)
+    return 0
+
+
+def generateModels(args):
+    # Only what we make, no example models in a new database.
+    conf.DB_SEED = False
+    import dataset
+    try:
+        count = int(args.file)
+        distributions = {
+            key: dataset.parseDistribution(text) for key, text in [
+                ('makes', args.make), ('colors', args.color), ('statuses', args.status)] if text}
+        stats = dataset.generate(
+            count, seed=args.seed, chunk_size=args.chunk_size or conf.GENERATE_CHUNK_SIZE,
+            progress=lambda rows: print('{0} rows generated'.format(rows), file=sys.stderr),
+            **distributions)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    print('{rows} rows in {seconds}s: loaded in {load_seconds}s ({rows_per_second} rows/s), '
+          'indexes took {index_seconds}s'.format(**stats), file=sys.stderr)
+    return 0
 
 
 if __name__ == "__main__":
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='OCCU Project')
+    parser.add_argument(
+        'command',
+        nargs='?',
+        default='serve',
+        choices=['serve', 'import', 'export', 'generate'],
+        help='run the server (default), import/export models or generate a synthetic dataset')
+    parser.add_argument(
+        'file',
+        nargs='?',
+        default='-',
+        help="file to import from or export to, '-' for stdin/stdout (how many models to generate)")
     parser.add_argument(
         '-host',
         type=str,
         default='localhost',
         help='server host')
     parser.add_argument('-port', type=int, default=8080, help='server port')
+    parser.add_argument(
+        '-debug',
+        action='store_true',
+        help='enable developer features')
+    parser.add_argument(
+        '-engine',
+        type=str,
+        default='threading',
+        choices=['threading', 'asyncio'],
+        help='server engine')
+    parser.add_argument(
+        '-workers',
+        type=int,
+        default=1,
+        help='number of pre-forked worker processes')
+    parser.add_argument(
+        '-db',
+        type=str,
+        default=conf.DB_FILE,
+        help='database file')
+    parser.add_argument(
+        '-access-log',
+        type=str,
+        default=conf.ACCESS_LOG,
+        help="access log file, '-' for stderr or 'off'")
+    parser.add_argument(
+        '-capture',
+        type=str,
+        default=conf.CAPTURE_FILE,
+        help='record every request to this file (see benchmarks/replay.py)')
+    parser.add_argument(
+        '-slow-query-ms',
+        type=float,
+        default=conf.DB_SLOW_QUERY_MS,
+        help="log statements slower than this (milliseconds), 0 for every statement, -1 for none")
+    parser.add_argument(
+        '-format',
+        choices=['ndjson', 'csv'],
+        help='import/export format (default from the file extension, else ndjson)')
+    parser.add_argument(
+        '-on-conflict',
+        default='fail',
+        choices=['fail', 'skip', 'update'],
+        help="what an import does with a name that is already taken")
+    parser.add_argument(
+        '-chunk-size',
+        type=int,
+        help='rows per import/generate transaction')
+    parser.add_argument(
+        '-filter',
+        nargs='*',
+        default=[],
+        help='only export models matching these, e.g. make=ford status=fail')
+    parser.add_argument('-make', help='generated makes with their weights, e.g. ford=3,gm=1')
+    parser.add_argument('-color', help='generated colors with their weights, e.g. red=1,blue=2')
+    parser.add_argument('-status', help='generated statuses with their weights, e.g. fail=1,pass=9')
+    parser.add_argument('-seed', type=int, help='random seed, the same seed generates the same models')
     args, unknown = parser.parse_known_args()
 
+    conf.DEBUG = args.debug
+    conf.DB_FILE = args.db
+    conf.ACCESS_LOG = None if 'off' == args.access_log else args.access_log
+    conf.CAPTURE_FILE = args.capture
+    conf.DB_SLOW_QUERY_MS = None if args.slow_query_ms < 0 else args.slow_query_ms
+
+    if 'import' == args.command:
+        sys.exit(importFile(args))
+    if 'export' == args.command:
+        sys.exit(exportFile(args))
+    if 'generate' == args.command:
+        sys.exit(generateModels(args))
+
+    # The database gets opened (and created) when the server modules are
+    # imported, so this has to come after the settings.
+    import server
+
     # Start server
-    server.start(args.host, args.port)
+    if 1 < args.workers:
+        import prefork
+        prefork.start(args.host, args.port, args.workers, args.engine)
+    elif 'asyncio' == args.engine:
+        import async_server
+        async_server.start(args.host, args.port)
+    else:
+        server.start(args.host, args.port)
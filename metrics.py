@@ -0,0 +1,197 @@
+#!/usr/bin/python3
+
+'''
+Tiny in-process metrics registry.
+
+Metrics are created once (usually at import time) and updated from the
+request threads, so every update goes through a lock.
+
+'render' writes everything out in the Prometheus text format (served at
+'/metrics'). Metrics that are cheaper to read when asked for than to keep
+up to date (e.g. the connection pool) register a 'collector' that sets
+them right before rendering. With pre-forked workers every process has
+its own registry.
+'''
+
+import bisect
+import threading
+
+
+# Latency buckets (seconds). Most of our requests are well under 10ms.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric(object):
+
+    ''' Base class for a named metric with optional labels. '''
+
+    kind = None
+
+    def __init__(self, name, help='', labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            values = dict(self._values)
+        if not self.labelnames:
+            return values.get((), 0)
+        return {
+            ','.join('{0}={1}'.format(n, v) for n, v in zip(self.labelnames, key)): value
+            for key, value in values.items()
+        }
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{0}="{1}"'.format(n, _escape(v)) for n, v in pairs) + '}'
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return ['{0}{1} {2}'.format(self.name, self._labels(key), _number(value))
+                for key, value in values]
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+
+    ''' Counts observations into 'buckets' (upper bounds) and keeps their sum.
+        The counts are kept per bucket and only made cumulative on output.
+    '''
+
+    kind = 'histogram'
+
+    def __init__(self, name, help='', labelnames=(), buckets=BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [counts per bucket (the last one is +Inf), sum, count]
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][idx] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def _entries(self):
+        with self._lock:
+            return sorted((key, (list(e[0]), e[1], e[2])) for key, e in self._values.items())
+
+    def snapshot(self):
+        summary = {}
+        for key, (counts, total, count) in self._entries():
+            name = ','.join('{0}={1}'.format(n, v) for n, v in zip(self.labelnames, key))
+            summary[name] = {'count': count, 'sum': total}
+        if not self.labelnames:
+            return summary.get('', {'count': 0, 'sum': 0.0})
+        return summary
+
+    def render(self):
+        lines = []
+        for key, (counts, total, count) in self._entries():
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name, self._labels(key, [('le', _number(bound))]), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(self.name, self._labels(key), _number(total)))
+            lines.append('{0}_count{1} {2}'.format(self.name, self._labels(key), count))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+REGISTRY = {}
+COLLECTORS = []
+_lock = threading.Lock()
+
+
+def _register(cls, name, help, labelnames, **kwargs):
+    with _lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = cls(name, help, labelnames, **kwargs)
+        return REGISTRY[name]
+
+
+def counter(name, help='', labelnames=()):
+    return _register(Counter, name, help, labelnames)
+
+
+def gauge(name, help='', labelnames=()):
+    return _register(Gauge, name, help, labelnames)
+
+
+def histogram(name, help='', labelnames=(), buckets=BUCKETS):
+    return _register(Histogram, name, help, labelnames, buckets=buckets)
+
+
+def collector(fn):
+    ''' Registers 'fn' to be called before the metrics are rendered. '''
+    COLLECTORS.append(fn)
+    return fn
+
+
+def render():
+    ''' Every metric in the Prometheus text exposition format. '''
+    for fn in COLLECTORS:
+        fn()
+    lines = []
+    for name, metric in sorted(REGISTRY.items()):
+        lines.append('# HELP {0} {1}'.format(name, metric.help.replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE {0} {1}'.format(name, metric.kind))
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+    ''' Returns the current value of every metric as a plain dict. '''
+    return {name: metric.snapshot() for name, metric in REGISTRY.items()}
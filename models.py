@@ -6,9 +6,29 @@ Interfaces with the sqlite3 database.
 This is our "[M]odel" in the MVC architecture.
 '''
 
+import json
+import time
 import uuid
+import sqlite3
+import itertools
+import threading
+from collections import OrderedDict
 
+import conf
+import metrics
 import database
+from utils import RawJSON
+from accesslog import ACCESS_LOG
+
+
+# How many rows 'Model.iterate' pulls off the cursor at a time.
+ITERATE_BATCH_SIZE = 500
+
+# Rows per 'executemany' call in the ModelCollection bulk operations. Bulk
+# writes touching more rows than BULK_INVALIDATE_ROWS clear the whole query
+# cache instead of checking every cached query against every row.
+BULK_CHUNK_SIZE = 1000
+BULK_INVALIDATE_ROWS = 1000
 
 
 class Model(object):
@@ -23,53 +43,93 @@ class Model(object):
     fields = ['id', 'name', 'make', 'color', 'status', 'create_at', 'update_at']
     filterable = ['id', 'name', 'make', 'color', 'status', 'create_at', 'update_at']
     editable = ['make', 'color', 'status']
+    # Columns covered by the full text index (see 'search').
+    searchable = ['name', 'make', 'color', 'status']
+
+    # Secondary indexes on the 'models' table. Each entry is a tuple of columns,
+    # so composite indexes are just longer tuples. The 'status' index doubles as
+    # the index for 'status' + 'make' lookups (the left most column is usable
+    # on its own). These get created/dropped at startup by 'createIndexes'.
+    indexes = [
+        ('status', 'make'),
+        ('make',),
+        ('color',),
+        ('create_at',),
+        ('update_at',),
+    ]
+
+    # Indexes we manage all start with this prefix. Anything else on the
+    # table (such as the UNIQUE index for 'name') is left alone.
+    index_prefix = 'idx_models_'
+
+    # Each model is backed by a single tuple (in 'fields' order) instead of a dict.
+    # With '__slots__' there is no per-instance __dict__ either, which adds up
+    # quickly when we are loading the whole table. Queries select the columns in
+    # 'fields' order and use plain tuple rows (no row factory), so building a
+    # model is just wrapping the row the sqlite3 module already made.
+    __slots__ = ('_row', )
 
     def __init__(self, **kwargs):
-        self._data = kwargs
+        self._row = tuple(kwargs.get(field) for field in self.fields)
+
+    @classmethod
+    def fromRow(cls, row):
+        model = cls.__new__(cls)
+        model._row = row
+        return model
+
+    def _set(self, idx, value):
+        row = list(self._row)
+        row[idx] = value
+        self._row = tuple(row)
 
     def get(self, key):
-        if self._data:
-            return self._data.get(key)
+        if key in _FIELD_INDEX:
+            return self._row[_FIELD_INDEX[key]]
 
     @property
     def id(self):
-        return self.get('id')
+        return self._row[0]
 
     @property
     def name(self):
-        return self.get('name')
+        return self._row[1]
+
+    @name.setter
+    def name(self, value):
+        self._set(1, value)
 
     @property
     def make(self):
-        return self.get('make')
+        return self._row[2]
 
     @make.setter
     def make(self, value):
-        self._data['make'] = value
+        self._set(2, value)
 
     @property
     def color(self):
-        return self.get('color')
+        return self._row[3]
 
     @color.setter
     def color(self, value):
-        self._data['color'] = value
+        self._set(3, value)
 
     @property
     def status(self):
-        return self.get('status')
+        return self._row[4]
 
     @status.setter
     def status(self, value):
-        self._data['status'] = value
+        self._set(4, value)
 
     @property
     def create_at(self):
-        return self.get('create_at')
+        return self._row[5]
 
     @property
     def update_at(self):
-        return self.get('update_at')
+        return self._row[6]
 
     def save(self):
         '''
@@ -79,50 +139,98 @@ class Model(object):
         the database maintain control over DEFAULT values. According to the SQLite documentation 'RETURNING'
         is availble since version 3.35.0 (2021-03-12): https://www.sqlite.org/lang_returning.html
 
+        When it is available we use an UPSERT with 'RETURNING' so a save is a single statement.
+        Otherwise we fall back to a write followed by a SELECT (see database.SUPPORTS_RETURNING).
+
         https://github.com/sjsafranek/find5/blob/c8d5bbbcfb4b33f420a83f07025bad9727474ce3/findapi/lib/database/database.go#L113
         https://github.com/sjsafranek/find5/blob/c8d5bbbcfb4b33f420a83f07025bad9727474ce3/finddb_schema/base_schema/create_users_table.sql#L6
 
         '''
         # If the 'name' parameter is not supplied generate a random one.
-        if 'name' not in self._data or not self._data['name']:
-            self._data['name'] = str(uuid.uuid4())
+        if not self.name:
+            self.name = str(uuid.uuid4())
 
-        # Get cursor
-        with database.connect() as conn:
-            cursor = conn.cursor()
+        # All writes go through the database writer thread, which group
+        # commits them. We get our record back once it has been committed.
+        self._row = self._write(self._save)
 
-            # Determine if this is an INSERT or UPDATE.
-            # Always use parameter substitution to prevent SQL injection.
-            if self.exists(id=self.id):
-                args = (self.make, self.color, self.status, self.name, self.id)
-                cursor.execute(
-                    '''UPDATE models SET make = ?, color = ?, status = ?, name = ? WHERE id = ?;''', args)
-                # Get any changes
-                self._data = cursor.execute('''SELECT * FROM models WHERE id = ?;''', (self.id,)).fetchone()
-            else:
-                # I would prefer to use the new 'RETURNING' clause here
-                args = (self.make, self.color, self.status, self.name, )
-                cursor.execute(
-                    '''INSERT INTO models (make, color, status, name) VALUES (?, ?, ?, ?);''',
-                    args)
-                # Get new record
-                self._data = cursor.execute('''SELECT * FROM models WHERE rowid = ?;''', (cursor.lastrowid,)).fetchone()
-
-            # Commit changes
-            conn.commit()
+    def _save(self, cursor):
+        cursor.row_factory = None
+        # Always use parameter substitution to prevent SQL injection.
+        # The 'update_at' column used to be set by a trigger, which meant a second
+        # UPDATE for every write. Setting it here keeps it to a single write.
+        if database.SUPPORTS_RETURNING:
+            if self.id is None:
+                # Let the database generate the 'id' and DEFAULT values.
+                args = (self.name, self.make, self.color, self.status, )
+                return cursor.execute(
+                    '''INSERT INTO models (name, make, color, status) VALUES (?, ?, ?, ?) RETURNING {0};'''.format(COLUMNS),
+                    args).fetchone()
 
-    def delete(self):
-        with database.connect() as conn:
-            cursor = conn.cursor()
+            # Insert or update and get the record back in a single statement.
+            args = (self.id, self.name, self.make, self.color, self.status, )
+            return cursor.execute(
+                '''INSERT INTO models (id, name, make, color, status) VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO UPDATE SET
+                        name = excluded.name,
+                        make = excluded.make,
+                        color = excluded.color,
+                        status = excluded.status,
+                        update_at = CURRENT_TIMESTAMP
+                    RETURNING {0};'''.format(COLUMNS),
+                args).fetchone()
+
+        # Older versions of SQLite do not have 'RETURNING' so we need a
+        # second statement to read the record back.
+        if self.id is not None:
+            args = (self.make, self.color, self.status, self.name, self.id)
             cursor.execute(
-                '''DELETE FROM models WHERE id = ?;''', (self.id,))
-            conn.commit()
+                '''UPDATE models SET make = ?, color = ?, status = ?, name = ?, update_at = CURRENT_TIMESTAMP WHERE id = ?;''', args)
+            if cursor.rowcount:
+                return cursor.execute('''SELECT {0} FROM models WHERE id = ?;'''.format(COLUMNS), (self.id,)).fetchone()
 
-    @classmethod
-    def _fetch(cls, **kwargs):
+        # Keep the 'id' we were given, same as the UPSERT above.
+        args = (self.make, self.color, self.status, self.name, )
+        if self.id is None:
+            cursor.execute(
+                '''INSERT INTO models (make, color, status, name) VALUES (?, ?, ?, ?);''',
+                args)
+        else:
+            cursor.execute(
+                '''INSERT INTO models (make, color, status, name, id) VALUES (?, ?, ?, ?, ?);''',
+                args + (self.id, ))
+        return cursor.execute('''SELECT {0} FROM models WHERE rowid = ?;'''.format(COLUMNS), (cursor.lastrowid,)).fetchone()
+
+    def delete(self):
+        self._write(self._delete)
+
+    def _delete(self, cursor):
+        cursor.execute(
+            '''DELETE FROM models WHERE id = ?;''', (self.id,))
 
-        # Build query and collect filter params
-        query = '''SELECT * FROM models'''
+    def _write(self, fn):
+        ''' Runs a write through the database writer and tells the query cache
+            exactly which rows it changed.
+        '''
+        def op(cursor):
+            cursor.row_factory = None
+            before = database.tableVersion(cursor)
+            old = None
+            if self.id is not None:
+                old = cursor.execute(
+                    '''SELECT {0} FROM models WHERE id = ?;'''.format(COLUMNS), (self.id,)).fetchone()
+            row = fn(cursor)
+            return row, old, before, database.tableVersion(cursor)
+
+        row, old, before, after = database.write(op)
+        QUERY_CACHE.invalidate(before, after, old, row)
+        FRAGMENT_CACHE.invalidate(old, row)
+        CHANGE_FEED.notify()
+        return row
+
+    @classmethod
+    def _filters(cls, kwargs):
+        ''' Returns the WHERE clauses and parameters for the exact match filters. '''
         filters = []
         params = []
         for key, value in kwargs.items():
@@ -130,24 +238,331 @@ class Model(object):
             if key in cls.filterable:
                 filters.append('{0} = ?'.format(key))
                 params.append(value)
+
+        if len([f for f in filters if f]) != len([p for p in params if p]):
+            raise Value('WAT?!?!')
+        return filters, params
+
+    @classmethod
+    def _query(cls, limit=None, after=None, q=None, **kwargs):
+        ''' Builds the SELECT statement and its parameters for the given filters.
+
+            'limit' and 'after' page through the results using the rowid as a
+            keyset cursor. Every index on the table ends with the rowid, so
+            'WHERE ... AND rowid > ? ORDER BY rowid LIMIT ?' is a range scan no
+            matter how deep into the table we are (unlike OFFSET).
+
+            'q' narrows the results down to the models matching the search
+            text, in rowid order. Use 'search' to get them ranked.
+        '''
+        return cls._select(COLUMNS, None, limit, after, q, kwargs)
+
+    @classmethod
+    def _select(cls, columns, group_by, limit, after, q, kwargs):
+        ''' The query behind '_query'. 'columns' and 'group_by' go into the
+            SQL as is, so they are positional and never come from the
+            filters (which can be whatever a request sent).
+        '''
+        # The column name goes into the query so it has to be one of ours.
+        if group_by is not None and group_by not in cls.filterable:
+            raise ValueError('Can not group by {0!r}'.format(group_by))
+        query = '''SELECT {0} FROM models'''.format(columns)
+        filters, params = cls._filters(kwargs)
+
+        if q:
+            clause, args = cls._searchFilter(q)
+            if clause:
+                filters.append(clause)
+                params.extend(args)
+        if after is not None:
+            filters.append('rowid > ?')
+            params.append(int(after))
         if len(filters):
             query += ' WHERE ' + ' AND '.join(filters)
+        if group_by is not None:
+            query += ' GROUP BY {0}'.format(group_by)
+        if limit is not None or after is not None:
+            query += ' ORDER BY rowid'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(int(limit))
         query += ';'
 
-        if len([f for f in filters if f]) != len([p for p in params if p]):
-            raise Value('WAT?!?!')
+        return query, tuple(params)
 
+    @classmethod
+    def _fetch(cls, **kwargs):
+        ''' Returns the rows for the given filters. Plain filter queries go
+            through QUERY_CACHE, so the list may be shared. Don't modify it.
+        '''
+        query, params = cls._query(**kwargs)
+        return cls._cached(QUERY_CACHE.key(kwargs), query, params)
+
+    @classmethod
+    def _cached(cls, key, query, params):
+        ''' Runs a query through QUERY_CACHE (straight to the database when
+            'key' is None).
+        '''
         # Run query and return results
         with database.connect() as conn:
             cursor = conn.cursor()
-            return cursor.execute(
-                query, tuple(params)
-            ).fetchall()
+            cursor.row_factory = None
+            if key is None:
+                return cursor.execute(
+                    query, params
+                ).fetchall()
+
+            # Read the table version and the rows from the same snapshot, so
+            # the rows we cache really belong to that version.
+            cursor.execute('''BEGIN;''')
+            version = database.tableVersion(cursor)
+            rows = QUERY_CACHE.get(key, version)
+            if rows is None:
+                rows = cursor.execute(
+                    query, params
+                ).fetchall()
+                QUERY_CACHE.put(key, rows, version)
+            return rows
+
+    @classmethod
+    def _match(cls, q):
+        ''' Turns the search text into an FTS5 MATCH expression. Every word has
+            to appear somewhere in the searchable columns. Returns None when
+            the full text index can't answer the search.
+        '''
+        terms = q.split()
+        if not terms or not database.SEARCH_TOKENIZER:
+            return None
+        # Each word is quoted so the user can't sneak in FTS5 query syntax.
+        quoted = ['"{0}"'.format(term.replace('"', '""')) for term in terms]
+        if 'trigram' == database.SEARCH_TOKENIZER:
+            # Trigrams match any substring, but only of 3 characters or more.
+            if any(len(term) < 3 for term in terms):
+                return None
+            return ' '.join(quoted)
+        # Word tokenizer, the best we can do is match the start of words.
+        return ' '.join(term + '*' for term in quoted)
+
+    @classmethod
+    def _like(cls, q):
+        ''' Same as '_match' with LIKE, for when the index is no use. This
+            scans the whole table.
+        '''
+        clauses = []
+        params = []
+        for term in q.split():
+            pattern = '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+            clauses.append('(' + ' OR '.join(
+                "{0} LIKE ? ESCAPE '\\'".format(column) for column in cls.searchable) + ')')
+            params.extend([pattern] * len(cls.searchable))
+        return ' AND '.join(clauses), params
+
+    @classmethod
+    def _searchFilter(cls, q):
+        match = cls._match(q)
+        if match is None:
+            return cls._like(q)
+        return '''rowid IN (SELECT rowid FROM models_search WHERE models_search MATCH ?)''', [match]
+
+    @classmethod
+    def search(cls, q, limit=None, offset=0, **kwargs):
+        ''' Substring search over the 'searchable' columns, combined with the
+            usual exact match filters. Results are ranked by bm25 (best match
+            first) so pages are by offset rather than rowid. Returns the models
+            and the offset of the next page (None on the last page).
+
+            Words shorter than 3 characters can't use the trigram index and
+            fall back to an unranked LIKE scan.
+        '''
+        filters, params = cls._filters(kwargs)
+        match = cls._match(q)
+        if match is None:
+            clause, args = cls._like(q)
+            if clause:
+                filters.append(clause)
+                params.extend(args)
+            query = '''SELECT {0} FROM models'''.format(COLUMNS)
+            order = 'rowid'
+        else:
+            query = '''SELECT {0} FROM models
+                JOIN (SELECT rowid AS match_rowid, rank AS match_rank FROM models_search WHERE models_search MATCH ?)
+                ON models.rowid = match_rowid'''.format(
+                ', '.join('models.' + field for field in cls.fields))
+            params.insert(0, match)
+            order = 'match_rank, models.rowid'
+
+        if filters:
+            query += ' WHERE ' + ' AND '.join(filters)
+        query += ' ORDER BY ' + order
+        if limit is not None:
+            query += ' LIMIT ? OFFSET ?'
+            params.extend([int(limit), int(offset or 0)])
+        query += ';'
+
+        with database.connect() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            rows = cursor.execute(query, params).fetchall()
+        next = None
+        if limit is not None and rows and len(rows) == int(limit):
+            next = int(offset or 0) + len(rows)
+        return [Model.fromRow(row) for row in rows], next
+
+    @classmethod
+    def facets(cls, group_by, **kwargs):
+        ''' Counts the models matching the filters by the distinct values of
+            the 'group_by' column. Returns [(value, count)], biggest first.
+
+            The declared indexes cover the GROUP BY for 'status', 'make' and
+            'color', so SQLite counts straight off the index.
+        '''
+        # '_select' makes sure 'group_by' is one of our columns.
+        query, params = cls._select(
+            '{0}, count(*)'.format(group_by), group_by,
+            kwargs.get('limit'), kwargs.get('after'), kwargs.get('q'), kwargs)
+        rows = cls._cached(QUERY_CACHE.key(kwargs, 'facets:' + group_by), query, params)
+        return sorted(rows, key=lambda row: (-row[1], str(row[0])))
+
+    @classmethod
+    def page(cls, limit, after=None, **kwargs):
+        ''' Fetches a single page of models. Returns the models and the cursor
+            to pass as 'after' to get the next page (None on the last page).
+        '''
+        query, params = cls._select(
+            COLUMNS + ', rowid', None, limit, after, kwargs.get('q'), kwargs)
+        with database.connect() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            rows = cursor.execute(query, params).fetchall()
+        cursor = None
+        if rows and len(rows) == int(limit):
+            cursor = rows[-1][-1]
+        return [Model.fromRow(row[:-1]) for row in rows], cursor
+
+    @classmethod
+    def iterate(cls, **kwargs):
+        ''' Lazily yields models straight off the database cursor. Unlike 'fetch'
+            this never holds the whole result set in memory, which is what we
+            want for streaming large responses.
+
+            The rows come off a connection of its own (not one from the pool),
+            which stays open until the generator is exhausted (or closed). So
+            a slow client can take as long as it likes without holding up
+            everyone else, and it gets a consistent snapshot of the table.
+        '''
+        query, params = cls._query(**kwargs)
+        with database.connectDedicated() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(ITERATE_BATCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    yield Model.fromRow(row)
+
+    @classmethod
+    def explain(cls, **kwargs):
+        ''' Returns the 'EXPLAIN QUERY PLAN' output for the query 'fetch' would
+            run with the same filters. Handy for checking the indexes get used.
+        '''
+        query, params = cls._query(**kwargs)
+        with database.connect() as conn:
+            cursor = conn.cursor()
+            plan = [
+                dict(zip(row.keys(), row)) for row in cursor.execute(
+                    'EXPLAIN QUERY PLAN ' + query, params
+                ).fetchall()
+            ]
+        return {
+            'query': query,
+            'params': params,
+            'plan': plan
+        }
+
+    @classmethod
+    def changes(cls, since, limit=None):
+        ''' Reads the change feed (see database.createChangeLog) after 'since'.
+            Returns the changes, the 'seq' to ask for next time and whether
+            the client has to start over from a snapshot: the changes it
+            missed have been pruned, or it is ahead of us (a new database).
+
+            Each change is {'seq', 'op', 'id', 'model'} where 'op' is 'upsert'
+            (with the current 'model') or 'delete'.
+        '''
+        since = int(since)
+        with database.connect() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            # The log and the rows from the same snapshot.
+            cursor.execute('''BEGIN;''')
+            latest = database.lastChange(cursor)
+            if since < database.tableVersion(cursor, 'changes_pruned') or since > latest:
+                return [], latest, True
+
+            query = '''SELECT changes.seq, changes.op, changes.id, {0} FROM changes
+                LEFT JOIN models ON models.id = changes.id
+                WHERE changes.seq > ? ORDER BY changes.seq'''.format(
+                ', '.join('models.' + field for field in cls.fields))
+            params = [since]
+            if limit is not None:
+                query += ' LIMIT ?'
+                params.append(int(limit))
+            rows = cursor.execute(query + ';', params).fetchall()
+
+        changes = [{
+            'seq': row[0],
+            'op': row[1],
+            'id': row[2],
+            'model': dict(zip(cls.fields, row[3:])) if 'upsert' == row[1] else None
+        } for row in rows]
+        # Compaction leaves gaps, so unless there is more to come the client
+        # is up to date with 'latest'.
+        if limit is not None and len(rows) == int(limit):
+            latest = changes[-1]['seq']
+        return changes, latest, False
+
+    @classmethod
+    def version(cls):
+        ''' The current version of the 'models' table. It goes up with every
+            write, from any process.
+        '''
+        with database.connect() as conn:
+            return database.tableVersion(conn.cursor())
+
+    @classmethod
+    def indexName(cls, columns):
+        return cls.index_prefix + '_'.join(columns)
+
+    @classmethod
+    def createIndexes(cls):
+        ''' Creates any indexes declared in 'indexes' that don't exist yet and drops
+            the ones we manage that are no longer declared.
+        '''
+        wanted = {cls.indexName(columns): columns for columns in cls.indexes}
+        with database.connect() as conn:
+            cursor = conn.cursor()
+            existing = [
+                row['name'] for row in cursor.execute(
+                    '''SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'models' AND name LIKE ?;''',
+                    (cls.index_prefix + '%',)).fetchall()
+            ]
+            for name in existing:
+                if name not in wanted:
+                    cursor.execute('''DROP INDEX IF EXISTS "{0}";'''.format(name))
+            for name, columns in wanted.items():
+                if name not in existing:
+                    # Column names come from our own class attribute, never the user.
+                    cursor.execute('''CREATE INDEX IF NOT EXISTS "{0}" ON models ({1});'''.format(
+                        name, ', '.join(columns)))
+            conn.commit()
 
     @classmethod
     def fetch(cls, **kwargs):
+        fromRow = Model.fromRow
         return [
-            Model(**row) for row in cls._fetch(**kwargs)
+            fromRow(row) for row in cls._fetch(**kwargs)
         ]
 
     @classmethod
@@ -161,19 +576,625 @@ class Model(object):
             return 0 != row['exists']
 
     def toDict(self):
-        return self._data
+        return dict(zip(self.fields, self._row))
+
+    def toJSON(self):
+        ''' toDict as JSON (UTF-8), through FRAGMENT_CACHE. '''
+        return FRAGMENT_CACHE.encode([self._row])[0]
+
+    @classmethod
+    def listJSON(cls, models):
+        ''' A JSON array of the models (as RawJSON), put together from
+            FRAGMENT_CACHE instead of encoding every one of them.
+        '''
+        return RawJSON(b'[' + b', '.join(FRAGMENT_CACHE.encode([model._row for model in models])) + b']')
+
+
+# Column list in 'fields' order. Used instead of 'SELECT *' so the
+# row tuples always line up with Model._row.
+COLUMNS = ', '.join(Model.fields)
+
+_FIELD_INDEX = {field: idx for idx, field in enumerate(Model.fields)}
+
+
+class QueryCache(object):
+
+    ''' Read-through cache for the rows behind 'Model.fetch', keyed by the
+        normalized filters (order doesn't matter, anything that isn't a filter
+        is ignored).
+
+        Every lookup checks the 'models' table version (see database.migrate)
+        in the same read transaction as the query. If the version moved and
+        it wasn't one of our own writes (another worker process, the sqlite3
+        shell...), we can't know what changed and everything goes. Our own
+        saves and deletes report the rows they touched, so only the cached
+        queries those rows match are dropped.
+
+        Bounded by the number of queries and the total number of rows (least
+        recently used go first), and entries expire after 'ttl' seconds.
+    '''
+
+    def __init__(self, size=conf.MODEL_CACHE_SIZE, max_rows=conf.MODEL_CACHE_MAX_ROWS, ttl=conf.MODEL_CACHE_TTL):
+        self.size = size
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.version = None
+        # {key: (rows, expires)}
+        self._entries = OrderedDict()
+        self._rows = 0
+        self._lock = threading.Lock()
+
+    def key(self, kwargs, kind='fetch'):
+        ''' Returns the cache key for a set of 'fetch' arguments or None if
+            the query shouldn't be cached. 'kind' tells apart different
+            queries over the same filters (e.g. the facet counts).
+        '''
+        # Search results can't be checked against a changed row (see
+        # '_matches') so they aren't cached either.
+        if not self.size or any(k in kwargs for k in ['limit', 'after', 'q']):
+            return None
+        key = (kind, tuple(sorted(
+            (k, v) for k, v in kwargs.items() if k in Model.filterable)))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _drop(self, key):
+        rows, _ = self._entries.pop(key)
+        self._rows -= len(rows)
+
+    def _clear(self):
+        if self._entries:
+            cache_evictions.inc(len(self._entries), reason='version')
+        self._entries.clear()
+        self._rows = 0
+
+    def get(self, key, version):
+        with self._lock:
+            if version != self.version:
+                self._clear()
+                self.version = version
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.monotonic():
+                self._drop(key)
+                cache_evictions.inc(reason='ttl')
+                entry = None
+            if entry is None:
+                cache_misses.inc()
+                return None
+            self._entries.move_to_end(key)
+        cache_hits.inc()
+        return entry[0]
+
+    def put(self, key, rows, version):
+        with self._lock:
+            # The table changed while we were running the query.
+            if version != self.version or len(rows) > self.max_rows:
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (rows, time.monotonic() + self.ttl)
+            self._rows += len(rows)
+            while len(self._entries) > self.size or self._rows > self.max_rows:
+                self._drop(next(iter(self._entries)))
+                cache_evictions.inc(reason='size')
+
+    def invalidate(self, before, after, *rows):
+        ''' Called after one of our writes moved the table from version
+            'before' to 'after', changing 'rows' (old and new versions of the
+            row, None for a row that didn't exist).
+        '''
+        rows = [row for row in rows if row is not None]
+        with self._lock:
+            if before != self.version:
+                # We missed a change, the next lookup will start over.
+                return
+            self.version = after
+            for key in list(self._entries):
+                if any(self._matches(key, row) for row in rows):
+                    self._drop(key)
+                    cache_evictions.inc(reason='write')
+
+    def _matches(self, key, row):
+        for field, value in key[1]:
+            cell = row[_FIELD_INDEX[field]]
+            if value != cell and str(value) != str(cell):
+                return False
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+            self.version = None
+
+    def stats(self):
+        evictions = cache_evictions.snapshot()
+        with self._lock:
+            return {
+                'hits': cache_hits.snapshot(),
+                'misses': cache_misses.snapshot(),
+                'evictions': {key.split('=', 1)[1]: value for key, value in evictions.items()},
+                'entries': len(self._entries),
+                'rows': self._rows,
+                'version': self.version,
+                'size': self.size,
+                'ttl': self.ttl
+            }
+
+
+cache_hits = metrics.counter(
+    'model_cache_hits_total', 'Model.fetch queries answered from the cache')
+cache_misses = metrics.counter(
+    'model_cache_misses_total', 'Model.fetch queries that went to the database')
+cache_evictions = metrics.counter(
+    'model_cache_evictions_total', 'Cached queries dropped', ['reason'])
+
+QUERY_CACHE = QueryCache()
+
+
+class FragmentCache(object):
+
+    ''' The JSON for single models (toDict, encoded), so list responses can
+        join the bytes instead of encoding every row again (see
+        Model.listJSON).
+
+        Entries are keyed by id and only used for the exact row they were
+        made from, 'update_at' included. Checking 'update_at' alone isn't
+        enough, it only goes down to the second and the other workers write
+        too. Our own saves and deletes drop the entries for the rows they
+        touched right away.
+
+        Bounded by a rough count of the bytes held, least recently used go
+        first.
+    '''
+
+    # Rough size of an entry besides the JSON: the dict slot, the tuple and
+    # the row (usually shared with the query cache).
+    overhead = 200
+
+    def __init__(self, max_bytes=conf.FRAGMENT_CACHE_MB * 1024 * 1024):
+        self.max_bytes = max_bytes
+        # {id: (row, json)}
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def encode(self, rows):
+        ''' Returns the JSON for each row. '''
+        fields = Model.fields
+        if not self.max_bytes:
+            return [json.dumps(dict(zip(fields, row))).encode('utf-8') for row in rows]
+        out = []
+        missed = []
+        entries = self._entries
+        with self._lock:
+            for row in rows:
+                entry = entries.get(row[0])
+                if entry is not None and entry[0] == row:
+                    entries.move_to_end(row[0])
+                    out.append(entry[1])
+                else:
+                    missed.append(len(out))
+                    out.append(None)
+        if missed:
+            # Encode without holding the lock.
+            for i in missed:
+                out[i] = json.dumps(dict(zip(fields, rows[i]))).encode('utf-8')
+            with self._lock:
+                for i in missed:
+                    self._put(rows[i], out[i])
+                while self._bytes > self.max_bytes:
+                    self._drop(next(iter(entries)))
+                    fragment_evictions.inc(reason='size')
+            fragment_misses.inc(len(missed))
+        if len(rows) > len(missed):
+            fragment_hits.inc(len(rows) - len(missed))
+        return out
+
+    def _put(self, row, fragment):
+        if row[0] in self._entries:
+            self._drop(row[0])
+        self._entries[row[0]] = (row, fragment)
+        self._bytes += len(fragment) + self.overhead
+
+    def _drop(self, id):
+        _, fragment = self._entries.pop(id)
+        self._bytes -= len(fragment) + self.overhead
+
+    def invalidate(self, *rows):
+        ''' Drops the entries for rows that were changed or deleted. '''
+        with self._lock:
+            for row in rows:
+                if row is not None and row[0] in self._entries:
+                    self._drop(row[0])
+                    fragment_evictions.inc(reason='write')
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        hits = fragment_hits.snapshot()
+        misses = fragment_misses.snapshot()
+        evictions = fragment_evictions.snapshot()
+        with self._lock:
+            return {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0.0,
+                'evictions': {key.split('=', 1)[1]: value for key, value in evictions.items()},
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes
+            }
+
+
+fragment_hits = metrics.counter(
+    'model_json_cache_hits_total', 'Models whose JSON came from the cache')
+fragment_misses = metrics.counter(
+    'model_json_cache_misses_total', 'Models that had to be encoded')
+fragment_evictions = metrics.counter(
+    'model_json_cache_evictions_total', 'Cached JSON dropped', ['reason'])
+
+FRAGMENT_CACHE = FragmentCache()
+
+
+class ChangeFeed(object):
+
+    ''' Lets requests wait for new changes (the long-polls and event streams
+        in server.py) and prunes the change log in the background.
+
+        Our own writes wake the waiting requests right away. Writes from other
+        processes (the other workers) are picked up by checking every 'poll'
+        seconds, which is a single row lookup.
+    '''
+
+    def __init__(self, poll=conf.CHANGES_POLL_INTERVAL, streams=conf.CHANGES_MAX_STREAMS):
+        self.poll = poll
+        self.closed = False
+        self._generation = 0
+        self._cond = threading.Condition()
+        self._streams = threading.BoundedSemaphore(streams)
+        self._stop = threading.Event()
+        self._pruner = None
+
+    def notify(self):
+        with self._cond:
+            self._generation += 1
+            self._cond.notify_all()
+
+    def latest(self):
+        with database.connect() as conn:
+            return database.lastChange(conn.cursor())
+
+    def wait(self, since, timeout):
+        ''' Waits up to 'timeout' seconds for a change after 'since'. Returns
+            whether there is one.
+        '''
+        deadline = time.monotonic() + timeout
+        while not self.closed:
+            with self._cond:
+                generation = self._generation
+            if self.latest() > since:
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            with self._cond:
+                # Don't sleep through a write that happened since we looked.
+                if generation == self._generation and not self.closed:
+                    self._cond.wait(min(self.poll, remaining))
+        return False
+
+    def acquire(self):
+        ''' Takes one of the waiting request slots. Returns False when they
+            are all taken.
+        '''
+        return self._streams.acquire(blocking=False)
+
+    def release(self):
+        self._streams.release()
+
+    def start(self, interval=conf.CHANGES_PRUNE_INTERVAL):
+        ''' Starts pruning the log every 'interval' seconds. '''
+        if self._pruner is not None and self._pruner.is_alive():
+            return
+        self.closed = False
+        self._stop.clear()
+        self._pruner = threading.Thread(target=self._prune, args=(interval,), daemon=True)
+        self._pruner.start()
+
+    def _prune(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                database.write(
+                    database.pruneChanges, conf.CHANGES_RETENTION, conf.CHANGES_MAX_ROWS)
+            except Exception as e:
+                ACCESS_LOG.write(
+                    level='error',
+                    message='unable to prune the change log',
+                    error=str(e))
+
+    def close(self):
+        ''' Wakes up everything that is waiting, e.g. when shutting down. '''
+        self.closed = True
+        self._stop.set()
+        self.notify()
+
+
+CHANGE_FEED = ChangeFeed()
+
+
+class _Rollback(Exception):
+    ''' Raised inside a write to throw the whole thing away. '''
+    pass
 
 
 class ModelCollection(object):
     ''' Helper class for doing bulk operations.
-        This is mainly for future proofing.
+
+        Each bulk operation is a single write (so a single transaction) and
+        the rows go in with 'executemany', BULK_CHUNK_SIZE at a time. One bad
+        row doesn't sink the rest: if a chunk fails, its rows are retried one
+        at a time to find the culprit. Results come back per item, either the
+        Model or the exception for that item.
     '''
 
+    # The columns a bulk update writes when not told otherwise.
+    updatable = ['name'] + Model.editable
+
     def __init__(self, models):
         self.collection = models
 
     def toDict(self):
         return [item.toDict() for item in self.collection]
 
+    def toJSON(self):
+        return Model.listJSON(self.collection)
+
+    def create(self):
+        return self.batch([('create', model, None) for model in self.collection])
+
+    def update(self, fields=None):
+        ''' Writes 'fields' (default 'updatable') of every model. '''
+        return self.batch([('update', model, fields) for model in self.collection])
+
+    def delete(self):
+        return self.batch([('delete', model, None) for model in self.collection])
+
+    @classmethod
+    def batch(cls, operations):
+        ''' Runs a list of (action, model, fields) operations in a single
+            transaction, where action is 'create', 'update' or 'delete' and
+            'fields' is only used for updates. Runs of the same action are
+            done together.
+        '''
+        def op(cursor):
+            cursor.row_factory = None
+            before = database.tableVersion(cursor)
+            results = []
+            changed = []
+            for action, group in itertools.groupby(operations, key=lambda o: o[0]):
+                group = list(group)
+                if 'create' == action:
+                    results += cls._create(cursor, [o[1] for o in group], changed)
+                elif 'update' == action:
+                    results += cls._update(cursor, [(o[1], o[2]) for o in group], changed)
+                elif 'delete' == action:
+                    results += cls._delete(cursor, [o[1] for o in group], changed)
+                else:
+                    results += [ValueError('Unknown action {0!r}'.format(action))] * len(group)
+            return results, changed, before, database.tableVersion(cursor)
+
+        results, changed, before, after = database.write(op)
+        FRAGMENT_CACHE.invalidate(*changed)
+        if len(changed) <= BULK_INVALIDATE_ROWS:
+            QUERY_CACHE.invalidate(before, after, *changed)
+        else:
+            # Quicker to start over than to check every cached query.
+            QUERY_CACHE.clear()
+        CHANGE_FEED.notify()
+        return results
+
+    @staticmethod
+    def _executemany(cursor, query, rows):
+        ''' Runs 'query' for every row. Returns a list with None for the rows
+            that made it and the exception for the ones that didn't.
+        '''
+        errors = [None] * len(rows)
+        for start in range(0, len(rows), BULK_CHUNK_SIZE):
+            chunk = rows[start:start + BULK_CHUNK_SIZE]
+            cursor.execute('''SAVEPOINT bulk_chunk;''')
+            try:
+                cursor.executemany(query, chunk)
+            except sqlite3.Error:
+                cursor.execute('''ROLLBACK TO bulk_chunk;''')
+                for i, row in enumerate(chunk):
+                    cursor.execute('''SAVEPOINT bulk_row;''')
+                    try:
+                        cursor.execute(query, row)
+                    except sqlite3.Error as e:
+                        cursor.execute('''ROLLBACK TO bulk_row;''')
+                        errors[start + i] = e
+                    cursor.execute('''RELEASE bulk_row;''')
+            cursor.execute('''RELEASE bulk_chunk;''')
+        return errors
+
+    # What 'load' does with a row whose 'name' is already taken.
+    CONFLICT_POLICIES = ['fail', 'skip', 'update']
+
+    # The columns 'load' takes, in order.
+    loadable = ['id', 'name', 'make', 'color', 'status', 'create_at', 'update_at']
+
+    @classmethod
+    def load(cls, rows, on_conflict='fail'):
+        ''' Inserts a chunk of rows (tuples in 'loadable' order) in a single
+            transaction with 'executemany', for bulk imports. Rows without an
+            'id', 'name' or timestamps get the same defaults as 'save' would.
+
+            'on_conflict' decides what happens when the 'name' is taken:
+            'skip' leaves the existing model alone, 'update' overwrites its
+            make, color and status and 'fail' rolls back the whole chunk.
+
+            Returns (inserted, updated, skipped, errors) where errors is a list
+            of (index, exception) for the rows that didn't make it. With 'fail'
+            the chunk is only written when there are no errors.
+        '''
+        if on_conflict not in cls.CONFLICT_POLICIES:
+            raise ValueError('on_conflict must be one of {0}'.format(', '.join(cls.CONFLICT_POLICIES)))
+        if 'update' == on_conflict and not database.SUPPORTS_UPSERT:
+            raise ValueError("on_conflict 'update' needs SQLite 3.24.0 or newer")
+
+        # Fill in the defaults here so every row has the same parameters.
+        rows = [
+            (row[0] or str(uuid.uuid4()), row[1] or str(uuid.uuid4())) + tuple(row[2:])
+            for row in rows]
+        query = '''INSERT {0} INTO models (id, name, make, color, status, create_at, update_at)
+            VALUES (?, ?, ?, ?, ?, coalesce(?, CURRENT_TIMESTAMP), coalesce(?, CURRENT_TIMESTAMP)){1};'''.format(
+            'OR IGNORE' if 'skip' == on_conflict else '',
+            ''' ON CONFLICT (name) DO UPDATE SET
+                make = excluded.make,
+                color = excluded.color,
+                status = excluded.status,
+                update_at = excluded.update_at''' if 'update' == on_conflict else '')
+
+        def op(cursor):
+            cursor.row_factory = None
+            last = cursor.execute('''SELECT max(rowid) FROM models;''').fetchone()[0] or 0
+            errors = cls._executemany(cursor, query, rows)
+            if 'fail' == on_conflict and any(errors):
+                # Throwing away the whole write rolls the chunk back.
+                raise _Rollback(errors)
+            inserted = cursor.execute(
+                '''SELECT count(*) FROM models WHERE rowid > ?;''', (last,)).fetchone()[0]
+            return inserted, errors
+
+        try:
+            inserted, errors = database.write(op)
+        except _Rollback as e:
+            errors = e.args[0]
+            return 0, 0, 0, [(i, error) for i, error in enumerate(errors) if error is not None]
+
+        # Far too many rows to check the cached queries one by one.
+        QUERY_CACHE.clear()
+        CHANGE_FEED.notify()
+        errors = [(i, error) for i, error in enumerate(errors) if error is not None]
+        written = len(rows) - len(errors) - inserted
+        if 'update' == on_conflict:
+            return inserted, written, 0, errors
+        return inserted, 0, written, errors
+
+    @staticmethod
+    def _select(cursor, ids):
+        ''' Returns {id: row} for the given ids. '''
+        rows = {}
+        ids = list(ids)
+        # Stay well under SQLite's limit on the number of parameters.
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            for row in cursor.execute(
+                    '''SELECT {0} FROM models WHERE id IN ({1});'''.format(
+                        COLUMNS, ', '.join('?' * len(chunk))), chunk):
+                rows[row[0]] = row
+        return rows
+
+    @classmethod
+    def _create(cls, cursor, models, changed):
+        # The ids are generated up front (instead of by the column DEFAULT)
+        # so we can find the new rows again without a RETURNING per row.
+        for model in models:
+            if model.id is None:
+                model._set(0, str(uuid.uuid4()))
+            if not model.name:
+                model.name = str(uuid.uuid4())
+        # New rows get a rowid past the current largest one, so one range
+        # scan reads them all back. Nobody else can write in the meantime.
+        last = cursor.execute('''SELECT max(rowid) FROM models;''').fetchone()[0] or 0
+        errors = cls._executemany(
+            cursor,
+            '''INSERT INTO models (id, name, make, color, status) VALUES (?, ?, ?, ?, ?);''',
+            [(m.id, m.name, m.make, m.color, m.status) for m in models])
+        saved = {
+            row[0]: row for row in cursor.execute(
+                '''SELECT {0} FROM models WHERE rowid > ?;'''.format(COLUMNS), (last,))
+        }
+        missing = [m.id for m, e in zip(models, errors) if e is None and m.id not in saved]
+        if missing:
+            # The rowids ran out and SQLite started picking random ones.
+            saved.update(cls._select(cursor, missing))
+
+        results = []
+        for model, error in zip(models, errors):
+            if error is None:
+                model._row = saved[model.id]
+                changed.append(model._row)
+                results.append(model)
+            else:
+                results.append(error)
+        return results
+
+    @classmethod
+    def _update(cls, cursor, items, changed):
+        existing = cls._select(cursor, [model.id for model, _ in items])
+        results = [None] * len(items)
+
+        # One statement per set of columns being written.
+        groups = {}
+        for i, (model, fields) in enumerate(items):
+            if model.id not in existing:
+                results[i] = LookupError('Model {0} not found'.format(model.id))
+                continue
+            # None means every column, an empty list means there is nothing to write.
+            fields = tuple(f for f in cls.updatable if fields is None or f in fields)
+            groups.setdefault(fields, []).append(i)
+
+        for fields, indexes in groups.items():
+            if not fields:
+                continue
+            errors = cls._executemany(
+                cursor,
+                '''UPDATE models SET {0}, update_at = CURRENT_TIMESTAMP WHERE id = ?;'''.format(
+                    ', '.join('{0} = ?'.format(f) for f in fields)),
+                [tuple(items[i][0].get(f) for f in fields) + (items[i][0].id,) for i in indexes])
+            for i, error in zip(indexes, errors):
+                results[i] = error
+
+        saved = cls._select(cursor, [model.id for (model, _), r in zip(items, results) if r is None])
+        for i, (model, _) in enumerate(items):
+            if results[i] is None:
+                changed.append(existing[model.id])
+                model._row = saved[model.id]
+                changed.append(model._row)
+                results[i] = model
+        return results
+
+    @classmethod
+    def _delete(cls, cursor, models, changed):
+        existing = cls._select(cursor, [model.id for model in models])
+        found = [model for model in models if model.id in existing]
+        errors = dict(zip(
+            [model.id for model in found],
+            cls._executemany(
+                cursor, '''DELETE FROM models WHERE id = ?;''', [(model.id,) for model in found])))
+
+        results = []
+        for model in models:
+            if model.id not in existing:
+                results.append(LookupError('Model {0} not found'.format(model.id)))
+            elif errors[model.id] is not None:
+                results.append(errors[model.id])
+            else:
+                changed.append(existing[model.id])
+                model._row = existing[model.id]
+                results.append(model)
+        return results
+
+
+# Make sure the declared indexes are in place.
+Model.createIndexes()
+
 
 #
@@ -0,0 +1,354 @@
+#!/usr/bin/python3
+
+'''
+Pre-forked worker processes.
+
+The supervisor (the process started from main.py) sets everything up once,
+including the database initialization, and then forks the workers. Every
+worker opens its own listening socket on the same port with 'SO_REUSEPORT'
+and the kernel spreads the incoming connections between them.
+
+    SIGTERM / SIGINT    stop all the workers and exit
+    SIGHUP              rolling reload, the workers are replaced one at a time
+                        and a replacement has to be listening before the old
+                        worker is stopped
+
+Crashed workers are restarted, with a backoff if they keep crashing right away.
+Note a reload forks from the supervisor, so code changes still need a restart.
+
+Each worker keeps its counters (open connections, requests...) in a table in
+shared memory so any of them can report on all of them, see 'stats()'.
+'''
+
+import os
+import sys
+import time
+import ctypes
+import signal
+import socket
+import threading
+import traceback
+from multiprocessing.sharedctypes import RawArray
+
+import conf
+import database
+
+
+# Columns of a worker's row in the shared table.
+FIELDS = ['pid', 'state', 'open', 'busy', 'connections', 'requests', 'started']
+PID, STATE, OPEN, BUSY, CONNECTIONS, REQUESTS, STARTED = range(len(FIELDS))
+
+STATES = ['free', 'starting', 'ready', 'stopping']
+FREE, STARTING, READY, STOPPING = range(len(STATES))
+
+
+class WorkerTable(object):
+
+    ''' Per worker counters in shared memory. Each worker only updates its own
+        row (the lock only has to cover the threads of that worker), the
+        supervisor sets the 'pid' and 'state' columns.
+    '''
+
+    def __init__(self, slots):
+        self.slots = slots
+        self._values = RawArray(ctypes.c_longlong, slots * len(FIELDS))
+        self._lock = threading.Lock()
+
+    def get(self, slot, field):
+        return self._values[slot * len(FIELDS) + field]
+
+    def set(self, slot, field, value):
+        self._values[slot * len(FIELDS) + field] = value
+
+    def inc(self, slot, field, value=1):
+        with self._lock:
+            self._values[slot * len(FIELDS) + field] += value
+
+    def reset(self, slot):
+        for field in range(len(FIELDS)):
+            self.set(slot, field, 0)
+
+    def free(self):
+        ''' Returns the first unused slot or None. '''
+        for slot in range(self.slots):
+            if FREE == self.get(slot, STATE):
+                return slot
+        return None
+
+    def snapshot(self):
+        workers = []
+        for slot in range(self.slots):
+            row = self._values[slot * len(FIELDS):(slot + 1) * len(FIELDS)]
+            if FREE == row[STATE]:
+                continue
+            worker = dict(zip(FIELDS, row))
+            worker['slot'] = slot
+            worker['state'] = STATES[row[STATE]]
+            workers.append(worker)
+        return workers
+
+
+# Set up by the supervisor, 'slot' is this worker's row in the table.
+table = None
+slot = None
+
+
+def connectionOpened():
+    if slot is not None:
+        table.inc(slot, OPEN)
+        table.inc(slot, CONNECTIONS)
+
+
+def connectionClosed():
+    if slot is not None:
+        table.inc(slot, OPEN, -1)
+
+
+def requestStarted():
+    if slot is not None:
+        table.inc(slot, BUSY)
+        table.inc(slot, REQUESTS)
+
+
+def requestFinished():
+    if slot is not None:
+        table.inc(slot, BUSY, -1)
+
+
+def drain(grace=conf.WORKER_SHUTDOWN_GRACE):
+    ''' Waits (up to 'grace' seconds) for this worker's in flight requests. '''
+    if slot is None:
+        return
+    deadline = time.monotonic() + grace
+    while table.get(slot, BUSY) > 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def stats():
+    ''' Returns the counters of every worker, None when not pre-forked. '''
+    if table is None:
+        return None
+    return table.snapshot()
+
+
+def listen(host, port):
+    return socket.create_server(
+        (host, port), backlog=conf.HTTP_BACKLOG, reuse_port=True)
+
+
+class Supervisor(object):
+
+    def __init__(self, host, port, workers, engine='threading'):
+        self.host = host
+        self.port = port
+        self.size = workers
+        self.engine = engine
+        # Twice the slots, so every worker can have its replacement starting
+        # while it is being stopped.
+        self.table = WorkerTable(workers * 2)
+        self.workers = {}
+        self.retiring = {}
+        self.respawn = []
+        self.backoff = 0
+        self.stopping = False
+        self.reloading = False
+        self.pid = os.getpid()
+
+    def log(self, message, *args):
+        print('[supervisor] ' + message.format(*args))
+        sys.stdout.flush()
+
+    def spawn(self):
+        global table, slot
+        index = self.table.free()
+        if index is None:
+            return None
+        self.table.reset(index)
+        self.table.set(index, STATE, STARTING)
+        self.table.set(index, STARTED, int(time.time()))
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        pid = os.fork()
+        if 0 == pid:
+            code = 0
+            try:
+                table, slot = self.table, index
+                self.work()
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+
+        self.table.set(index, PID, pid)
+        self.workers[pid] = index
+        self.log('Started worker {0} (pid {1})', index, pid)
+        return pid
+
+    def work(self):
+        ''' Runs in the worker process. '''
+        # The supervisor decides when we stop, a Ctrl-C in the terminal
+        # reaches it too and it will send us a SIGTERM.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, _interrupt)
+        threading.Thread(target=_watchParent, args=(self.pid,), daemon=True).start()
+
+        sock = listen(self.host, self.port)
+        self.table.set(slot, PID, os.getpid())
+        self.table.set(slot, STATE, READY)
+        if 'asyncio' == self.engine:
+            import async_server
+            async_server.start(self.host, self.port, sock=sock)
+        else:
+            import server
+            server.start(self.host, self.port, sock=sock)
+
+    def stop(self, pid, grace=conf.WORKER_SHUTDOWN_GRACE):
+        self.table.set(self.workers[pid], STATE, STOPPING)
+        self.retiring[pid] = time.monotonic() + grace + 5
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if 0 == pid:
+                break
+            index = self.workers.pop(pid, None)
+            if index is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            retired = self.retiring.pop(pid, None) is not None
+            lived = time.time() - self.table.get(index, STARTED)
+            self.table.reset(index)
+            if retired or self.stopping:
+                self.log('Worker {0} (pid {1}) stopped', index, pid)
+                continue
+
+            # Back off when workers keep dying right after starting, e.g. the
+            # port is taken or the database is broken.
+            if lived < 5:
+                self.backoff = min(max(self.backoff * 2, 1), conf.WORKER_RESTART_BACKOFF_MAX)
+            else:
+                self.backoff = 0
+            self.log('Worker {0} (pid {1}) exited with {2}, restarting in {3}s',
+                     index, pid, code, self.backoff)
+            self.respawn.append(time.monotonic() + self.backoff)
+
+        # Workers that ignore the SIGTERM for too long.
+        now = time.monotonic()
+        for pid, deadline in list(self.retiring.items()):
+            if now > deadline:
+                self.log('Killing worker (pid {0})', pid)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                self.retiring[pid] = now + 5
+
+    def tick(self):
+        self.reap()
+        now = time.monotonic()
+        for when in list(self.respawn):
+            if when <= now and self.spawn():
+                self.respawn.remove(when)
+
+    def wait(self, predicate, timeout):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if self.stopping or time.monotonic() > deadline:
+                return False
+            self.tick()
+            time.sleep(0.05)
+        return True
+
+    def reload(self):
+        ''' Replaces the workers one at a time. '''
+        self.log('Reloading {0} workers', len(self.workers))
+        for pid in [pid for pid in self.workers if pid not in self.retiring]:
+            if pid not in self.workers:
+                continue
+            if not self.wait(lambda: self.table.free() is not None, conf.WORKER_READY_TIMEOUT):
+                break
+            new = self.spawn()
+            index = self.workers[new]
+            ready = self.wait(
+                lambda: new not in self.workers or READY == self.table.get(index, STATE),
+                conf.WORKER_READY_TIMEOUT)
+            if not ready or new not in self.workers:
+                # Keep the old workers, the new code is broken.
+                self.log('Worker {0} (pid {1}) did not start, aborting the reload', index, new)
+                if new in self.workers:
+                    self.stop(new)
+                return
+            if pid in self.workers:
+                self.stop(pid)
+        self.log('Reload done')
+
+    def shutdown(self):
+        for pid in list(self.workers):
+            if pid not in self.retiring:
+                self.stop(pid)
+        while self.workers:
+            self.reap()
+            time.sleep(0.05)
+
+    def run(self):
+        # The database was set up when 'server' was imported (database.py and
+        # models.py do it at import time), so it happened exactly once, right
+        # here. Close our connections so none get shared with the workers.
+        database.close()
+
+        def onStop(signum, frame):
+            self.stopping = True
+
+        def onReload(signum, frame):
+            self.reloading = True
+
+        signal.signal(signal.SIGTERM, onStop)
+        signal.signal(signal.SIGINT, onStop)
+        signal.signal(signal.SIGHUP, onReload)
+
+        print("Starting server at http://{0}:{1} with {2} workers".format(
+            self.host, self.port, self.size))
+        for _ in range(self.size):
+            self.spawn()
+
+        while not self.stopping:
+            self.tick()
+            if self.reloading:
+                self.reloading = False
+                self.reload()
+            time.sleep(0.2)
+
+        self.log('Stopping {0} workers', len(self.workers))
+        self.shutdown()
+        print("Server stopped")
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _watchParent(pid):
+    ''' Stops the worker if the supervisor went away (e.g. it got a SIGKILL),
+        otherwise we'd keep serving on the port forever.
+    '''
+    while os.getppid() == pid:
+        time.sleep(1)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def start(host='localhost', port=8080, workers=2, engine='threading'):
+    Supervisor(host, port, workers, engine).run()
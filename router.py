@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+
+'''
+URL routing for the Controller.
+
+Routes are registered as a method plus a path template:
+
+    ROUTES.add('GET', '/api/v1/model/{id}', Controller.apiModelHandler)
+    ROUTES.add('GET', '/static/{path:path}', Controller.staticHandler)
+
+Captures are '{name}' or '{name:type}' where the type is one of 'str' (the
+default, a single segment), 'int' or 'path' (the rest of the url, only as the
+last segment). The templates are compiled into a trie on the path segments,
+and paths without captures also go in a plain dict so the common case is a
+single lookup.
+'''
+
+import json
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+from urllib.parse import parse_qs
+
+
+def _str(value):
+    if not value:
+        raise ValueError(value)
+    return value
+
+
+CONVERTERS = {
+    'str': _str,
+    'int': int,
+    'path': _str,
+}
+
+
+class Node(object):
+
+    __slots__ = ('children', 'captures', 'rest', 'handlers', 'template')
+
+    def __init__(self):
+        # Static segments, {segment: Node}
+        self.children = {}
+        # Single segment captures, [(name, converter, Node)]
+        self.captures = []
+        # A trailing 'path' capture, (name, Node)
+        self.rest = None
+        # {method: handler} for routes ending here
+        self.handlers = {}
+        # The template of the routes ending here
+        self.template = None
+
+
+class Router(object):
+
+    def __init__(self):
+        self.root = Node()
+        self.static = {}
+        self.routes = []
+
+    def add(self, methods, template, handler):
+        ''' Registers 'handler' for the given method(s) and path template. '''
+        if isinstance(methods, str):
+            methods = [methods]
+        self.routes.append((tuple(methods), template, handler))
+
+        segments = template.strip('/').split('/') if '/' != template else []
+        if not any(segment.startswith('{') for segment in segments):
+            static = self.static.setdefault(template, Node())
+            static.template = template
+            for method in methods:
+                static.handlers[method] = handler
+
+        node = self.root
+        for i, segment in enumerate(segments):
+            if not segment.startswith('{'):
+                node = node.children.setdefault(segment, Node())
+                continue
+
+            name, _, kind = segment[1:-1].partition(':')
+            kind = kind or 'str'
+            if kind not in CONVERTERS:
+                raise ValueError('Unknown capture type {0!r} in {1}'.format(kind, template))
+            if 'path' == kind:
+                if i != len(segments) - 1:
+                    raise ValueError('Path captures must come last in {0}'.format(template))
+                if node.rest is None:
+                    node.rest = (name, Node())
+                node.rest[1].template = template
+                for method in methods:
+                    node.rest[1].handlers[method] = handler
+                return
+
+            for capture in node.captures:
+                if capture[0] == name and capture[1] is CONVERTERS[kind]:
+                    node = capture[2]
+                    break
+            else:
+                child = Node()
+                node.captures.append((name, CONVERTERS[kind], child))
+                node = child
+
+        node.template = template
+        for method in methods:
+            node.handlers[method] = handler
+
+    def route(self, methods, template):
+        ''' Decorator version of 'add'. '''
+        def decorator(handler):
+            self.add(methods, template, handler)
+            return handler
+        return decorator
+
+    def _search(self, node, segments, i, captures):
+        ''' Walks the trie, static segments win over captures. Returns the
+            node of the matching route or None.
+        '''
+        if i == len(segments):
+            return node if node.handlers else None
+
+        segment = segments[i]
+        child = node.children.get(segment)
+        if child is not None:
+            found = self._search(child, segments, i + 1, captures)
+            if found is not None:
+                return found
+
+        for name, converter, child in node.captures:
+            try:
+                value = converter(unquote(segment))
+            except ValueError:
+                continue
+            captures[name] = value
+            found = self._search(child, segments, i + 1, captures)
+            if found is not None:
+                return found
+            del captures[name]
+
+        if node.rest is not None:
+            rest = unquote('/'.join(segments[i:]))
+            if rest:
+                captures[node.rest[0]] = rest
+                return node.rest[1]
+        return None
+
+    def match(self, method, path):
+        ''' Returns (handler, captures, allowed, template). The handler is None
+            when nothing matched, 'allowed' lists the methods the path does
+            support (empty for a 404). 'template' is the matched route's
+            template (None for a 404), handy for labelling metrics.
+        '''
+        captures = {}
+        node = self.static.get(path)
+        if node is None:
+            segments = path.strip('/').split('/') if '/' != path else []
+            node = self._search(self.root, segments, 0, captures)
+            if node is None:
+                return None, captures, [], None
+
+        handlers = node.handlers
+        handler = handlers.get(method)
+        if handler is None and 'HEAD' == method:
+            handler = handlers.get('GET')
+        return handler, captures, sorted(handlers), node.template
+
+
+def _cached(fn):
+    ''' Like functools.cached_property, without the lock. A RequestContext
+        only ever belongs to one thread.
+    '''
+    name = fn.__name__
+
+    def getter(self):
+        try:
+            return self._cache[name]
+        except KeyError:
+            value = self._cache[name] = fn(self)
+            return value
+    return property(getter, doc=fn.__doc__)
+
+
+class RequestContext(object):
+
+    ''' Everything parsed out of a request, each part parsed at most once. '''
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.captures = {}
+        self._cache = {}
+
+    @_cached
+    def url(self):
+        return urlsplit(self.handler.path)
+
+    @property
+    def path(self):
+        return self.url.path
+
+    @_cached
+    def args(self):
+        ''' Parses url query string parameters '''
+        params = parse_qs(self.url.query)
+        return {
+            k: v[0] for k, v in params.items() if v is not None
+        }
+
+    @property
+    def content_type(self):
+        return self.handler.headers.get('content-type')
+
+    @_cached
+    def form(self):
+        ''' Parses forms contained in the request body '''
+        if 'application/x-www-form-urlencoded' == self.content_type:
+            body = self.handler.body
+            if body:
+                params = parse_qs(body)
+                return {
+                    k.decode(): v[0].decode() for k,
+                    v in params.items() if v is not None}
+        return {}
+
+    @_cached
+    def json(self):
+        ''' Parses JSON payloads contained in the request body '''
+        if 'application/json' == self.content_type:
+            body = self.handler.body
+            if body:
+                try:
+                    return json.loads(body)
+                except BaseException:
+                    return {}
+        return {}
+
+    @_cached
+    def params(self):
+        ''' This merges parameters sent via different methods (JSON, form and query string).
+            We will prioritize data sent within the request body, and values captured
+            from the url path win over everything.
+        '''
+        data = self.json
+        return {
+            **self.args,
+            **self.form,
+            **(data.get('params', {}) if isinstance(data, dict) else {}),
+            **self.captures
+        }
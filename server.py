@@ -6,18 +6,16 @@ Web server to accept incomming HTTP requests.
 This will constitute as our "[C]ontroller" in the MVC architecture.
 '''
 
-import re
 import os
 import sys
 import json
 import time
+import base64
+import hashlib
 import signal
 import sqlite3
 import os.path
-from urllib.parse import quote
 from urllib.parse import unquote
-from urllib.parse import urlparse
-from urllib.parse import parse_qs
 from http.server import HTTPServer
 from http.server import BaseHTTPRequestHandler
 from socketserver import ThreadingMixIn
@@ -26,16 +24,91 @@ from socketserver import ThreadingMixIn
 # might try to utilize it.
 
 
+import conf
+import static
+import metrics
+import prefork
+import database
+import transfer
+import compression
+import templates
 from models import Model
-from utils import getMimeTypeFromFile
+from models import ModelCollection
+from models import QUERY_CACHE
+from models import FRAGMENT_CACHE
+from models import CHANGE_FEED
+from router import Router
+from router import RequestContext
+from utils import dumps
+from utils import acceptsEncoding
+from utils import etagMatches
+from utils import parseAcceptEncoding
+from accesslog import ACCESS_LOG
+from accesslog import CAPTURE
 
 
 VERSION = '0.0.1'
 
 START_TIME = time.time()
 
-
-# TODO: load templates up on start up.
+# Metadata for the files under 'static/' (see static.py).
+STATIC_FILES = static.StaticFiles()
+
+# Largest page size allowed for '/api/v1/models?limit=...'
+API_MAX_LIMIT = 1000
+
+# Number of models encoded per chunk when streaming.
+STREAM_BATCH_SIZE = 500
+
+# Models rendered into the index page. The rest are fetched a page at a time.
+INDEX_PAGE_SIZE = 100
+
+# Most items allowed in a single '/api/v1/models/batch' (or JSON-RPC batch) request.
+API_MAX_BATCH = 100000
+
+# JSON-RPC method names for the batch requests and what they map to.
+RPC_METHODS = {
+    'create_model': 'create',
+    'update_model': 'update',
+    'delete_model': 'delete',
+}
+
+# Request metrics, labelled by the route template rather than the path so
+# there is a fixed number of them (see Controller.dispatch).
+requests_total = metrics.counter(
+    'http_requests_total', 'Requests handled', ['route', 'method', 'status'])
+request_seconds = metrics.histogram(
+    'http_request_duration_seconds', 'Time to handle a request', ['route', 'method'])
+request_db_seconds = metrics.histogram(
+    'http_request_db_seconds', 'Time a request spent in the database', ['route'])
+request_serialize_seconds = metrics.histogram(
+    'http_request_serialize_seconds', 'Time a request spent encoding JSON and rendering templates', ['route'])
+requests_in_flight = metrics.gauge(
+    'http_requests_in_flight', 'Requests being handled right now', ['route'])
+response_bytes = metrics.counter(
+    'http_response_bytes_total', 'Response body bytes sent (after compression)', ['route'])
+
+database_pool = metrics.gauge(
+    'database_pool', 'Connection pool counters (see database.ConnectionPool)', ['stat'])
+database_writer = metrics.gauge(
+    'database_writer', 'Writer thread counters (see database.Writer)', ['stat'])
+database_statements = metrics.gauge(
+    'database_statements', 'Statement tracing totals (see database.StatementStats)', ['stat'])
+uptime_seconds = metrics.gauge(
+    'process_uptime_seconds', 'Seconds since the server started')
+
+
+@metrics.collector
+def collectServerMetrics():
+    stats = database.stats()
+    for key, value in stats['pool'].items():
+        database_pool.set(value, stat=key)
+    for key, value in stats['writer'].items():
+        database_writer.set(value, stat=key)
+    for key, value in (stats['statements'] or {}).items():
+        if value is not None:
+            database_statements.set(value, stat=key)
+    uptime_seconds.set(time.time() - START_TIME)
 
 
 # Basic server for handling requests
@@ -50,34 +123,265 @@ class Controller(BaseHTTPRequestHandler):
         I typically use frameworks such as Django, Tornado or Flask for Python
         webs development. I like using Gorilla for GoLang web development.
 
-        TODO:
-         - Add a custom log format. I don't like the default one.
+        Requests are logged as JSON lines by 'dispatch' (see accesslog.py)
+        instead of the default log format.
     '''
 
+    # HTTP/1.1 gives us persistent (keep-alive) connections and chunked
+    # transfer encoding. Every response has to be framed with either a
+    # 'Content-Length' or chunked encoding for this to work.
+    protocol_version = 'HTTP/1.1'
+
+    # Idle keep-alive connections get closed after this many seconds.
+    # (StreamRequestHandler applies this as the socket timeout.)
+    timeout = conf.HTTP_KEEPALIVE_TIMEOUT
+
+    # Buffer the output so the headers and a small body go out in a single
+    # write. handle_one_request flushes after every request. Nagle's algorithm
+    # would otherwise hold back the last packet of a response on a kept-alive
+    # connection waiting for an ACK.
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    # Per request bookkeeping for the metrics, reset by 'dispatch'.
+    _status = None
+    _sent = 0
+    _serialize = 0.0
+    # Started (epoch) and a hash of the response body, for '-capture'.
+    _started = 0.0
+    _digest = None
+
+    def setup(self):
+        super().setup()
+        self.requests_handled = 0
+        prefork.connectionOpened()
+
+    def finish(self):
+        try:
+            super().finish()
+        finally:
+            prefork.connectionClosed()
+
+    def handle_expect_100(self):
+        # The output is buffered (wbufsize), so the '100 Continue' has to be
+        # pushed out or the client sits there until it gives up waiting and
+        # sends the body anyway (a second for curl).
+        result = super().handle_expect_100()
+        self.wfile.flush()
+        return result
+
+    def parse_request(self):
+        # Called once the request line is in, so waiting on an idle keep-alive
+        # connection doesn't count as being busy.
+        self._busy = True
+        prefork.requestStarted()
+        return super().parse_request()
+
+    def handle_one_request(self):
+        # The handler instance lives as long as the connection, so anything we
+        # cached for the previous request has to go.
+        self.__dict__.pop('_body', None)
+        self.__dict__.pop('_ctx', None)
+        self.__dict__.pop('_etag', None)
+        self.headers = None
+        self._busy = False
+        try:
+            super().handle_one_request()
+            if not self.close_connection:
+                self.discardBody()
+        finally:
+            if self._busy:
+                prefork.requestFinished()
+
+    def discardBody(self):
+        ''' Reads any part of the request body the handler didn't use, so the
+            next (possibly pipelined) request starts at the right place.
+        '''
+        if self.headers is None or hasattr(self, '_body'):
+            return
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            # We don't parse chunked request bodies, so there is no telling
+            # where the next request starts.
+            self.close_connection = True
+            return
+        self.body
+
+    def send_response(self, code, message=None):
+        self._status = code
+        super().send_response(code, message)
+        self.requests_handled += 1
+        if self.requests_handled >= conf.HTTP_MAX_KEEPALIVE_REQUESTS:
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        else:
+            if 'HTTP/1.0' == self.request_version:
+                self.send_header('Connection', 'keep-alive')
+            self.send_header('Keep-Alive', 'timeout={0}, max={1}'.format(
+                conf.HTTP_KEEPALIVE_TIMEOUT,
+                conf.HTTP_MAX_KEEPALIVE_REQUESTS - self.requests_handled))
+
+    def log_request(self, code='-', size='-'):
+        # 'dispatch' writes the access log.
+        pass
+
+    def log_message(self, format, *args):
+        # Only errors get here now (e.g. a malformed request line).
+        ACCESS_LOG.write(
+            client=self.client_address[0],
+            level='error',
+            message=format % args)
+
     def redirect(self, path):
         ''' A simple helper method for implementing HTTP redirects '''
         self.send_response(302)
         self.send_header('Location', '/')
+        self.send_header('Content-Length', '0')
         self.end_headers()
 
-    def send(self, content, content_type='text/plain', status=200):
+    def negotiateEncoding(self, content_type):
+        ''' Returns the compression to use for this response (or None). '''
+        if compression.compressible(content_type):
+            return compression.negotiate(self.headers.get('Accept-Encoding'))
+        return None
+
+    def send(self, content, content_type='text/plain', status=200, headers=None):
         ''' A helper method for sending the HTTP response '''
+        if not isinstance(content, bytes):
+            content = bytes(content, "UTF-8")
+        if self._digest is not None:
+            self._digest.update(content)
+        compressible = compression.compressible(content_type)
+        encoding = None
+        if compressible and len(content) >= conf.COMPRESSION_MIN_SIZE:
+            encoding = self.negotiateEncoding(content_type)
+            if encoding:
+                content = compression.compress(content, encoding)
         self.send_response(status)
         self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if compressible:
+            self.send_header('Vary', 'Accept-Encoding')
+        if 200 == status:
+            self.sendETag()
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
         self.end_headers()
-        if bytes != type(content):
-            self.wfile.write(bytes(content, "UTF-8"))
-        else:
+        if 'HEAD' != self.command:
             self.wfile.write(content)
-        self.wfile.flush()
+            self._sent += len(content)
+
+    def sendChunked(self, chunks, content_type='text/plain', status=200, headers=None, flush=False):
+        ''' Streams the response one chunk at a time using chunked transfer
+            encoding, so we never need the whole payload in memory. With
+            'flush' every chunk goes out as soon as it is written.
+        '''
+        # HTTP/1.0 clients don't understand chunked encoding. For them we just
+        # write the raw bytes and let the closed connection mark the end.
+        chunked = 'HTTP/1.0' != self.request_version
+        if not chunked:
+            self.close_connection = True
+        # We don't know the size up front, so compress whenever the client allows it.
+        encoding = self.negotiateEncoding(content_type)
+        compressor = compression.StreamCompressor(encoding) if encoding else None
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if compression.compressible(content_type):
+            self.send_header('Vary', 'Accept-Encoding')
+        if 200 == status:
+            self.sendETag()
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+
+        if 'HEAD' == self.command:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            return
+
+        def write(chunk):
+            if not chunk:
+                return
+            if chunked:
+                self.wfile.write(b'%X\r\n%s\r\n' % (len(chunk), chunk))
+            else:
+                self.wfile.write(chunk)
+            self._sent += len(chunk)
+
+        for chunk in chunks:
+            if not isinstance(chunk, bytes):
+                chunk = bytes(chunk, "UTF-8")
+            if self._digest is not None:
+                self._digest.update(chunk)
+            write(compressor.compress(chunk, flush) if compressor else chunk)
+            if flush:
+                self.wfile.flush()
+        if compressor:
+            write(compressor.finish())
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+
+    def notModified(self, *parts):
+        ''' Conditional GETs for responses built from the 'models' table. The
+            ETag comes from the table version (see database.migrate), so
+            checking it is a single tiny query. Sends a 304 and returns True
+            when the client's copy is still current, otherwise the ETag goes
+            out with the response.
+
+            'parts' is anything else the response depends on (e.g. the
+            template). It's a weak ETag since the body depends on the
+            compression we pick.
+        '''
+        self._etag = 'W/"{0}"'.format('-'.join(
+            str(part) for part in (VERSION, Model.version()) + parts))
+        if not etagMatches(self.headers.get('If-None-Match'), self._etag):
+            return False
+        self.send_response(304)
+        self.sendETag()
+        self.end_headers()
+        return True
+
+    def sendETag(self):
+        etag = self.__dict__.get('_etag')
+        if etag:
+            self.send_header('ETag', etag)
+            # Caches may keep it but have to check back with us first.
+            self.send_header('Cache-Control', 'no-cache')
 
     # The next few methods are just helpers to keep things clean
     # within our application logic.
-    def sendJSON(self, payload, status=200):
+    def encode(self, payload):
+        ''' The payload as JSON (bytes, see utils.dumps), timed as
+            serialization for the metrics.
+        '''
+        start = time.perf_counter()
+        try:
+            return dumps(payload)
+        finally:
+            self._serialize += time.perf_counter() - start
+
+    def encodeModels(self, models):
+        ''' The models as a JSON array put together from the cached JSON of
+            each one (see models.FragmentCache), timed as serialization.
+        '''
+        start = time.perf_counter()
+        try:
+            return Model.listJSON(models)
+        finally:
+            self._serialize += time.perf_counter() - start
+
+    def sendJSON(self, payload, status=200, headers=None):
         self.send(
-            json.dumps(payload),
+            self.encode(payload),
             content_type='application/json',
-            status=status)
+            status=status,
+            headers=headers)
 
     def sendHTML(self, content, status=200):
         self.send(content, content_type='text/html', status=status)
@@ -86,9 +390,10 @@ class Controller(BaseHTTPRequestHandler):
         self.sendJSON({"status": "error", "error": {
                       "message": message}}, status=404)
 
-    def errorMethodNotAllowed(self, message='Method Not Allowed'):
+    def errorMethodNotAllowed(self, allowed=(), message='Method Not Allowed'):
         self.sendJSON({"status": "error", "error": {
-                      "message": message}}, status=405)
+                      "message": message}}, status=405,
+                      headers={'Allow': ', '.join(allowed)})
 
     def errorMethodBadRequest(self, message='Bad Request'):
         self.sendJSON({"status": "error", "error": {
@@ -100,13 +405,105 @@ class Controller(BaseHTTPRequestHandler):
             "data": kwargs
         }, kwargs.get('status', 200))
 
-    def sendStaticFile(self, fpath):
-        if os.path.exists(fpath):
-            with open(fpath, 'rb') as fh:
-                content = fh.read()
-                contentType = getMimeTypeFromFile(fpath)[0]
-                return self.send(content, content_type=contentType)
-        self.errorNotFound()
+    def streamAPIModels(self, models):
+        ''' Streams the same payload as sendAPIResponse(models=[...]) without
+            building the list. Rows are encoded and written in batches.
+        '''
+        def chunks():
+            yield b'{"status": "ok", "data": {"models": ['
+            batch = []
+            separator = b''
+            for model in models:
+                batch.append(model)
+                if len(batch) >= STREAM_BATCH_SIZE:
+                    # Without the brackets.
+                    yield separator + self.encodeModels(batch)[1:-1]
+                    separator = b', '
+                    batch = []
+            if batch:
+                yield separator + self.encodeModels(batch)[1:-1]
+            yield b']}}'
+        return self.sendChunked(chunks(), content_type='application/json')
+
+    # Zero-copy sends for large static files. The asyncio engine turns
+    # this off since it doesn't hand us a real socket.
+    use_sendfile = hasattr(os, 'sendfile')
+
+    def sendStaticFile(self, urlpath):
+        ''' Serves a file from the static directory. Supports conditional
+            requests (ETag/Last-Modified), single byte ranges and precompressed
+            '.br'/'.gz' siblings. The file metadata is cached by STATIC_FILES.
+        '''
+        meta = STATIC_FILES.lookup(urlpath)
+        if meta is None:
+            return self.errorNotFound()
+        # Static files can be sent with sendfile, so they don't get a digest.
+        self._digest = None
+
+        # Use a precompressed version if the client can take it.
+        path, size, etag, encoding = meta.path, meta.size, meta.etag, None
+        if meta.variants:
+            accepted = parseAcceptEncoding(self.headers.get('Accept-Encoding'))
+            for name, _ in static.ENCODINGS:
+                if name in meta.variants and acceptsEncoding(accepted, name):
+                    path, size, etag = meta.variants[name]
+                    encoding = name
+                    break
+
+        headers = [
+            ('ETag', etag),
+            ('Last-Modified', meta.last_modified),
+            ('Cache-Control', 'no-cache' if conf.DEBUG else meta.cache_control)
+        ]
+        if meta.variants:
+            headers.append(('Vary', 'Accept-Encoding'))
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+
+        if meta.notModified(self.headers, etag):
+            self.send_response(304)
+            for key, value in headers:
+                self.send_header(key, value)
+            return self.end_headers()
+
+        # Byte ranges only make sense against the uncompressed file.
+        status, start, length = 200, 0, size
+        if encoding is None:
+            headers.append(('Accept-Ranges', 'bytes'))
+            byterange = static.parseRange(self.headers.get('Range'), size)
+            # 'If-Range' means only send the range if the file hasn't changed.
+            if_range = self.headers.get('If-Range')
+            if byterange is not None and if_range and if_range not in [etag, meta.last_modified]:
+                byterange = None
+            if byterange is False:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{0}'.format(size))
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+            if byterange:
+                status, start, length = 206, byterange[0], byterange[1] - byterange[0] + 1
+                headers.append(('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                    byterange[0], byterange[1], size)))
+
+        self.send_response(status)
+        self.send_header('Content-type', meta.content_type)
+        self.send_header('Content-Length', str(length))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+
+        if 'HEAD' == self.command:
+            return
+
+        with open(path, 'rb') as fh:
+            if self.use_sendfile and length >= conf.STATIC_SENDFILE_MIN:
+                # Anything we buffered has to go out before the file does.
+                self.wfile.flush()
+                self.connection.sendfile(fh, start, length)
+            else:
+                fh.seek(start)
+                self.wfile.write(fh.read(length))
+        self._sent += length
 
     # This section contains methods to help get/collect parameters
     # sent in the HTTP request.
@@ -125,75 +522,151 @@ class Controller(BaseHTTPRequestHandler):
         self._body = self.rfile.read(content_len)
         return self._body
 
+    def bodyLines(self):
+        ''' Reads the body a line at a time instead of all at once like 'body',
+            so a big upload never has to fit in memory. Anything left unread
+            is counted in '_unread'.
+        '''
+        # Tells 'discardBody' (and 'body') the body is being taken care of.
+        self._body = None
+        self._unread = int(self.headers.get('content-length', 0))
+        while self._unread > 0:
+            line = self.rfile.readline(min(self._unread, 1024 * 1024))
+            if not line:
+                break
+            self._unread -= len(line)
+            yield line.decode('utf-8', errors='replace')
+
+    @property
+    def ctx(self):
+        ''' The parsed request (url, query string, form, JSON), see router.py.
+            Each part is parsed at most once per request.
+        '''
+        if '_ctx' not in self.__dict__:
+            self._ctx = RequestContext(self)
+        return self._ctx
+
     def json(self):
         ''' Parses JSON payloads contained in the request body '''
-        if 'application/json' == self.headers.get('content-type'):
-            if self.body:
-                try:
-                    return json.loads(self.body)
-                except BaseException:
-                    return {}
-        return {}
+        return self.ctx.json
 
     @property
     def form(self):
         ''' Parses forms contained in the request body '''
-        if 'application/x-www-form-urlencoded' == self.headers.get(
-                'content-type'):
-            if self.body:
-                params = parse_qs(self.body)
-                return {
-                    k.decode(): v[0].decode() for k,
-                    v in params.items() if v is not None}
-        return {}
+        return self.ctx.form
 
     @property
     def args(self):
         ''' Parses url query string parameters '''
-        params = parse_qs(urlparse(self.path).query)
-        return {
-            k: v[0] for k, v in params.items() if v is not None
-        }
+        return self.ctx.args
 
     @property
     def params(self):
         ''' This merges parameters sent via different methods (JSON, form and query string).
-            We will prioritize data sent within the request body.
+            We will prioritize data sent within the request body. The 'id' from urls like
+            '/model/{id}' is included as well.
+
+            Handlers are free to modify what they get back.
         '''
-        params = {
-            **self.args,
-            **self.form,
-            **self.json().get('params', {})
-        }
-        # Get any parameters from the URL
-        id = self.getModelIDFromRequestURL()
-        if id:
-            params['id'] = id
-        return params
+        return dict(self.ctx.params)
 
     # These two methods are just helper functions for the application logic.
-    def getModelIDFromRequestURL(self):
-        ''' This extracts the 'name' parameter from the url.
-
-            Pretty clunky and room for improvement.
-        '''
-        url = urlparse(self.path)
-        if url.path.startswith('/api/v1/model/'):
-            parts = url.path.replace('/api/v1/model/', '').split('/')
-            return quote(parts[0])
-        elif url.path.startswith('/model/'):
-            parts = url.path.replace('/model/', '').split('/')
-            return quote(parts[0])
-        return None
+    def isAPIRequest(self):
+        return self.ctx.path.startswith('/api/')
 
     def getModel(self):
         ''' Fetches the Model object for the given 'name' supplied by the request. '''
-        id = self.params.get('id')
+        id = self.ctx.params.get('id')
         models = Model.fetch(id=id)
         return models[0] if len(models) else None
 
     # Here are the HTTP request handlers.
     # This section contains the bulk for our application logic.
+    # The urls they are served on are at the bottom of this file.
+
+    def dispatch(self):
+        ''' Finds the handler for the request in ROUTES and runs it. Every
+            request is timed, counted and logged under its route template
+            (so '/api/v1/model/{id}' is one route, not one per model).
+        '''
+        start = time.perf_counter()
+        database.resetQueryTime()
+        self._status = None
+        self._sent = 0
+        self._serialize = 0.0
+        if CAPTURE.target is not None:
+            self._started = time.time()
+            self._digest = hashlib.sha1()
+        handler, captures, allowed, route = ROUTES.match(self.command, self.ctx.path)
+        route = route or 'unmatched'
+        requests_in_flight.inc(route=route)
+        try:
+            if handler is None:
+                if allowed:
+                    return self.errorMethodNotAllowed(allowed)
+                return self.errorNotFound()
+            self.ctx.captures = captures
+            return handler(self)
+        finally:
+            requests_in_flight.dec(route=route)
+            self.recordRequest(route, time.perf_counter() - start)
+
+    def recordRequest(self, route, elapsed):
+        # No status means the handler blew up before responding.
+        status = self._status or 500
+        db = database.queryTime()
+        requests_total.inc(route=route, method=self.command, status=status)
+        request_seconds.observe(elapsed, route=route, method=self.command)
+        request_db_seconds.observe(db, route=route)
+        request_serialize_seconds.observe(self._serialize, route=route)
+        response_bytes.inc(self._sent, route=route)
+        ACCESS_LOG.write(
+            client=self.client_address[0],
+            method=self.command,
+            path=self.path,
+            route=route,
+            status=status,
+            bytes=self._sent,
+            ms=round(elapsed * 1000, 3),
+            db_ms=round(db * 1000, 3),
+            serialize_ms=round(self._serialize * 1000, 3))
+        if CAPTURE.target is not None:
+            self.captureRequest(route, status, elapsed)
+
+    # Headers that shouldn't end up in a capture file.
+    CAPTURE_REDACT = ['authorization', 'proxy-authorization', 'cookie']
+
+    def captureRequest(self, route, status, elapsed):
+        ''' Writes the request to the capture file (see conf.CAPTURE_FILE and
+            benchmarks/replay.py), along with the status and a hash of the
+            response body to compare against when it is replayed. The body is
+            only kept if the handler read it and it isn't too big.
+        '''
+        headers = [
+            (key, '<redacted>' if key.lower() in self.CAPTURE_REDACT else value)
+            for key, value in self.headers.items()]
+        body = getattr(self, '_body', None)
+        entry = {}
+        if body and len(body) <= conf.CAPTURE_MAX_BODY:
+            try:
+                entry['body'] = body.decode('utf-8')
+            except UnicodeDecodeError:
+                entry['body_base64'] = base64.b64encode(body).decode('ascii')
+        CAPTURE.write(
+            start=round(self._started, 6),
+            method=self.command,
+            path=self.path,
+            route=route,
+            headers=headers,
+            body_length=int(self.headers.get('Content-Length') or 0),
+            **entry,
+            status=status,
+            bytes=self._sent,
+            sha1=self._digest.hexdigest() if self._digest is not None else None,
+            ms=round(elapsed * 1000, 3))
+        self._digest = None
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = dispatch
 
     def indexHandler(self):
         ''' HTTP handler for our index path.
@@ -210,149 +683,494 @@ class Controller(BaseHTTPRequestHandler):
             I felt this would better demonstrate some modern web development approaches
             as well as my full stack development capabilities.
         '''
-        fpath = os.path.join('tmpl', 'page.html')
-        with open(fpath) as fh:
-            tmpl = fh.read()
-            data = [model.toDict() for model in Model.fetch(**self.params)]
-            page = tmpl.replace('{{models}}', json.dumps(data))
-            self.sendHTML(page)
+        if self.notModified(templates.PAGE.mtime):
+            return
+
+        # Only the first page of models and the 'status' counts for the chart
+        # go into the page, so it stays the same size however big the table
+        # gets. The page fetches more as needed.
+        params = self.modelFilters(self.params, 'q')
+        # Read before the models, the page may get a change it already has
+        # but never misses one.
+        since = CHANGE_FEED.latest()
+        models, cursor = Model.page(INDEX_PAGE_SIZE, **params)
+        data = {
+            'models': self.encodeModels(models),
+            'next': cursor,
+            'since': since,
+            'limit': INDEX_PAGE_SIZE,
+            'facets': self.facetCounts(['status'], params)
+        }
+
+        # The templates are loaded and split up on start up (see templates.py).
+        self.sendHTML(templates.PAGE.render(data=self.encode(data)))
+
+    @staticmethod
+    def modelFilters(params, *extra):
+        ''' Picks the filters (and the 'extra' params) out of the request
+            params for the Model queries. Nothing else a client sends gets
+            anywhere near their keyword arguments.
+        '''
+        return {
+            key: value for key, value in params.items()
+            if key in Model.filterable or key in extra
+        }
+
+    @staticmethod
+    def facetCounts(columns, filters):
+        return {
+            column: [
+                {'value': value, 'count': count}
+                for value, count in Model.facets(column, **filters)
+            ] for column in columns
+        }
+
+    def staticHandler(self):
+        # Handler static assets...
+        return self.sendStaticFile(unquote(self.ctx.path))
+
+    def modelsHandler(self):
+        ''' Lists models. Supports three modes:
+
+             - default: every matching model in one response
+             - 'limit' (and 'after'): one page plus a 'next' cursor
+             - 'stream': every matching model, streamed as it is read
+
+            'q' searches the text columns. The results come back best match
+            first, so with 'limit' the 'next' cursor is an offset instead.
+        '''
+        if self.notModified():
+            return
+
+        params = self.params
+        filters = self.modelFilters(params)
+        try:
+            q = params.get('q', '').strip()
+            if 'limit' in params:
+                limit = int(params['limit'])
+                if limit < 1 or limit > API_MAX_LIMIT:
+                    raise ValueError('limit must be between 1 and {0}'.format(API_MAX_LIMIT))
+                if q:
+                    models, cursor = Model.search(q, limit, offset=int(params.get('after') or 0), **filters)
+                else:
+                    models, cursor = Model.page(limit, after=params.get('after'), **filters)
+                return self.sendAPIResponse(models=self.encodeModels(models), next=cursor)
+
+            if params.get('stream') in ['1', 'true', True]:
+                return self.streamAPIModels(Model.iterate(q=q, **filters))
+
+            if q:
+                models, _ = Model.search(q, **filters)
+                return self.sendAPIResponse(models=self.encodeModels(models))
+
+            return self.sendAPIResponse(models=self.encodeModels(Model.fetch(**filters)))
+        except ValueError as e:
+            return self.errorMethodBadRequest(str(e))
+
+    def facetsHandler(self):
+        ''' Counts the matching models by the values of one or more columns,
+            e.g. '/api/v1/models/facets?group_by=status,make&color=red'
+        '''
+        if self.notModified():
+            return
+
+        params = self.params
+        columns = [c for c in params.get('group_by', 'status').split(',') if c]
+        try:
+            return self.sendAPIResponse(facets=self.facetCounts(columns, self.modelFilters(params, 'q')))
+        except ValueError as e:
+            return self.errorMethodBadRequest(str(e))
+
+    def exportHandler(self):
+        ''' Streams the matching models as NDJSON or CSV, e.g.
+            '/api/v1/models/export?format=csv&status=fail' (see transfer.py).
+        '''
+        params = self.params
+        fmt = params.pop('format', 'ndjson')
+        if fmt not in transfer.FORMATS:
+            return self.errorMethodBadRequest('format must be one of {0}'.format(', '.join(transfer.FORMATS)))
+        filters = self.modelFilters(params, 'q')
+        self.sendChunked(
+            transfer.exportModels(fmt, **filters),
+            content_type=transfer.FORMATS[fmt] + '; charset=utf-8',
+            headers={'Content-Disposition': 'attachment; filename="models.{0}"'.format(fmt)})
+
+    def importHandler(self):
+        ''' Imports models from an NDJSON or CSV body (picked by 'format' or the
+            Content-Type), committed a chunk at a time (see transfer.py):
+
+                curl -T models.csv -H 'Content-Type: text/csv' '/api/v1/models/import?on_conflict=skip'
+
+            'on_conflict' is 'fail' (the default), 'skip' or 'update' and
+            'chunk_size' is the number of rows per transaction. The response
+            has the counts and the first bad rows. When a 'fail' import stops
+            early the status is 409 and 'stopped' is the line it stopped at.
+        '''
+        if self.headers.get('Content-Length') is None:
+            return self.sendJSON({"status": "error", "error": {
+                "message": "Content-Length is required"}}, status=411)
+        args = self.args
+        self._unread = int(self.headers.get('Content-Length'))
+        try:
+            chunk_size = int(args.get('chunk_size', conf.IMPORT_CHUNK_SIZE))
+            if chunk_size < 1 or chunk_size > API_MAX_BATCH:
+                raise ValueError('chunk_size must be between 1 and {0}'.format(API_MAX_BATCH))
+            stats = transfer.importModels(
+                self.bodyLines(),
+                args.get('format') or transfer.detectFormat(content_type=self.headers.get('Content-Type')),
+                args.get('on_conflict', 'fail'),
+                chunk_size)
+        except ValueError as e:
+            stats = e
+        # Whatever we didn't read is still sitting on the connection.
+        if self._unread:
+            self.close_connection = True
+        if isinstance(stats, Exception):
+            return self.errorMethodBadRequest(str(stats))
+        return self.sendAPIResponse(
+            **stats.toDict(), status=409 if stats.stopped is not None else 200)
+
+    def explainHandler(self):
+        # Shows how SQLite will run the query for a set of filters.
+        # Only available when running with '-debug'.
+        if not conf.DEBUG:
+            return self.errorNotFound()
+        try:
+            return self.sendAPIResponse(**Model.explain(**self.modelFilters(self.params, 'q', 'limit', 'after')))
+        except ValueError as e:
+            return self.errorMethodBadRequest(str(e))
+
+    def changesHandler(self):
+        ''' The change feed, '/api/v1/changes?since=<seq>'. Returns the changes
+            after 'since' (see Model.changes) and the 'last' seq to ask for
+            next. Without 'since' it just returns the current 'last'.
+
+            With 'wait=<seconds>' it long-polls: when there is nothing new it
+            holds on until something changes or the time runs out. Clients
+            asking for 'text/event-stream' (EventSource) get an event stream.
+        '''
+        params = self.params
+        try:
+            # A reconnecting EventSource sends the last event it got.
+            since = self.headers.get('Last-Event-ID') or params.get('since')
+            since = CHANGE_FEED.latest() if since in [None, ''] else int(since)
+            limit = int(params.get('limit', API_MAX_LIMIT))
+            if limit < 1 or limit > API_MAX_LIMIT:
+                raise ValueError('limit must be between 1 and {0}'.format(API_MAX_LIMIT))
+            wait = min(float(params.get('wait', 0)), conf.CHANGES_LONGPOLL_MAX)
+        except ValueError as e:
+            return self.errorMethodBadRequest(str(e))
+
+        if 'text/event-stream' in self.headers.get('Accept', ''):
+            return self.streamChanges(since, limit)
+
+        changes, last, reset = Model.changes(since, limit)
+        if not changes and not reset and wait > 0 and CHANGE_FEED.acquire():
+            try:
+                if CHANGE_FEED.wait(since, wait):
+                    changes, last, reset = Model.changes(since, limit)
+            finally:
+                CHANGE_FEED.release()
+        return self.sendAPIResponse(changes=changes, last=last, reset=reset)
+
+    def streamChanges(self, since, limit):
+        ''' Server-Sent Events version of the change feed. Every change is an
+            event with its seq as the 'id', so a reconnecting EventSource picks
+            up where it left off (Last-Event-ID). A 'reset' event means the
+            client missed too much and has to reload.
+        '''
+        if not CHANGE_FEED.acquire():
+            return self.sendJSON({"status": "error", "error": {
+                "message": "Too many open change streams"}}, status=503,
+                headers={'Retry-After': str(conf.CHANGES_HEARTBEAT)})
+
+        def events():
+            nonlocal since
+            # How long the browser waits before reconnecting (milliseconds).
+            yield 'retry: 2000\n\n'
+            deadline = time.monotonic() + conf.CHANGES_STREAM_TIMEOUT
+            while not CHANGE_FEED.closed and time.monotonic() < deadline:
+                changes, last, reset = Model.changes(since, limit)
+                if reset:
+                    yield 'event: reset\ndata: {0}\n\n'.format(json.dumps({'last': last}))
+                for change in changes:
+                    yield 'id: {0}\nevent: change\ndata: {1}\n\n'.format(
+                        change['seq'], json.dumps(change))
+                since = last
+                if len(changes) < limit and not CHANGE_FEED.wait(
+                        since, min(conf.CHANGES_HEARTBEAT, deadline - time.monotonic())):
+                    # A comment line, keeps proxies from timing out and tells
+                    # us when the client is gone.
+                    yield ': heartbeat\n\n'
+
+        try:
+            # Events have to go out as they happen, so they are never compressed
+            # (text/event-stream isn't in compression.COMPRESSIBLE).
+            self.sendChunked(events(), content_type='text/event-stream', flush=True,
+                             headers={'Cache-Control': 'no-cache'})
+        except (BrokenPipeError, ConnectionResetError, TimeoutError):
+            self.close_connection = True
+        finally:
+            CHANGE_FEED.release()
+
+    def metricsHandler(self):
+        ''' Everything in the metrics registry, for Prometheus to scrape. '''
+        self.send(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+    def queriesHandler(self):
+        ''' The statements this process spent the most time on (see
+            database.StatementStats), e.g. '/api/v1/admin/queries?limit=10&sort=mean'.
+            With '-workers' each worker keeps its own totals.
+        '''
+        if database.STATEMENTS is None:
+            return self.errorNotFound()
+        params = self.params
+        try:
+            limit = int(params.get('limit', conf.DB_TRACE_TOP_N))
+            statements = database.STATEMENTS.top(limit, params.get('sort', 'seconds'))
+        except ValueError as e:
+            return self.errorMethodBadRequest(str(e))
+        return self.sendAPIResponse(
+            statements=statements, pid=os.getpid(), **database.STATEMENTS.stats())
+
+    def resetQueriesHandler(self):
+        ''' Starts the statement totals over. '''
+        if database.STATEMENTS is None:
+            return self.errorNotFound()
+        database.STATEMENTS.reset()
+        return self.sendAPIResponse(**database.STATEMENTS.stats())
 
     def pingHandler(self):
         self.sendAPIResponse(
             version=VERSION,
             start_time=START_TIME,
-            up_time=time.time() - START_TIME
+            up_time=time.time() - START_TIME,
+            database=database.stats(),
+            compression=compression.stats(),
+            cache=QUERY_CACHE.stats(),
+            fragments=FRAGMENT_CACHE.stats(),
+            workers=prefork.stats()
         )
 
     # This is a more traditional "View" for MVC.
     def modelHandler(self, message=''):
         model = self.getModel()
         if model:
-            fpath = os.path.join('tmpl', 'model.html')
-            with open(fpath) as fh:
-                tmpl = fh.read()
-                page = tmpl.format(**model.toDict(), message=message)
-                return self.sendHTML(page)
+            page = templates.MODEL.render(**model.toDict(), message=message)
+            return self.sendHTML(page)
+        self.errorNotFound()
+
+    def apiModelHandler(self):
+        if self.notModified():
+            return
+
+        model = self.getModel()
+        if model:
+            return self.sendAPIResponse(model=model.toDict())
         self.errorNotFound()
 
     def updateModel(self):
         model = self.getModel()
         if model:
-            params = self.params
+            params = self.ctx.params
             model.color = params.get('color', model.color)
             model.make = params.get('make', model.make)
             model.status = params.get('status', model.status)
             model.save()
         return model
 
-    def do_HEAD(self):
-        return
-
-    def do_POST(self):
+    def createModelHandler(self):
         ''' An HTTP handler for the [C]reate method in the CRUD application. '''
-        url = urlparse(self.path)
-
-        # Handle redirects
-        if '/' == url.path:
-            return self.indexHandler()
-
-        elif url.path in ['/api/v1/model', '/create']:
-            try:
-                # Create new model
-                model = Model(**self.params)
-                model.save()
-
-                # Depending on endpoint return api response or redirect.
-                if '/api/v1/model' == url.path:
-                    return self.sendAPIResponse(model=model.toDict())
-                else:
-                    return self.redirect('/')
-
-            except Exception as e:
-                return self.errorMethodBadRequest(str(e))
-
-        # I did not realize PUT was not allowed in forms...
-        elif re.match(r'^/model/[^/]+$', url.path):
-            if self.updateModel():
-                return self.modelHandler(message='Model updated')
-
-        self.errorNotFound()
-
-    def do_GET(self):
-        ''' An HTTP handler for the [R]ead method in the CRUD application. '''
-        url = urlparse(self.path)
-
-        # Handle redirects
-        if '/' == url.path:
-            return self.indexHandler()
+        # A JSON-RPC batch, e.g. '[{"method": "create_model", ...}, ...]'
+        if isinstance(self.ctx.json, list):
+            return self.rpcBatchHandler()
+        try:
+            # Create new model
+            model = Model(**self.params)
+            model.save()
 
-        # Handler static assets...
-        # TODO: Add a better handler for static folders.
-        elif url.path.startswith('/static/'):
-            parts = url.path.split('/')
-            fpath = os.path.join(*[part for part in parts if part])
-            return self.sendStaticFile(fpath)
-
-        # It's always nice to include a route for health checks.
-        elif '/ping' == url.path:
-            return self.pingHandler()
-
-        # This is a more traditional 'View' for MVC.
-        elif re.match(r'^/model/[^/]+$', url.path):
-            return self.modelHandler()
-
-        # Basic API endpoints for testing
-        elif '/api/v1/models' == url.path:
-            return self.sendAPIResponse(models=[
-                model.toDict() for model in Model.fetch(**self.params)
-            ])
-
-        elif re.match(r'^/api/v1/model/[^/]+$', url.path):
-            model = self.getModel()
-            if model:
+            # Depending on endpoint return api response or redirect.
+            if self.isAPIRequest():
                 return self.sendAPIResponse(model=model.toDict())
+            else:
+                return self.redirect('/')
 
-        self.errorNotFound()
+        except Exception as e:
+            return self.errorMethodBadRequest(str(e))
 
-    def do_PUT(self):
-        ''' An HTTP handler for the [U]pdate method in the CRUD application. '''
-        url = urlparse(self.path)
+    def updateModelHandler(self):
+        ''' An HTTP handler for the [U]pdate method in the CRUD application.
 
-        _isApiRequest = re.match(r'^/api/v1/model/[^/]+$', url.path)
-
-        # Handle redirects
-        if '/' == url.path:
-            return self.indexHandler()
-
-        elif _isApiRequest or re.match(r'^/model/[^/]+$', url.path):
-            model = self.updateModel()
-            if model:
-                # Depending on endpoint return api response or redirect.
-                if _isApiRequest:
-                    return self.sendAPIResponse(model=model.toDict())
-                else:
-                    self.modelHandler(message='Model updated')
-
-        self.errorNotFound()
-
-    def do_DELETE(self):
+            I did not realize PUT was not allowed in forms... so the model page
+            form POSTs here as well.
+        '''
+        model = self.updateModel()
+        if not model:
+            return self.errorNotFound()
+        # Depending on endpoint return api response or the model page.
+        if self.isAPIRequest():
+            return self.sendAPIResponse(model=model.toDict())
+        return self.modelHandler(message='Model updated')
+
+    @staticmethod
+    def batchOperation(action, params):
+        ''' Turns the params of a single create/update/delete into a
+            ModelCollection.batch operation.
+        '''
+        if 'delete' == action and isinstance(params, str):
+            params = {'id': params}
+        if not isinstance(params, dict):
+            raise ValueError('params must be an object')
+        if 'create' == action:
+            return action, Model(**params), None
+        if not params.get('id'):
+            raise ValueError('id is required')
+        if 'update' == action:
+            # Only the fields that were sent get changed, like updateModel.
+            return action, Model(**params), [f for f in ModelCollection.updatable if f in params]
+        return action, Model(id=params['id']), None
+
+    @staticmethod
+    def batchResult(result):
+        if isinstance(result, Exception):
+            return {'error': {'message': str(result)}}
+        return {'model': result.toDict()}
+
+    def batchHandler(self):
+        ''' Bulk create/update/delete in a single transaction:
+
+                {"method": "create_models", "params": {"models": [{...}, ...]}}
+
+            'update_models' items need an 'id', 'delete_models' takes objects
+            with an 'id' or just the ids. There's a result (or error) for
+            every item, in order. JSON-RPC batches (an array of calls) are
+            accepted here too.
+        '''
+        data = self.ctx.json
+        if isinstance(data, list):
+            return self.rpcBatchHandler()
+        if not isinstance(data, dict):
+            return self.errorMethodBadRequest('expected a JSON object or an array of calls')
+
+        action = {
+            'create_models': 'create',
+            'update_models': 'update',
+            'delete_models': 'delete'
+        }.get(data.get('method'))
+        if action is None:
+            return self.errorMethodBadRequest('method must be one of create_models, update_models or delete_models')
+        params = data.get('params')
+        items = params.get('models') if isinstance(params, dict) else None
+        if not isinstance(items, list):
+            return self.errorMethodBadRequest('params.models must be a list')
+        if len(items) > API_MAX_BATCH:
+            return self.errorMethodBadRequest('at most {0} models per batch'.format(API_MAX_BATCH))
+
+        results = [None] * len(items)
+        operations = []
+        positions = []
+        for i, item in enumerate(items):
+            try:
+                operations.append(self.batchOperation(action, item))
+                positions.append(i)
+            except ValueError as e:
+                results[i] = e
+        for i, result in zip(positions, ModelCollection.batch(operations)):
+            results[i] = result
+
+        return self.sendAPIResponse(results=[self.batchResult(result) for result in results])
+
+    def rpcBatchHandler(self):
+        ''' A JSON-RPC 2.0 batch (https://www.jsonrpc.org/specification#batch).
+            Every call in the batch runs in the same transaction.
+        '''
+        calls = self.ctx.json
+        if not calls:
+            return self.sendJSON({'jsonrpc': '2.0', 'id': None, 'error': {
+                'code': -32600, 'message': 'Invalid Request'}})
+        if len(calls) > API_MAX_BATCH:
+            return self.errorMethodBadRequest('at most {0} calls per batch'.format(API_MAX_BATCH))
+
+        def error(call, code, message):
+            return {'jsonrpc': '2.0', 'id': call.get('id') if isinstance(call, dict) else None,
+                    'error': {'code': code, 'message': message}}
+
+        responses = [None] * len(calls)
+        invalid = set()
+        operations = []
+        positions = []
+        for i, call in enumerate(calls):
+            if not isinstance(call, dict) or not isinstance(call.get('method'), str):
+                responses[i] = error(call, -32600, 'Invalid Request')
+                invalid.add(i)
+            elif call['method'] not in RPC_METHODS:
+                responses[i] = error(call, -32601, 'Method not found')
+            else:
+                try:
+                    operations.append(self.batchOperation(RPC_METHODS[call['method']], call.get('params')))
+                    positions.append(i)
+                except ValueError as e:
+                    responses[i] = error(call, -32602, str(e))
+
+        for i, result in zip(positions, ModelCollection.batch(operations)):
+            if isinstance(result, Exception):
+                responses[i] = error(calls[i], -32000, str(result))
+            else:
+                responses[i] = {'jsonrpc': '2.0', 'id': calls[i].get('id'), 'result': self.batchResult(result)}
+
+        # Calls without an 'id' are notifications and don't get a response,
+        # but something that isn't a valid call at all always gets one.
+        responses = [
+            response for i, (call, response) in enumerate(zip(calls, responses))
+            if i in invalid or 'id' in call
+        ]
+        if not responses:
+            self.send_response(204)
+            return self.end_headers()
+        return self.sendJSON(responses)
+
+    def deleteModelHandler(self):
         ''' An HTTP handler for the [D]elete method in the CRUD application. '''
-        url = urlparse(self.path)
-
-        # Handle redirects
-        if '/' == url.path:
-            return self.indexHandler()
-
-        elif url.path.startswith('/api/v1/model/') or re.match(r'^/model/[^/]+$', url.path):
-            model = self.getModel()
-            if model:
-                model.delete()
-                if url.path.startswith('/api/v1/model/'):
-                    return self.sendAPIResponse()
-                else:
-                    return self.redirect('/')
-
-        self.errorNotFound()
+        model = self.getModel()
+        if not model:
+            return self.errorNotFound()
+        model.delete()
+        if self.isAPIRequest():
+            return self.sendAPIResponse()
+        return self.redirect('/')
+
+
+# The urls we serve. More specific templates don't need to come first, static
+# segments always win over captures (see router.py).
+ROUTES = Router()
+ROUTES.add('GET', '/', Controller.indexHandler)
+# Handle redirects
+ROUTES.add(['POST', 'PUT', 'DELETE'], '/', Controller.indexHandler)
+ROUTES.add('GET', '/static/{path:path}', Controller.staticHandler)
+# It's always nice to include a route for health checks.
+ROUTES.add('GET', '/ping', Controller.pingHandler)
+ROUTES.add('GET', '/metrics', Controller.metricsHandler)
+ROUTES.add('GET', '/api/v1/admin/queries', Controller.queriesHandler)
+ROUTES.add('DELETE', '/api/v1/admin/queries', Controller.resetQueriesHandler)
+
+# This is a more traditional 'View' for MVC.
+ROUTES.add('POST', '/create', Controller.createModelHandler)
+ROUTES.add('GET', '/model/{id}', Controller.modelHandler)
+ROUTES.add(['POST', 'PUT'], '/model/{id}', Controller.updateModelHandler)
+ROUTES.add('DELETE', '/model/{id}', Controller.deleteModelHandler)
+
+# Basic API endpoints
+ROUTES.add('GET', '/api/v1/models', Controller.modelsHandler)
+ROUTES.add('GET', '/api/v1/models/explain', Controller.explainHandler)
+ROUTES.add('GET', '/api/v1/models/facets', Controller.facetsHandler)
+ROUTES.add('POST', '/api/v1/models/batch', Controller.batchHandler)
+ROUTES.add('GET', '/api/v1/models/export', Controller.exportHandler)
+ROUTES.add('POST', '/api/v1/models/import', Controller.importHandler)
+ROUTES.add('GET', '/api/v1/changes', Controller.changesHandler)
+ROUTES.add('POST', '/api/v1/model', Controller.createModelHandler)
+ROUTES.add('GET', '/api/v1/model/{id}', Controller.apiModelHandler)
+ROUTES.add('PUT', '/api/v1/model/{id}', Controller.updateModelHandler)
+ROUTES.add('DELETE', '/api/v1/model/{id}', Controller.deleteModelHandler)
 
 
 class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
@@ -380,10 +1198,17 @@ class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
 
 
 # Listen and serve on specified host and port
-def start(host='localhost', port=8080):
+def start(host='localhost', port=8080, sock=None):
     # server = HTTPServer((host, port), Controller)
     # server = ForkingHTTPServer((host, port), Controller)
-    server = ThreadingSimpleServer((host, port), Controller)
+    if sock is None:
+        server = ThreadingSimpleServer((host, port), Controller)
+    else:
+        # A pre-forked worker, the socket is already listening (see prefork.py).
+        server = ThreadingSimpleServer((host, port), Controller, bind_and_activate=False)
+        server.socket.close()
+        server.socket = sock
+        server.server_address = sock.getsockname()
 
     # This addresses the occasional issue when the port does not
     # get released on shutdown.
@@ -396,11 +1221,16 @@ def start(host='localhost', port=8080):
 
     print("Starting server at http://{0}:{1}".format(host, port))
 
+    CHANGE_FEED.start()
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
     finally:
+        # Let the long-polls and event streams go first.
+        CHANGE_FEED.close()
         server.server_close()
+        prefork.drain()
+        database.close()
 
     print("Server stopped")
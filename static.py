@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+
+'''
+Metadata cache for the files in the 'static' directory.
+
+The first request for a file does the 'stat' calls, the mimetype guess and
+looks for precompressed '.br'/'.gz' siblings. After that everything needed
+to answer a request (including a 304) comes out of memory. When running with
+'-debug' files are re-checked on every request so edits show up right away.
+
+The precompressed siblings can be generated with:
+
+    $ python3 static.py
+'''
+
+import os
+import re
+import gzip
+import sys
+import threading
+from email.utils import formatdate
+from email.utils import parsedate_to_datetime
+
+import conf
+from utils import getMimeTypeFromFile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STATIC_DIR = 'static'
+
+# Vendored files carry their version in the path (e.g. 'vue_v2.6.14.min.js'
+# or 'bootstrap-5.1.1-dist/'). These never change so browsers can keep them.
+_versioned = re.compile(r'\d+\.\d+\.\d+')
+
+# Precompressed siblings, in order of preference.
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+
+class StaticFile(object):
+
+    ''' Everything we need to know about a static file to serve it. '''
+
+    __slots__ = ('path', 'size', 'mtime', 'etag', 'last_modified',
+                 'content_type', 'cache_control', 'variants')
+
+    def __init__(self, path, st):
+        self.path = path
+        self.size = st.st_size
+        self.mtime = int(st.st_mtime)
+        self.etag = '"{0:x}-{1:x}"'.format(st.st_size, st.st_mtime_ns)
+        self.last_modified = formatdate(st.st_mtime, usegmt=True)
+        self.content_type = getMimeTypeFromFile(path)[0] or 'application/octet-stream'
+        if _versioned.search(path):
+            self.cache_control = 'public, max-age=31536000, immutable'
+        else:
+            self.cache_control = 'public, max-age={0}'.format(conf.STATIC_MAX_AGE)
+
+        # Precompressed versions of this file, {encoding: (path, size, etag)}
+        self.variants = {}
+        for encoding, ext in ENCODINGS:
+            try:
+                vst = os.stat(path + ext)
+            except OSError:
+                continue
+            # Skip stale siblings that are older than the original.
+            if vst.st_mtime < st.st_mtime:
+                continue
+            self.variants[encoding] = (
+                path + ext, vst.st_size,
+                '"{0:x}-{1:x}-{2}"'.format(st.st_size, st.st_mtime_ns, encoding))
+
+    def notModified(self, headers, etag):
+        ''' Checks the conditional request headers. 'If-None-Match' wins
+            over 'If-Modified-Since' when both are sent.
+        '''
+        inm = headers.get('If-None-Match')
+        if inm:
+            if '*' == inm.strip():
+                return True
+            tags = [tag.strip() for tag in inm.split(',')]
+            # Weak comparison
+            return etag in tags or 'W/' + etag in tags
+        ims = headers.get('If-Modified-Since')
+        if ims:
+            try:
+                return self.mtime <= parsedate_to_datetime(ims).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+class StaticFiles(object):
+
+    ''' Resolves url paths under '/static/' to files and caches their metadata. '''
+
+    def __init__(self, root=STATIC_DIR):
+        self.root = os.path.realpath(root)
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def resolve(self, urlpath):
+        ''' Maps a url path to a file path inside the static directory.
+            Returns None for anything that tries to escape it.
+        '''
+        parts = [part for part in urlpath.split('/') if part]
+        if not parts or STATIC_DIR != parts[0]:
+            return None
+        if any(part in ['.', '..'] or '\\' in part for part in parts):
+            return None
+        return os.path.join(*parts)
+
+    def lookup(self, urlpath):
+        fpath = self.resolve(urlpath)
+        if fpath is None:
+            return None
+
+        meta = self._files.get(fpath)
+        if meta is not None and not conf.DEBUG:
+            return meta
+
+        try:
+            st = os.stat(fpath)
+        except OSError:
+            self._files.pop(fpath, None)
+            return None
+        if not os.path.isfile(fpath) or not os.path.realpath(fpath).startswith(self.root + os.sep):
+            return None
+
+        if meta is None or meta.etag != '"{0:x}-{1:x}"'.format(st.st_size, st.st_mtime_ns):
+            meta = StaticFile(fpath, st)
+            with self._lock:
+                self._files[fpath] = meta
+        return meta
+
+
+def parseRange(header, size):
+    ''' Parses a single 'bytes=start-end' range. Returns (start, end) with an
+        inclusive end, None when the header should be ignored (we only do
+        single ranges) and False when it can not be satisfied.
+    '''
+    if not header or not header.startswith('bytes='):
+        return None
+    spec = header[len('bytes='):].strip()
+    if ',' in spec:
+        return None
+    start, sep, end = spec.partition('-')
+    if not sep:
+        return None
+    try:
+        if '' == start:
+            # Suffix range, the last N bytes.
+            length = int(end)
+            if length <= 0:
+                return False
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def precompress(root=STATIC_DIR, minimum=1024):
+    ''' Writes '.gz' (and '.br' when the brotli module is installed) siblings
+        for every compressible file under 'root'.
+    '''
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.endswith(tuple(ext for _, ext in ENCODINGS)):
+                continue
+            path = os.path.join(dirpath, filename)
+            content_type = getMimeTypeFromFile(path)[0] or ''
+            if not (content_type.startswith('text/') or content_type in [
+                    'application/javascript', 'application/json', 'image/svg+xml']):
+                continue
+            if os.path.getsize(path) < minimum:
+                continue
+            with open(path, 'rb') as fh:
+                content = fh.read()
+            with open(path + '.gz', 'wb') as fh:
+                fh.write(gzip.compress(content, 9, mtime=0))
+            if brotli:
+                with open(path + '.br', 'wb') as fh:
+                    fh.write(brotli.compress(content))
+            print(path)
+
+
+if __name__ == '__main__':
+    precompress(*sys.argv[1:2])
@@ -11,7 +11,7 @@
 
 */
 
-var App = function(models) {
+var App = function(initial) {
 
     return new Vue({
 
@@ -19,9 +19,16 @@ var App = function(models) {
 
         delimiters: ["<%","%>"],
 
+        // The page only comes with the first page of models and the counts
+        // for the chart. Everything else is fetched from the API as needed.
         data: {
-            models: models,
+            models: initial.models,
+            next: initial.next,
+            since: initial.since,
+            limit: initial.limit,
+            facets: initial.facets,
             filters: {
+                q: null,
                 id: null,
                 name: null,
                 make: null,
@@ -38,9 +45,7 @@ var App = function(models) {
 
             // Lets setup the basic D3 chart to show the 'status' values.
             this.chart = new PieChart()
-                            .update(this._data.models.map(function(d) {
-                                return d[self.piechartColumnId];
-                            }))
+                            .update(this._data.facets[this._data.piechartColumnId] || [])
                             .on({
                                 click: function(label) {
                                     self._data.filters[self.piechartColumnId] = label;
@@ -51,6 +56,23 @@ var App = function(models) {
                                     self.filterChange();
                                 }
                             });
+
+            // Changes made by everyone else (other tabs, other users) come in
+            // through the change feed, starting from when the page was made.
+            // EventSource reconnects on its own and tells the server the last
+            // change it got.
+            if (window.EventSource) {
+                this.changes = new EventSource('/api/v1/changes?since=' + this._data.since);
+                this.changes.addEventListener('change', function(event) {
+                    self.applyChange(JSON.parse(event.data));
+                });
+                this.changes.addEventListener('reset', function(event) {
+                    // We missed too much, start over.
+                    self._data.since = JSON.parse(event.data).last;
+                    self.fetchModels();
+                    self.refreshChart();
+                });
+            }
         },
 
         methods: {
@@ -88,40 +110,105 @@ var App = function(models) {
             // "Model" object a Vue 'Component'. That way I could have the
             // parent (app) send Events to its children.
             // https://vuejs.org/v2/guide/components.html
-            filterChange: function(model) {
+            //
+            // The filtering happens on the server now (the page doesn't have
+            // every model anymore), so the column filters have to match
+            // exactly. Substring matching is the search box ('q'), which
+            // uses the full text index. We wait for the user to stop typing
+            // before asking.
+            filterChange: function() {
                 let self = this;
+                clearTimeout(this._filterTimer);
+                this._filterTimer = setTimeout(function() {
+                    self.fetchModels();
+                    self.refreshChart();
+                }, 250);
+            },
 
-                // Because we are doing many DOM manipluations I will run
-                // this in a callback function via the Array.filter function.
-                let models = this._data.models.filter(function(d) {
-                    let _show = true;
-                    for (let field in self._data.filters) {
-                        let value = self._data.filters[field];
-                        if (value) {
-                            if (!d[field] || -1 == d[field].indexOf(value)) {
-                                _show = false;
-                                break;
-                            }
+            // Query string for the current filters plus any 'extra' parameters.
+            filterQuery: function(extra) {
+                let params = [];
+                let values = Object.assign({}, this._data.filters, extra || {});
+                for (let field in values) {
+                    if (values[field]) {
+                        params.push(encodeURIComponent(field) + '=' + encodeURIComponent(values[field]));
+                    }
+                }
+                return params.join('&');
+            },
+
+            // Fetches the first page of models matching the filters, or the
+            // page after the 'after' cursor.
+            fetchModels: function(after) {
+                let self = this;
+                return fetch('/api/v1/models?' + this.filterQuery({limit: this._data.limit, after: after}))
+                    .then(function(response) {
+                        return response.json();
+                    }).then(function(data) {
+                        if ('ok' != data.status) {
+                            return self.showError(data.error.message);
                         }
+                        self._data.models = after ? self._data.models.concat(data.data.models) : data.data.models;
+                        self._data.next = data.data.next;
+                    }).catch(function(error) {
+                        self.showError('Unable to communicate with server');
+                    });
+            },
+
+            // Applies a change from the feed to the models we are showing.
+            applyChange: function(change) {
+                let self = this;
+                let models = this._data.models;
+                let idx = models.findIndex(function(d) { return d.id == change.id; });
+                this._data.since = change.seq;
+                if ('delete' == change.op) {
+                    if (-1 != idx) {
+                        models.splice(idx, 1);
                     }
-                    let $elem = self.getRowByModelID(d);
-                    _show ? $elem.fadeIn(250) : $elem.fadeOut(250);
-                    return _show;
-                });
+                } else if (-1 != idx) {
+                    models.splice(idx, 1, change.model);
+                } else if (!this._data.next && !this.filterQuery()) {
+                    // New models go at the end, but only if we are showing
+                    // everything. Otherwise they show up with the next fetch.
+                    models.push(change.model);
+                }
 
-                // Update SVG chart to display filtered 'status' values.
-                this.chart.update(
-                    models.map(function(d) {
-                        return d[self._data.piechartColumnId];
-                    })
-                );
+                // Changes tend to come in bunches.
+                clearTimeout(this._chartTimer);
+                this._chartTimer = setTimeout(function() {
+                    self.refreshChart();
+                }, 250);
+            },
+
+            loadMore: function() {
+                if (this._data.next) {
+                    return this.fetchModels(this._data.next);
+                }
+            },
+
+            // Update SVG chart to display the counts for the filtered models.
+            refreshChart: function() {
+                let self = this;
+                let column = this._data.piechartColumnId;
+                return fetch('/api/v1/models/facets?' + this.filterQuery({group_by: column}))
+                    .then(function(response) {
+                        return response.json();
+                    }).then(function(data) {
+                        if ('ok' != data.status) {
+                            return self.showError(data.error.message);
+                        }
+                        self._data.facets = data.data.facets;
+                        self.chart.update(data.data.facets[column] || []);
+                    }).catch(function(error) {
+                        console.log(error);
+                    });
             },
 
             setChartColumnId: function(event, columnId) {
                 $('.btn-chart').addClass('text-muted');
                 $(event.target).removeClass('text-muted');
                 this._data.piechartColumnId = columnId;
-                this.filterChange();
+                this.refreshChart();
             },
 
             // I read the "copy/edit" item as coping an individual model object,
@@ -202,14 +289,17 @@ var App = function(models) {
                 }).then(function(result) {
                     if (result.isConfirmed) {
                         let new_model = result.value.data.model;
-                        self._data.models.push(new_model);
+                        // The change feed may have beaten us to it.
+                        if (!self._data.models.some(function(d) { return d.id == new_model.id; })) {
+                            self._data.models.push(new_model);
+                        }
 
                         // Allow Vue to add element to DOM before scrolling to view.
                         // This is a little hacky but it works.
                         setTimeout(function() {
-                            // We are going to 'trigger' the filterChange. I could also do this
+                            // The new model counts towards the chart. I could also do this
                             // with a custom event and have Vue listen for this when it gets 'mounted'.
-                            self.filterChange();
+                            self.refreshChart();
 
                             // Auto scroll to the newly added element.
                             let $row = self.getRowByModelID(new_model);
@@ -275,8 +365,8 @@ var App = function(models) {
                             model[i] = data.data.model[i];
                         }
 
-                        // Trigger filter change
-                        self.filterChange();
+                        // The chart counts may have changed
+                        self.refreshChart();
 
                         // Throb row that was updated
                         let $row = self.getRowByModelID(model);
@@ -330,7 +420,7 @@ var App = function(models) {
                             self._data.models = self._data.models.filter(function(d) {
                                 return d.id != model.id;
                             });
-                            return self.filterChange();
+                            return self.refreshChart();
                         }
                         self.showError(data.error.message);
                     }
@@ -56,10 +56,16 @@ var PieChart = function(handlers) {
 
     // Function to update chart. D3 will trigger css transitions
     // to nicely animate the chart during the update.
-    this.update = function(raw) {
+    //
+    // The counts come from the server ('/api/v1/models/facets'), so the
+    // chart no longer needs every model to be loaded in the page.
+    //   [{value: 'pass', count: 25}, {value: 'warn', count: 9}, ...]
+    this.update = function(counts) {
 
         // Reformat data
-        let values = d3.set(raw).values();
+        let values = counts.map(function(d) {
+            return String(d.value);
+        });
 
         let color = d3.scale.ordinal()
         	.domain(values)
@@ -68,18 +74,15 @@ var PieChart = function(handlers) {
             }));
 
         function formatData (){
-        	let labels = color.domain();
-        	return values.map(function(label){
+        	return counts.map(function(d){
         		return {
-                    label: label,
-                    value: raw.filter(function(d) {
-                        return label == d;
-                    }).length
+                    label: String(d.value),
+                    value: d.count
                 }
         	});
         }
 
-        let data = formatData(raw);
+        let data = formatData();
 
 
     	// Build the pie chart slices
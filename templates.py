@@ -0,0 +1,110 @@
+#!/usr/bin/python3
+
+'''
+Loads the HTML templates from the 'tmpl' directory once on start up.
+
+The templates are split into pre-encoded byte segments so rendering a page
+is just joining bytes together. No reading from disk or parsing on every
+request. When running with '-debug' a template gets reloaded if the file
+on disk has changed, so front end work doesn't need a server restart.
+'''
+
+import os
+import re
+import string
+
+import conf
+
+
+class Template(object):
+
+    ''' Base class that handles loading (and reloading) a template file. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.load()
+
+    def load(self):
+        with open(self.path, encoding='utf-8') as fh:
+            text = fh.read()
+        self.mtime = os.stat(self.path).st_mtime
+        self.compile(text)
+
+    def compile(self, text):
+        raise NotImplementedError
+
+    def reloadIfChanged(self):
+        # Only worth the 'stat' call when developing.
+        if conf.DEBUG and os.stat(self.path).st_mtime != self.mtime:
+            self.load()
+
+
+class PlaceholderTemplate(Template):
+
+    ''' Templates with '{{name}}' placeholders such as 'page.html'.
+
+        Renders exactly like calling str.replace for each placeholder.
+    '''
+
+    pattern = re.compile(r'\{\{(\w+)\}\}')
+
+    def compile(self, text):
+        # re.split with a group gives us [literal, name, literal, name, ..., literal]
+        parts = self.pattern.split(text)
+        self.segments = [part.encode('utf-8') for part in parts[0::2]]
+        self.names = parts[1::2]
+
+    def render(self, **kwargs):
+        self.reloadIfChanged()
+        out = [self.segments[0]]
+        for name, segment in zip(self.names, self.segments[1:]):
+            if name in kwargs:
+                value = kwargs[name]
+                out.append(value if bytes == type(value) else value.encode('utf-8'))
+            else:
+                # Unknown placeholders are left as is.
+                out.append('{{{{{0}}}}}'.format(name).encode('utf-8'))
+            out.append(segment)
+        return b''.join(out)
+
+
+class FormatTemplate(Template):
+
+    ''' Templates that use str.format style fields such as 'model.html'.
+
+        The template is parsed once with string.Formatter and rendering produces
+        the same bytes as 'text.format(**kwargs).encode()'.
+    '''
+
+    formatter = string.Formatter()
+
+    def compile(self, text):
+        self.segments = []
+        for literal, name, spec, conversion in self.formatter.parse(text):
+            field = None
+            if name is not None:
+                field = (name, spec, conversion)
+            self.segments.append((literal.encode('utf-8'), field))
+
+    def render(self, **kwargs):
+        self.reloadIfChanged()
+        formatter = self.formatter
+        out = []
+        for literal, field in self.segments:
+            out.append(literal)
+            if field is None:
+                continue
+            name, spec, conversion = field
+            value, _ = formatter.get_field(name, (), kwargs)
+            value = formatter.convert_field(value, conversion)
+            if spec and '{' in spec:
+                # Nested fields in the format spec, e.g. '{name:{width}}'
+                spec = formatter.vformat(spec, (), kwargs)
+            out.append(formatter.format_field(value, spec).encode('utf-8'))
+        return b''.join(out)
+
+
+# Templates used by the server. These are loaded when this module is imported.
+PAGE = PlaceholderTemplate(os.path.join('tmpl', 'page.html'))
+MODEL = FormatTemplate(os.path.join('tmpl', 'model.html'))
@@ -0,0 +1,31 @@
+#!/usr/bin/python3
+
+'''
+Points the project at a scratch database before anything opens the real
+one. Every test module imports this first:
+
+    import common
+    import database
+'''
+
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import conf
+
+TMPDIR = tempfile.mkdtemp(prefix='tests-')
+atexit.register(shutil.rmtree, TMPDIR, True)
+
+conf.DB_FILE = os.path.join(TMPDIR, 'test.sqlite3')
+conf.ACCESS_LOG = None
+conf.DB_SLOW_QUERY_MS = None
+
+
+def scratch(name):
+    ''' A path for a database of its own. '''
+    return os.path.join(TMPDIR, name)
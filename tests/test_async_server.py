@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+import json
+import uuid
+import socket
+import asyncio
+import unittest
+import threading
+
+import common
+import async_server
+
+
+class HTTPParserTest(unittest.TestCase):
+
+    def test_request_comes_out_before_its_body(self):
+        parser = async_server.HTTPParser(max_body_size=10)
+        requests = parser.feed(b'POST / HTTP/1.1\r\nContent-Length: 20\r\n\r\n0123456789')
+        self.assertEqual(1, len(requests))
+        body = requests[0].body
+        self.assertIs(body, parser.body)
+        self.assertEqual(b'0123456789', body.read(10))
+        self.assertFalse(body.complete)
+
+        # The rest of the body, then a pipelined request.
+        requests = parser.feed(b'abcdefghijGET /ping HTTP/1.1\r\n\r\n')
+        self.assertTrue(body.complete)
+        self.assertEqual(b'abcdefghij', body.read())
+        self.assertIsNone(parser.body)
+        self.assertEqual(['/ping'], [request.target for request in requests])
+
+    def test_readline(self):
+        parser = async_server.HTTPParser()
+        request, = parser.feed(b'POST / HTTP/1.1\r\nContent-Length: 9\r\n\r\none\ntw')
+        self.assertEqual(b'one\n', request.body.readline())
+        parser.feed(b'o\nx')
+        self.assertEqual(b'two\n', request.body.readline())
+        self.assertEqual(b'x', request.body.readline())
+        self.assertEqual(b'', request.body.readline())
+
+    def test_discarded_body(self):
+        parser = async_server.HTTPParser()
+        request, = parser.feed(b'POST / HTTP/1.1\r\nContent-Length: 6\r\n\r\nabc')
+        request.body.discard()
+        self.assertEqual([], parser.feed(b'def'))
+        self.assertEqual(b'', request.body.read())
+
+    def test_chunked_body_is_still_limited(self):
+        parser = async_server.HTTPParser(max_body_size=4)
+        with self.assertRaises(async_server.ParseError) as e:
+            parser.feed(b'POST / HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n5\r\n')
+        self.assertEqual(413, e.exception.status)
+
+
+class AsyncServerTest(unittest.TestCase):
+
+    max_body_size = 1024
+
+    @classmethod
+    def setUpClass(cls):
+        cls.loop = asyncio.new_event_loop()
+        cls.app = async_server.AsyncServer(cls.loop, workers=2)
+
+        def protocol():
+            protocol = async_server.HTTPProtocol(cls.app)
+            protocol.parser.max_body_size = cls.max_body_size
+            return protocol
+
+        cls.server = cls.loop.run_until_complete(cls.loop.create_server(protocol, 'localhost', 0))
+        cls.address = cls.server.sockets[0].getsockname()[:2]
+        cls.thread = threading.Thread(target=cls.loop.run_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        async def stop():
+            cls.server.close()
+            await cls.app.shutdown(grace=1)
+        asyncio.run_coroutine_threadsafe(stop(), cls.loop).result(10)
+        cls.loop.call_soon_threadsafe(cls.loop.stop)
+        cls.thread.join(10)
+        cls.loop.close()
+
+    def connect(self):
+        sock = socket.create_connection(self.address, timeout=10)
+        self.addCleanup(sock.close)
+        return sock.makefile('rb'), sock
+
+    def readResponse(self, rfile):
+        status = rfile.readline()
+        length = 0
+        while True:
+            line = rfile.readline()
+            if b'\r\n' == line:
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if 'content-length' == name.lower():
+                length = int(value)
+        return int(status.split()[1]), rfile.read(length)
+
+    def importRequest(self, body, expect_continue=False):
+        return (
+            'POST /api/v1/models/import?format=ndjson HTTP/1.1\r\n'
+            'Host: localhost\r\n'
+            'Content-Type: application/x-ndjson\r\n'
+            'Content-Length: {0}\r\n'
+            '{1}\r\n'.format(len(body), 'Expect: 100-continue\r\n' if expect_continue else '')
+        ).encode('latin-1')
+
+    def models(self, count):
+        return ''.join(
+            json.dumps({'name': str(uuid.uuid4()), 'make': 'ford', 'color': 'red', 'status': 'pass'}) + '\n'
+            for _ in range(count)).encode('utf-8')
+
+    def test_body_larger_than_the_chunked_limit(self):
+        body = self.models(100)
+        self.assertGreater(len(body), self.max_body_size)
+        rfile, sock = self.connect()
+        sock.sendall(self.importRequest(body) + body)
+        status, data = self.readResponse(rfile)
+        self.assertEqual(200, status, data)
+        self.assertEqual(100, json.loads(data)['data']['inserted'])
+
+    def test_continue_comes_after_earlier_responses(self):
+        body = self.models(1)
+        rfile, sock = self.connect()
+        sock.sendall(b'GET /ping HTTP/1.1\r\nHost: localhost\r\n\r\n' + self.importRequest(body, True))
+        status, _ = self.readResponse(rfile)
+        self.assertEqual(200, status)
+        self.assertEqual(b'HTTP/1.1 100 Continue\r\n', rfile.readline())
+        self.assertEqual(b'\r\n', rfile.readline())
+        sock.sendall(body)
+        status, data = self.readResponse(rfile)
+        self.assertEqual(200, status, data)
+
+
+if __name__ == '__main__':
+    unittest.main()
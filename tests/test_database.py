@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+
+import sqlite3
+import unittest
+
+import common
+import database
+
+
+class WriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = common.scratch('writer-{0}.sqlite3'.format(self.id().rsplit('.', 1)[-1]))
+        conn = sqlite3.connect(self.path)
+        conn.execute('pragma journal_mode=wal')
+        conn.execute('CREATE TABLE items (value INTEGER)')
+        conn.commit()
+        conn.close()
+        # Don't wait out the usual busy timeout on the lock we hold.
+        self.busy_timeout = database.DB_BUSY_TIMEOUT
+        database.DB_BUSY_TIMEOUT = 100
+        self.pool = database.ConnectionPool(self.path, size=2, timeout=0.2)
+        self.writer = database.Writer(self.pool)
+
+    def tearDown(self):
+        self.writer.stop(5)
+        self.pool.close()
+        database.DB_BUSY_TIMEOUT = self.busy_timeout
+
+    @staticmethod
+    def insert(cursor, value):
+        cursor.execute('INSERT INTO items (value) VALUES (?)', (value,))
+        return value
+
+    def test_locked_database_fails_every_write(self):
+        other = sqlite3.connect(self.path, isolation_level=None)
+        other.execute('BEGIN IMMEDIATE')
+        try:
+            futures = [self.writer.submit(self.insert, i) for i in range(20)]
+            for future in futures:
+                with self.assertRaises(sqlite3.OperationalError):
+                    future.result(timeout=10)
+        finally:
+            other.execute('ROLLBACK')
+            other.close()
+        # The writer is still there once the lock is gone.
+        self.assertEqual(42, self.writer.write(self.insert, 42))
+
+    def test_pool_timeout_fails_the_write(self):
+        held = [self.pool.checkout() for _ in range(self.pool.size)]
+        try:
+            with self.assertRaises(database.PoolTimeoutError):
+                self.writer.submit(self.insert, 1).result(timeout=10)
+        finally:
+            for conn in held:
+                self.pool.checkin(conn)
+        self.assertEqual(2, self.writer.write(self.insert, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/python3
+
+import uuid
+import unittest
+
+import common
+import server
+import database
+from models import Model
+from models import ModelCollection
+
+
+def create(**kwargs):
+    model = Model(name=str(uuid.uuid4()), make='ford', color='red', status='pass')
+    for key, value in kwargs.items():
+        setattr(model, key, value)
+    model.save()
+    return model
+
+
+class PartialUpdateTest(unittest.TestCase):
+
+    def reload(self, model):
+        return Model.fetch(id=model.id)[0]
+
+    def test_only_the_sent_fields_change(self):
+        model = create()
+        name = str(uuid.uuid4())
+        operation = server.Controller.batchOperation('update', {'id': model.id, 'name': name})
+        self.assertEqual(['name'], operation[2])
+        result, = ModelCollection.batch([operation])
+        self.assertIsInstance(result, Model)
+        saved = self.reload(model)
+        self.assertEqual(name, saved.name)
+        self.assertEqual(('ford', 'red', 'pass'), (saved.make, saved.color, saved.status))
+
+    def test_no_fields_changes_nothing(self):
+        model = create()
+        result, = ModelCollection.batch([('update', Model(id=model.id), [])])
+        self.assertIsInstance(result, Model)
+        saved = self.reload(model)
+        self.assertEqual(model.toDict(), saved.toDict())
+
+    def test_all_fields_by_default(self):
+        model = create()
+        ModelCollection([Model(id=model.id, name=model.name, make='gm')]).update()
+        saved = self.reload(model)
+        self.assertEqual(('gm', None, None), (saved.make, saved.color, saved.status))
+
+
+class SaveTest(unittest.TestCase):
+
+    def check(self):
+        id = str(uuid.uuid4())
+        model = Model(id=id, name=str(uuid.uuid4()), make='ford')
+        model.save()
+        self.assertEqual(id, model.id)
+        self.assertEqual('ford', Model.fetch(id=id)[0].make)
+
+        model.make = 'gm'
+        model.save()
+        self.assertEqual(id, model.id)
+        self.assertEqual(['gm'], [saved.make for saved in Model.fetch(id=id)])
+
+        model = Model(name=str(uuid.uuid4()))
+        model.save()
+        self.assertIsNotNone(model.id)
+
+    def test_upsert(self):
+        if not database.SUPPORTS_RETURNING:
+            self.skipTest('SQLite without RETURNING')
+        self.check()
+
+    def test_without_returning(self):
+        supports = database.SUPPORTS_RETURNING
+        database.SUPPORTS_RETURNING = False
+        try:
+            self.check()
+        finally:
+            database.SUPPORTS_RETURNING = supports
+
+
+class IterateTest(unittest.TestCase):
+
+    def test_does_not_hold_a_pool_connection(self):
+        for _ in range(3):
+            create()
+        models = Model.iterate()
+        first = next(models)
+        self.assertIsInstance(first, Model)
+        stats = database.pool.stats()
+        self.assertEqual(0, stats['in_use'])
+        self.assertEqual(1, stats['dedicated'])
+
+        # Writes go through while the export is still going.
+        create()
+        self.assertGreaterEqual(len(list(models)), 2)
+        self.assertEqual(0, database.pool.stats()['dedicated'])
+
+
+class QueryTest(unittest.TestCase):
+
+    def test_sql_arguments_are_not_filters(self):
+        model = create()
+        # Not filters, so they are ignored.
+        models = Model.fetch(id=model.id, columns='sql FROM sqlite_master --', group_by='x')
+        self.assertEqual([model.toDict()], [found.toDict() for found in models])
+
+    def test_group_by_must_be_a_column(self):
+        with self.assertRaises(ValueError):
+            Model._select('count(*)', 'sql FROM sqlite_master --', None, None, None, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+
+import json
+import unittest
+import threading
+import http.client
+
+import common
+import conf
+import server
+from models import Model
+
+
+class ServerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = server.ThreadingSimpleServer(('localhost', 0), server.Controller)
+        cls.server.daemon_threads = True
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def request(self, method, path, body=None):
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=10)
+        try:
+            conn.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def post(self, path, body):
+        status, data = self.request('POST', path, body)
+        return status, json.loads(data) if data else None
+
+    def get(self, path):
+        status, data = self.request('GET', path)
+        return status, json.loads(data) if data else None
+
+
+class BatchHandlerTest(ServerTest):
+
+    def test_body_that_is_not_an_object(self):
+        for body in ('"oops"', '1', 'null'):
+            status, _ = self.post('/api/v1/models/batch', body)
+            self.assertEqual(400, status, body)
+
+    def test_models_must_be_a_list(self):
+        status, _ = self.post('/api/v1/models/batch',
+                              '{"method": "create_models", "params": {"models": {}}}')
+        self.assertEqual(400, status)
+
+    def test_invalid_calls_without_an_id_get_a_response(self):
+        status, data = self.post('/api/v1/models/batch', '[1, {"jsonrpc": "2.0", "method": 5}]')
+        self.assertEqual(200, status)
+        self.assertEqual([-32600, -32600], [response['error']['code'] for response in data])
+        self.assertEqual([None, None], [response['id'] for response in data])
+
+    def test_notifications_do_not_get_a_response(self):
+        status, data = self.post('/api/v1/models/batch', '[{"jsonrpc": "2.0", "method": "nope"}]')
+        self.assertEqual(204, status)
+        self.assertIsNone(data)
+
+
+class ModelsHandlerTest(ServerTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        Model(name='listed', make='ford', color='red', status='pass').save()
+
+    def test_query_arguments_are_ignored(self):
+        for query in ['columns=sql,1,1,1,1,1,1%20FROM%20sqlite_master%20--', 'limit=5&columns=x',
+                      'group_by=sql', 'stream=1&group_by=x', 'q=listed&columns=x']:
+            status, data = self.request('GET', '/api/v1/models?' + query)
+            self.assertEqual(200, status, query)
+            self.assertNotIn(b'CREATE TABLE', data, query)
+            if 'stream' not in query:
+                for model in json.loads(data)['data']['models']:
+                    self.assertEqual(sorted(Model.fields), sorted(model), query)
+
+    def test_filters_still_work(self):
+        _, data = self.get('/api/v1/models?make=ford&limit=5')
+        self.assertTrue(data['data']['models'])
+        self.assertEqual({'ford'}, {model['make'] for model in data['data']['models']})
+
+
+class FacetsHandlerTest(ServerTest):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        Model(name='faceted', make='subaru', color='blue', status='warn').save()
+
+    def counts(self, facets):
+        return {facet['value']: facet['count'] for facet in facets}
+
+    def test_counts(self):
+        status, data = self.get('/api/v1/models/facets?group_by=status,make&make=subaru')
+        self.assertEqual(200, status)
+        facets = data['data']['facets']
+        self.assertEqual(['subaru'], list(self.counts(facets['make'])))
+        self.assertIn('warn', self.counts(facets['status']))
+
+    def test_query_arguments_are_ignored(self):
+        status, data = self.get('/api/v1/models/facets?group_by=status&columns=x&limit=1')
+        self.assertEqual(200, status)
+        self.assertIn('warn', self.counts(data['data']['facets']['status']))
+
+    def test_unknown_column(self):
+        status, _ = self.get('/api/v1/models/facets?group_by=sql%20FROM%20sqlite_master%20--')
+        self.assertEqual(400, status)
+
+
+class IndexHandlerTest(ServerTest):
+
+    def test_query_arguments_are_ignored(self):
+        for query in ['columns=x', 'group_by=x', 'make=ford&columns=sql%20FROM%20sqlite_master%20--', 'q=ford']:
+            status, data = self.request('GET', '/?' + query)
+            self.assertEqual(200, status, query)
+            self.assertNotIn(b'CREATE TABLE', data, query)
+
+
+class ExplainHandlerTest(ServerTest):
+
+    def setUp(self):
+        debug = conf.DEBUG
+        conf.DEBUG = True
+        self.addCleanup(setattr, conf, 'DEBUG', debug)
+
+    def test_query_arguments_are_ignored(self):
+        status, data = self.get('/api/v1/models/explain?make=ford&columns=sql%20FROM%20sqlite_master%20--')
+        self.assertEqual(200, status)
+        self.assertNotIn('sqlite_master', data['data']['query'])
+        self.assertEqual(['ford'], data['data']['params'])
+
+    def test_bad_limit(self):
+        status, _ = self.get('/api/v1/models/explain?limit=x')
+        self.assertEqual(400, status)
+
+
+if __name__ == '__main__':
+    unittest.main()
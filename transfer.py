@@ -0,0 +1,230 @@
+#!/usr/bin/python3
+
+'''
+Bulk import and export of models as NDJSON (one JSON object per line) or CSV
+(with a header row). Used by 'main.py import/export' and the
+'/api/v1/models/import' and '/api/v1/models/export' endpoints.
+
+Both directions stream. Imports read a line at a time and hand the rows to
+ModelCollection.load IMPORT_CHUNK_SIZE at a time (one transaction per chunk),
+exports write rows straight off the database cursor (Model.iterate). So the
+memory used doesn't depend on how many models there are.
+
+    {"id": "...", "name": "thing_1", "make": "ford", "color": "red", "status": "pass", ...}
+
+    id,name,make,color,status,create_at,update_at
+    ...,thing_1,ford,red,pass,2021-09-08 12:00:00,2021-09-08 12:00:00
+
+Only 'name' really matters on the way in. Missing ids, names and timestamps
+are filled in, unknown columns are ignored and empty CSV cells are NULL.
+'''
+
+import io
+import csv
+import json
+import time
+
+import conf
+from models import Model
+from models import ModelCollection
+
+
+# Supported formats and their content types.
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def detectFormat(path=None, content_type=None, default='ndjson'):
+    ''' Guesses the format from a file name or a content type. '''
+    if content_type:
+        content_type = content_type.split(';')[0].strip()
+        for name, mime in FORMATS.items():
+            if mime == content_type:
+                return name
+    if path and path.lower().endswith('.csv'):
+        return 'csv'
+    return default
+
+
+def readNDJSON(lines):
+    ''' Yields (line number, record) for every non blank line. Lines that
+        aren't a JSON object come back as a ValueError instead of a record.
+    '''
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield number, ValueError('Invalid JSON: {0}'.format(e))
+            continue
+        if not isinstance(record, dict):
+            yield number, ValueError('Expected a JSON object')
+            continue
+        yield number, record
+
+
+def readCSV(lines):
+    ''' Yields (line number, record) for every row after the header. '''
+    reader = csv.DictReader(lines)
+    for record in reader:
+        # Quoted values can span lines, so use where the row ended.
+        yield reader.line_num, {key: value for key, value in record.items() if key}
+
+
+READERS = {
+    'ndjson': readNDJSON,
+    'csv': readCSV,
+}
+
+
+def toRow(record):
+    ''' Turns a record into a ModelCollection.load row. '''
+    row = []
+    for column in ModelCollection.loadable:
+        value = record.get(column)
+        if isinstance(value, (dict, list)):
+            raise ValueError('{0} must be a string'.format(column))
+        # CSV has no NULL, so empty strings are the closest thing.
+        row.append(None if value is None or '' == value else str(value))
+    return tuple(row)
+
+
+class Progress(object):
+
+    ''' Counts for an import, and how fast it is going. '''
+
+    def __init__(self, max_errors=conf.IMPORT_MAX_ERRORS):
+        self.max_errors = max_errors
+        self.started = time.monotonic()
+        self.read = 0
+        self.inserted = 0
+        self.updated = 0
+        self.skipped = 0
+        self.failed = 0
+        self.chunks = 0
+        self.errors = []
+        self.stopped = None
+
+    def error(self, line, error):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'line': line, 'message': str(error)})
+
+    def toDict(self):
+        seconds = time.monotonic() - self.started
+        return {
+            'read': self.read,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'chunks': self.chunks,
+            'seconds': round(seconds, 3),
+            'rows_per_second': round(self.read / seconds, 1) if seconds else 0.0,
+            'errors': self.errors,
+            'stopped': self.stopped
+        }
+
+    def __str__(self):
+        stats = self.toDict()
+        return ('{read} read, {inserted} inserted, {updated} updated, {skipped} skipped, '
+                '{failed} failed in {seconds}s ({rows_per_second} rows/s)').format(**stats)
+
+
+def importModels(lines, fmt='ndjson', on_conflict='fail', chunk_size=conf.IMPORT_CHUNK_SIZE,
+                 progress=None, interval=conf.IMPORT_PROGRESS_INTERVAL):
+    ''' Imports the records in 'lines' (any iterable of text lines, such as
+        an open file). 'progress' gets called with the Progress every
+        'interval' seconds. Returns the final Progress.
+
+        With on_conflict 'fail' the import stops at the first chunk with a
+        bad row. Chunks before it have already been committed.
+    '''
+    if fmt not in READERS:
+        raise ValueError('format must be one of {0}'.format(', '.join(READERS)))
+    if on_conflict not in ModelCollection.CONFLICT_POLICIES:
+        raise ValueError('on_conflict must be one of {0}'.format(
+            ', '.join(ModelCollection.CONFLICT_POLICIES)))
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be at least 1')
+
+    stats = Progress()
+    reported = time.monotonic()
+    # (line number, row) waiting to be written
+    chunk = []
+
+    def flush():
+        ''' Writes the chunk. Returns the line of the first bad row, if any. '''
+        inserted, updated, skipped, errors = ModelCollection.load(
+            [row for _, row in chunk], on_conflict)
+        stats.chunks += 1
+        stats.inserted += inserted
+        stats.updated += updated
+        stats.skipped += skipped
+        for i, error in errors:
+            stats.error(chunk[i][0], error)
+        first = chunk[errors[0][0]][0] if errors else None
+        chunk.clear()
+        return first
+
+    for line, record in READERS[fmt](lines):
+        stats.read += 1
+        try:
+            if isinstance(record, Exception):
+                raise record
+            chunk.append((line, toRow(record)))
+        except ValueError as e:
+            stats.error(line, e)
+            if 'fail' == on_conflict:
+                stats.stopped = line
+                break
+        if len(chunk) >= chunk_size:
+            stats.stopped = flush()
+            if stats.stopped is not None and 'fail' == on_conflict:
+                break
+        if progress is not None and time.monotonic() - reported >= interval:
+            progress(stats)
+            reported = time.monotonic()
+    else:
+        if chunk:
+            stats.stopped = flush()
+    if 'fail' != on_conflict:
+        stats.stopped = None
+    if progress is not None:
+        progress(stats)
+    return stats
+
+
+def exportModels(fmt='ndjson', batch_size=conf.EXPORT_BATCH_SIZE, progress=None, **kwargs):
+    ''' Yields the matching models (same filters as Model.fetch) as text,
+        'batch_size' rows per chunk. 'progress' gets called with the number
+        of rows written so far after every chunk.
+    '''
+    if fmt not in FORMATS:
+        raise ValueError('format must be one of {0}'.format(', '.join(FORMATS)))
+    buffer = io.StringIO()
+    writer = None
+    if 'csv' == fmt:
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(Model.fields)
+    count = 0
+    for model in Model.iterate(**kwargs):
+        if writer is None:
+            buffer.write(json.dumps(model.toDict()))
+            buffer.write('\n')
+        else:
+            writer.writerow(['' if value is None else value for value in map(model.get, Model.fields)])
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            if progress is not None:
+                progress(count)
+    if buffer.tell():
+        yield buffer.getvalue()
+    if progress is not None:
+        progress(count)
@@ -1,7 +1,73 @@
 #!/usr/bin/python3
 
+import json
 from mimetypes import MimeTypes
 mime = MimeTypes()
 
 def getMimeTypeFromFile(fpath):
     return mime.guess_type(fpath)
+
+def parseAcceptEncoding(header):
+    ''' Parses an 'Accept-Encoding' header into a dict of {encoding: q-value}.
+        Encodings with a q-value of 0 are explicitly not acceptable.
+    '''
+    encodings = {}
+    if not header:
+        return encodings
+    for item in header.split(','):
+        parts = item.strip().split(';')
+        name = parts[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if 'q' == key.strip():
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        encodings[name] = q
+    return encodings
+
+def acceptsEncoding(encodings, name):
+    ''' Checks the parsed 'Accept-Encoding' values for the given encoding. '''
+    if name in encodings:
+        return encodings[name] > 0
+    return encodings.get('*', 0) > 0
+
+def etagMatches(header, etag):
+    ''' Checks an 'If-None-Match' header against our ETag. Uses the weak
+        comparison, so 'W/"1"' matches '"1"'.
+    '''
+    if not header:
+        return False
+    if '*' == header.strip():
+        return True
+    etag = etag[2:] if etag.startswith('W/') else etag
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+class RawJSON(bytes):
+    ''' JSON that has already been encoded (UTF-8). 'dumps' puts it in a
+        payload as is.
+    '''
+    __slots__ = ()
+
+def dumps(value):
+    ''' json.dumps straight to UTF-8 bytes, with the same output. RawJSON
+        can be the value itself or a value in a dict (at any depth), the
+        dicts around it are put together here.
+    '''
+    if isinstance(value, RawJSON):
+        return value
+    if isinstance(value, dict) and any(isinstance(item, (RawJSON, dict)) for item in value.values()):
+        return b'{' + b', '.join(
+            json.dumps(str(key)).encode('utf-8') + b': ' + dumps(item)
+            for key, item in value.items()) + b'}'
+    return json.dumps(value).encode('utf-8')